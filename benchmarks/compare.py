@@ -0,0 +1,63 @@
+"""Compares two result files written by ``benchmarks/run.py``. Exits
+with status 1 if the memory allocated per request grew by more than
+``--max-allocation-growth`` percent in any scenario.
+
+    python3 -m benchmarks.compare BASELINE.json CANDIDATE.json
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return {(x['scenario'], x['concurrency']): x for x in report['results']},\
+        {x['scenario']: x for x in report.get('allocations', [])}
+
+
+def change(old, new):
+    if not old:
+        return "n/a"
+    return "{0:+.1f}%".format((new - old) / old * 100)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Compares two benchmark result files.")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--max-allocation-growth', type=float, default=10.0,
+        help="The allowed growth of the peak allocation per request, in percent (default: 10).")
+    args = parser.parse_args(argv)
+
+    baseline, baseline_allocations = load(args.baseline)
+    candidate, candidate_allocations = load(args.candidate)
+    print("{0:<20} {1:>4} {2:>12} {3:>9} {4:>12} {5:>9}".format(
+        'scenario', 'thr', 'req/s', 'change', 'p99 ms', 'change'))
+    for key in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[key], candidate[key]
+        print("{0:<20} {1:>4} {2:>12.1f} {3:>9} {4:>12.3f} {5:>9}".format(
+            key[0], key[1], new['rps'], change(old['rps'], new['rps']),
+            new['p99_ms'], change(old['p99_ms'], new['p99_ms'])))
+
+    regressions = []
+    print()
+    print("{0:<20} {1:>12} {2:>9} {3:>12} {4:>9}".format(
+        'scenario', 'peak KiB', 'change', 'blocks', 'change'))
+    for key in sorted(set(baseline_allocations) & set(candidate_allocations)):
+        old, new = baseline_allocations[key], candidate_allocations[key]
+        print("{0:<20} {1:>12.2f} {2:>9} {3:>12.2f} {4:>9}".format(
+            key, new['peak_kb'], change(old['peak_kb'], new['peak_kb']),
+            new['retained_blocks'],
+            change(old['retained_blocks'], new['retained_blocks'])))
+        if new['peak_kb'] > old['peak_kb'] * (1 + args.max_allocation_growth / 100):
+            regressions.append(key)
+
+    if regressions:
+        print("Allocation regressions: " + ', '.join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
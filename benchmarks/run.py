@@ -0,0 +1,263 @@
+"""Measures the throughput and latency of the command issue path, both
+through :class:`gateway.wsgi.GatewayApplication` (using the WSGI test
+client, in-process) and by invoking :meth:`gateway.Gateway.issue()`
+directly, and the memory allocated while handling a single request.
+Results are written as JSON, so that runs of different versions can be
+compared with ``benchmarks/compare.py``.
+
+    python3 -m benchmarks.run [--requests N] [--concurrency 1,4,16] [--output FILE]
+"""
+from os.path import dirname
+from os.path import join
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+import ioc
+
+from gateway.dto import CommandRequestDTO
+from gateway.wsgi import GatewayApplication
+
+
+IOC_TEMPLATE = join(dirname(__file__), 'gateway.ioc')
+COMMAND_TYPE = 'gateway.test.TestCommand'
+PARAMS = {'foo': 1, 'bar': 2, 'baz': 3}
+
+
+def load_container(dsn):
+    """Load the IoC container using the benchmark configuration, with
+    the command store writing to `dsn`.
+    """
+    with open(IOC_TEMPLATE) as f:
+        config = f.read().replace('{dsn}', dsn)
+    fd, path = tempfile.mkstemp(suffix='.ioc')
+    with os.fdopen(fd, 'w') as f:
+        f.write(config)
+    try:
+        ioc.load_container(path)
+    finally:
+        os.unlink(path)
+
+
+def issue_direct(asynchronous):
+    gateway = ioc.instance('CommandGateway')
+
+    def factory():
+        def issue():
+            gateway.issue(CommandRequestDTO(None, COMMAND_TYPE, asynchronous,
+                dict(PARAMS), 100, 100, '127.0.0.1'))
+        return issue
+    return factory
+
+
+def post_http(asynchronous):
+    body = json.dumps({
+        'command': COMMAND_TYPE,
+        'asynchronous': asynchronous,
+        'params': PARAMS
+    })
+
+    def factory():
+        client = create_client()
+        def post():
+            request(client, 'POST', '/v1/command', body, expected=(200, 201, 202))
+        return post
+    return factory
+
+
+def get_http(limit):
+    def factory():
+        client = create_client()
+        def get():
+            request(client, 'GET', '/v1/command?limit={0}'.format(limit))
+        return get
+    return factory
+
+
+def create_client():
+    return Client(GatewayApplication(), Response)
+
+
+def request(client, method, path, body=None, expected=(200,)):
+    response = client.open(path, method=method, data=body,
+        content_type='application/json')
+    try:
+        response.get_data()
+        if response.status_code not in expected:
+            raise AssertionError("{0} {1} returned {2}"\
+                .format(method, path, response.status_code))
+    finally:
+        response.close()
+
+
+def measure(factory, requests, concurrency):
+    """Invoke the callables created by `factory` `requests` times in
+    total, from `concurrency` threads, and return a dictionary with
+    the throughput and the latency percentiles.
+    """
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+    count = max(1, requests // concurrency)
+
+    def worker():
+        func = factory()
+        local = []
+        barrier.wait()
+        for i in range(count):
+            started = time.perf_counter()
+            func()
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed)
+
+
+def measure_allocations(factory, requests):
+    """Invoke the callable created by `factory` `requests` times from
+    the current thread, and return a dictionary with the largest amount
+    of memory allocated while handling a request, and the number of
+    memory blocks retained per request.
+    """
+    func = factory()
+
+    # Warm up the lazily created handlers, schemas and sessions.
+    func()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        peak = 0
+        for i in range(requests):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    gc.collect()
+    return {
+        'peak_kb': round(peak / 1024.0, 2),
+        'retained_blocks': round((sys.getallocatedblocks() - blocks) / requests, 2)
+    }
+
+
+def summarize(latencies, elapsed):
+    latencies.sort()
+
+    def percentile(p):
+        index = int(round(p / 100.0 * (len(latencies) - 1)))
+        return round(latencies[index] * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+    }
+
+
+def get_scenarios(page_sizes):
+    scenarios = [
+        ('issue.sync', issue_direct(False)),
+        ('issue.async', issue_direct(True)),
+        ('http.post.sync', post_http(False)),
+        ('http.post.async', post_http(True)),
+    ]
+    for limit in page_sizes:
+        scenarios.append(('http.get.{0}'.format(limit), get_http(limit)))
+    return scenarios
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Benchmarks the Gateway command issue path.")
+    parser.add_argument('--requests', type=int, default=2000,
+        help="The number of requests per scenario and concurrency level (default: 2000).")
+    parser.add_argument('--concurrency', default='1,4,16',
+        help="A comma-separated list of thread counts (default: 1,4,16).")
+    parser.add_argument('--page-sizes', default='10,100,1000',
+        help="A comma-separated list of GET /v1/command page sizes (default: 10,100,1000).")
+    parser.add_argument('--only', default=None,
+        help="Only run the scenarios whose name starts with this prefix.")
+    parser.add_argument('--allocations', type=int, default=200,
+        help="The number of requests per scenario measuring allocations; 0 to skip (default: 200).")
+    parser.add_argument('--dsn', default=None,
+        help="The database URL of the command store (default: a temporary SQLite database).")
+    parser.add_argument('--output', default=None,
+        help="Write the results as JSON to this file (default: stdout).")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-')
+    load_container(args.dsn or 'sqlite:///' + join(workdir, 'bench.db'))
+
+    concurrency = [int(x) for x in args.concurrency.split(',')]
+    page_sizes = [int(x) for x in args.page_sizes.split(',')]
+    results = []
+    allocations = []
+    for name, factory in get_scenarios(page_sizes):
+        if args.only and not name.startswith(args.only):
+            continue
+        if args.allocations:
+            result = measure_allocations(factory, args.allocations)
+            result.update(scenario=name)
+            allocations.append(result)
+            print("{scenario:<20} peak {peak_kb:>10.2f}KiB/req  "
+                "retained {retained_blocks:>8.2f} blocks/req".format(**result),
+                file=sys.stderr)
+        for threads in concurrency:
+            result = measure(factory, args.requests, threads)
+            result.update(scenario=name, concurrency=threads)
+            results.append(result)
+            print("{scenario:<20} x{concurrency:<3} {rps:>10.1f} req/s  "
+                "p50 {p50_ms:>8.3f}ms  p95 {p95_ms:>8.3f}ms  p99 {p99_ms:>8.3f}ms"\
+                    .format(**result), file=sys.stderr)
+
+    report = {
+        'revision': get_revision(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'requests': args.requests,
+        'results': results,
+        'allocations': allocations
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
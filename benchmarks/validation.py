@@ -0,0 +1,65 @@
+"""Compares validating commands with
+:meth:`gateway.provider.CommandHandlersProvider.validate()` as the
+gateway did before validators were compiled, i.e. through the handler
+schema followed by the rebuild of the parameters, with the current
+implementation, which assigns the parameters returned by the compiled
+validator.
+
+    python3 -m benchmarks.validation [--number N]
+"""
+import argparse
+import timeit
+
+from gateway.dto import CommandRequestDTO
+from gateway.provider import CommandHandlersProvider
+
+
+PARAMS = {'foo': 1, 'bar': '2', 'baz': 3, 'ignored': 4}
+
+
+class SchemaCommandHandlersProvider(CommandHandlersProvider):
+    """Validates commands like the provider did before validators were
+    compiled.
+    """
+
+    def validate(self, command):
+        handler = self.get(command.command)
+        params, errors = handler.schema.load(command.params)
+        if errors:
+            raise handler.CommandRejected(context=errors)
+        for key in list(command.params.keys()):
+            command.params.pop(key)
+            if key in params:
+                command.params[key] = params[key]
+        return command
+
+
+def create_command():
+    return CommandRequestDTO(None, 'gateway.test.TestCommand', False,
+        dict(PARAMS), 1, 0, '127.0.0.1')
+
+
+def main(number):
+    providers = [
+        ('schema', SchemaCommandHandlersProvider()),
+        ('compiled', CommandHandlersProvider())
+    ]
+    assert providers[0][1].validate(create_command()).params\
+        == providers[1][1].validate(create_command()).params
+
+    results = {}
+    for name, provider in providers:
+        seconds = min(timeit.repeat(
+            lambda: provider.validate(create_command()),
+            number=number, repeat=3))
+        results[name] = number / seconds
+        print("{0:>10}: {1:>12,.0f} validations/s".format(name, results[name]))
+    print("  speed-up: {0:.1f}x".format(results['compiled'] / results['schema']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Benchmarks command parameter validation.")
+    parser.add_argument('--number', type=int, default=20000,
+        help="The number of validations per run (default: 20000).")
+    main(parser.parse_args().number)
@@ -0,0 +1,36 @@
+"""ASGI entry point of the Gateway HTTP interface, e.g.::
+
+    GATEWAY_IOC_CONFIG=/etc/gateway/gateway.ioc uvicorn gateway.__asgi__:application
+"""
+import os
+import sys
+
+import ioc
+
+from gateway.asgi import GatewayASGIApplication
+
+
+IOC_CONFIG = os.getenv('GATEWAY_IOC_CONFIG') or '/etc/gateway/gateway.ioc'
+if not os.path.exists(IOC_CONFIG):
+    print("No such file: " + IOC_CONFIG)
+    sys.exit(1)
+
+ioc.load_container(IOC_CONFIG)
+
+DEBUG = os.getenv('GATEWAY_DEBUG') == '1'
+try:
+    EXECUTOR_WORKERS = int(os.getenv('GATEWAY_EXECUTOR_WORKERS', 32))
+    MAX_PENDING = int(os.getenv('GATEWAY_MAX_PENDING', 10000))
+    ASYNC_WORKERS = int(os.getenv('GATEWAY_ASYNC_WORKERS', 1000))
+except ValueError:
+    print("Invalid value set for GATEWAY_EXECUTOR_WORKERS, GATEWAY_MAX_PENDING"
+        " or GATEWAY_ASYNC_WORKERS")
+    sys.exit(1)
+
+
+application = GatewayASGIApplication(
+    executor_workers=EXECUTOR_WORKERS,
+    max_pending=MAX_PENDING,
+    workers=ASYNC_WORKERS,
+    debug=DEBUG
+)
@@ -0,0 +1,127 @@
+import collections
+import math
+import threading
+import time
+
+from gateway.mixins import ICommandProcessor
+
+
+class AdmissionControl(ICommandProcessor):
+    """Limits the rate at which commands are admitted with token
+    buckets, one per issuer and one per command type. A command is
+    admitted only if both buckets hold a token.
+
+    Args:
+        issuer_rate: the number of commands per second each issuer may
+            issue, or ``0`` for no limit.
+        issuer_burst: the number of commands an issuer may issue at
+            once; defaults to `issuer_rate`.
+        issuer_rates: a dictionary mapping issuers to the rate that
+            applies to them instead of `issuer_rate`.
+        command_rates: a dictionary mapping command types to the number
+            of commands of that type per second that may be issued by
+            all issuers together. Other command types are not limited.
+        command_burst: the number of commands of a type that may be
+            issued at once, as a multiple of its rate.
+        max_buckets: the maximum number of issuer buckets kept. The
+            bucket of the least recently seen issuer is discarded first;
+            the issuer starts again with a full bucket.
+    """
+
+    def __init__(self, issuer_rate=0, issuer_burst=None, issuer_rates=None,
+        command_rates=None, command_burst=1.0, max_buckets=10000):
+        self.issuer_rate = issuer_rate
+        self.issuer_burst = issuer_burst
+        self.issuer_rates = {str(k): v for k, v in (issuer_rates or {}).items()}
+        self.command_rates = dict(command_rates or {})
+        self.command_burst = command_burst
+        self.max_buckets = max_buckets
+        self.enabled = bool(issuer_rate or self.issuer_rates or self.command_rates)
+        self.lock = threading.Lock()
+        self.issuers = collections.OrderedDict()
+        self.commands = {}
+
+    def admit(self, command):
+        """Take a token for `command` from the bucket of its issuer and
+        of its type.
+
+        Raises:
+            RateLimited: a bucket is empty. The ``retry_after`` key of
+                the exception context holds the number of seconds
+                after which a token is available.
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self.lock:
+            issuer = self.get_issuer_bucket(command.issuer, now)
+            delay = issuer.take(now) if issuer is not None else 0
+            if delay:
+                raise self.get_exception("issuer", delay)
+
+            bucket = self.get_command_bucket(command.command, now)
+            delay = bucket.take(now) if bucket is not None else 0
+            if delay:
+                # The command is not admitted, so the issuer keeps its token.
+                if issuer is not None:
+                    issuer.tokens += 1
+                raise self.get_exception("command type", delay)
+
+    def get_issuer_bucket(self, issuer, now):
+        bucket = self.issuers.get(issuer)
+        if bucket is not None:
+            self.issuers.move_to_end(issuer)
+            return bucket
+        rate = self.issuer_rates.get(str(issuer), self.issuer_rate)
+        if not rate:
+            return None
+        self.prune()
+        bucket = self.issuers[issuer] = TokenBucket(rate,
+            self.issuer_burst or rate, now)
+        return bucket
+
+    def get_command_bucket(self, command_type, now):
+        bucket = self.commands.get(command_type)
+        if bucket is None:
+            rate = self.command_rates.get(command_type)
+            if not rate:
+                return None
+            bucket = self.commands[command_type] = TokenBucket(rate,
+                rate * self.command_burst, now)
+        return bucket
+
+    def prune(self):
+        # Make room for a bucket, so that a flood of distinct issuers
+        # does not grow the buckets without limit.
+        while len(self.issuers) >= self.max_buckets:
+            self.issuers.popitem(last=False)
+
+    def get_exception(self, limit, delay):
+        return self.RateLimited(
+            reason="The {0} rate limit was exceeded. Retry later.".format(limit),
+            context={'retry_after': math.ceil(delay)})
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens, which are replenished at `rate`
+    tokens per second.
+    """
+    __slots__ = ['rate', 'burst', 'tokens', 'updated']
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = now
+
+    def take(self, now):
+        """Take a token and return ``0``, or return the number of
+        seconds after which a token is available.
+        """
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
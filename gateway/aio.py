@@ -0,0 +1,524 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+from gateway.dto import CommandResponseDTO
+from gateway.exc import GatewayException
+from gateway.mixins import ICommandProcessor
+from gateway.pool import FairQueueMixin
+from gateway.store import ICommandStore
+
+
+class AsyncCommandStore(ICommandProcessor):
+    """Exposes the methods of a :class:`gateway.store.ICommandStore` as
+    coroutines, which invoke the store in `executor`.
+
+    Args:
+        store: the wrapped :class:`gateway.store.ICommandStore`.
+        executor: a :class:`concurrent.futures.Executor`.
+    """
+    STATE_PENDING = ICommandStore.STATE_PENDING
+    STATE_FAILED = ICommandStore.STATE_FAILED
+    STATE_DONE = ICommandStore.STATE_DONE
+    STATE_RETRYING = ICommandStore.STATE_RETRYING
+    ACTIVE_STATES = ICommandStore.ACTIVE_STATES
+
+    def __init__(self, store, executor):
+        self.store = store
+        self.executor = executor
+
+    async def call(self, func, *args, **kwargs):
+        """Invoke `func` in the executor and release the resources the
+        store holds on behalf of the executor thread.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor,
+            functools.partial(self._call, func, *args, **kwargs))
+
+    async def persist(self, command):
+        return await self.call(self.store.persist, command)
+
+    async def persist_many(self, commands):
+        return await self.call(self.store.persist_many, commands)
+
+    async def set_status(self, command_id, status, result=None):
+        return await self.call(self.store.set_status, command_id, status, result)
+
+    async def release_idempotency_key(self, command_id):
+        return await self.call(self.store.release_idempotency_key, command_id)
+
+    def _call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.store.release()
+
+
+class AsyncFairQueue(FairQueueMixin, asyncio.Queue):
+    """An :class:`asyncio.Queue` of tasks taken by weighted fair
+    queuing; see :class:`gateway.pool.FairQueueMixin`.
+    """
+
+    def _init(self, maxsize):
+        super(AsyncFairQueue, self)._init(maxsize)
+        # asyncio.Queue counts the items of _queue.
+        self._queue = self.heap
+
+
+class AsyncWorkerPool:
+    """Runs coroutine functions on `workers` tasks consuming a bounded
+    queue, like :class:`gateway.pool.WorkerPool` does with threads.
+    The tasks are started on the running event loop when the first
+    coroutine function is submitted.
+
+    Args:
+        workers: the number of tasks running the coroutine functions.
+        queue_size: the maximum number of coroutine functions waiting
+            for a task; ``0`` means unbounded.
+        executor: the :class:`concurrent.futures.Executor` invoking the
+            synchronous handlers of the commands run by the pool.
+        weights: if not ``None``, coroutine functions are taken from
+            the queue by weighted fair queuing across the flows they
+            are submitted with. A dictionary mapping flows to their
+            weight; other flows have a weight of ``1``.
+    """
+    QueueFull = asyncio.QueueFull
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, workers, queue_size, executor, weights=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = executor
+        self.queue = asyncio.Queue(queue_size) if weights is None\
+            else AsyncFairQueue(queue_size, weights)
+        self.tasks = []
+        self.busy = 0
+
+    def submit(self, func, *args, flow=None):
+        """Schedule the coroutine function `func` to be awaited with the
+        positional arguments `args` by one of the tasks. `flow`
+        identifies the flow of `func` if the pool uses fair queuing.
+
+        Raises:
+            AsyncWorkerPool.QueueFull: the queue is full.
+        """
+        if not self.tasks:
+            self.tasks = [asyncio.ensure_future(self._work())
+                for i in range(self.workers)]
+        self.queue.put_nowait((func, args, flow))
+
+    def shutdown(self):
+        """Cancel the tasks; the queued coroutine functions are not
+        run.
+        """
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+
+    def metrics(self):
+        return {
+            'workers': self.workers,
+            'workers_busy': self.busy,
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue_size
+        }
+
+    async def _work(self):
+        while True:
+            func, args, flow = await self.queue.get()
+            self.busy += 1
+            try:
+                await func(*args)
+            except Exception:
+                self.logger.exception("Caught exception in asynchronous worker.")
+            finally:
+                self.busy -= 1
+
+
+class AsyncCommandRunner(ICommandProcessor):
+    """Runs commands on the event loop. Handlers whose ``run()`` method
+    is a coroutine function are awaited; other handlers are invoked in
+    `executor`. Asynchronous commands are run by `workers` tasks.
+
+    If `partitioned` is ``True``, commands whose handler declares a
+    partition key run after the commands with the same key that were
+    issued before them, like on the shards of
+    :class:`gateway.test.CommandRunner`. Synchronous commands then
+    wait for these commands to finish.
+
+    The asynchronous commands of a lane listed in `lanes` are run by
+    tasks reserved for the lane, with a queue and a thread pool of
+    their own, so that a burst of commands of other lanes neither
+    delays them nor takes the threads they need.
+
+    If `weights` is not ``None``, the queued asynchronous commands are
+    run by weighted fair queuing across issuers, so that an issuer
+    submitting a burst of commands does not delay the commands of the
+    other issuers.
+
+    Args:
+        handlers: the :class:`gateway.provider.CommandHandlersProvider`.
+        store: an :class:`AsyncCommandStore`.
+        executor: a :class:`concurrent.futures.Executor`.
+        max_pending: the maximum number of asynchronous commands waiting
+            to be run, per lane. Commands exceeding this limit are
+            rejected with :exc:`UpstreamFailure`.
+        workers: the number of asynchronous commands of the lanes that
+            are not reserved that may be running at once.
+        partitioned: run the commands with the same partition key one
+            at a time, in order.
+        lanes: a dictionary mapping lanes to the number of their
+            asynchronous commands that may be running at once, which is
+            also the number of threads reserved for their synchronous
+            handlers.
+        weights: a dictionary mapping issuers to their share of the
+            workers relative to other issuers, which have a weight of
+            ``1``, or ``None`` to run the commands in the order in
+            which they were issued.
+    """
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, handlers, store, executor, max_pending=10000,
+        workers=1000, partitioned=False, lanes=None, weights=None):
+        self.handlers = handlers
+        self.store = store
+        self.executor = executor
+        self.max_pending = max_pending
+        self.partitioned = bool(partitioned)
+        self.partitions = {}
+        self.tasks = set()
+        self.pool = AsyncWorkerPool(workers, max_pending, executor, weights)
+        self.lanes = {
+            lane: AsyncWorkerPool(int(lane_workers), max_pending,
+                concurrent.futures.ThreadPoolExecutor(int(lane_workers),
+                    thread_name_prefix='gateway-lane-' + lane), weights)
+            for lane, lane_workers in (lanes or {}).items()
+        }
+
+    async def execute(self, command):
+        handler = self.handlers.get(command.command)
+        key = self.get_partition_key(handler, command)
+        if command.asynchronous:
+            return self.run_asynchronous(handler, command, key)
+
+        try:
+            if key is None:
+                ident, result, created = await self.run(handler, command)
+            else:
+                ident, result, created = await self.run_after(key,
+                    self.run, handler, command)
+        except self.UpstreamFailure:
+            raise
+        except Exception:
+            raise self.CommandFailed
+        return ident, result, True, created, False
+
+    def get_partition_key(self, handler, command):
+        if not self.partitioned:
+            return None
+        return handler.get_partition_key(command.params)
+
+    def run_after(self, key, func, *args):
+        """Return a task awaiting the coroutine function `func` with the
+        positional arguments `args` once the task submitted before with
+        the partition key `key`, if any, has finished.
+        """
+        previous = self.partitions.get(key)
+        task = asyncio.ensure_future(self._run_after(previous, func, *args))
+        self.partitions[key] = task
+
+        def forget(task):
+            if self.partitions.get(key) is task:
+                del self.partitions[key]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def _run_after(self, previous, func, *args):
+        if previous is not None:
+            # The outcome of the previous command does not matter.
+            await asyncio.wait([previous])
+        return await func(*args)
+
+    async def run(self, handler, command, executor=None):
+        return await handler.policy.run_async(
+            lambda: self.invoke(handler, command, executor or self.executor),
+            on_retry=lambda attempt: self.on_retry(command, attempt))
+
+    async def invoke(self, handler, command, executor):
+        if asyncio.iscoroutinefunction(handler.run):
+            result = handler.run(command)
+        else:
+            loop = asyncio.get_event_loop()
+            result = loop.run_in_executor(executor, handler.run, command)
+        if handler.policy.timeout is None:
+            return await result
+
+        # Synchronous handlers keep running in the executor after
+        # the timeout expired; only the wait is cancelled.
+        try:
+            return await asyncio.wait_for(result, handler.policy.timeout)
+        except asyncio.TimeoutError:
+            raise self.UpstreamFailure(reason="The command timed out.")
+
+    async def on_retry(self, command, attempt):
+        self.logger.warning("Retrying command (id: {0}), attempt {1}."\
+            .format(command.id, attempt))
+        if command.id is not None:
+            await self.store.set_status(command.id, self.store.STATE_RETRYING)
+
+    def run_asynchronous(self, handler, command, key=None):
+        """Schedule a command on the pool of its lane, or after the
+        commands with the same partition key `key`.
+
+        Raises:
+            UpstreamFailure: the queue is full.
+        """
+        assert command.id is not None
+        if key is not None:
+            if len(self.tasks) >= self.max_pending:
+                raise self.UpstreamFailure(
+                    reason="The command queue is full. Retry later.")
+            task = self.run_after(key, self._async, handler, command)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return None, None, False, False, False
+
+        pool = self.lanes.get(handler.lane, self.pool)
+        try:
+            pool.submit(self._async, handler, command, pool.executor,
+                flow=command.issuer)
+        except pool.QueueFull:
+            raise self.UpstreamFailure(
+                reason="The command queue is full. Retry later.")
+        return None, None, False, False, False
+
+    def shutdown(self):
+        """Stop running asynchronous commands and shut the thread pools
+        of the lanes down.
+        """
+        self.pool.shutdown()
+        for pool in self.lanes.values():
+            pool.shutdown()
+            pool.executor.shutdown(wait=False)
+
+    def get_metrics(self):
+        metrics = self.pool.metrics()
+        metrics['shard_queue_depth'] = len(self.tasks)
+        for lane, pool in self.lanes.items():
+            for name, value in pool.metrics().items():
+                metrics['lane_{0}_{1}'.format(lane, name)] = value
+        return metrics
+
+    async def _async(self, handler, command, executor=None):
+        try:
+            ident, result, created = await self.run(handler, command, executor)
+            await self.store.set_status(command.id, self.store.STATE_DONE,
+                result={'ident': ident, 'result': result})
+        except Exception:
+            await self.store.set_status(command.id, self.store.STATE_FAILED)
+            self.logger.exception(
+                "Caught fatal exception during handling of command (id: {0})."\
+                    .format(command.id)
+            )
+
+
+class AsyncGateway(ICommandProcessor):
+    """Exposes :class:`gateway.Gateway` to coroutines.
+
+    Args:
+        gateway: the wrapped :class:`gateway.Gateway`.
+        store: an :class:`AsyncCommandStore`.
+        runner: an :class:`AsyncCommandRunner`.
+        executor: a :class:`concurrent.futures.Executor`.
+    """
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, gateway, store, runner, executor):
+        self.gateway = gateway
+        self.store = store
+        self.runner = runner
+        self.executor = executor
+        self.inflight = {}
+
+    async def get_commands(self, *args, **kwargs):
+        return await self.store.call(self.gateway.get_commands, *args, **kwargs)
+
+    async def get_page(self, **query):
+        return await self.store.call(self.gateway.get_page, **query)
+
+    def get_metrics(self):
+        """Return the gauges of the synchronous command runner, and
+        those of the coroutine runner prefixed with ``async_``.
+        """
+        metrics = self.gateway.get_metrics()
+        for name, value in self.runner.get_metrics().items():
+            metrics['async_' + name] = value
+        return metrics
+
+    async def get_command(self, command_id, wait=0):
+        """Coroutine equivalent of :meth:`gateway.Gateway.get_command()`.
+        The event loop is not blocked while waiting.
+        """
+        loop = asyncio.get_event_loop()
+        event = asyncio.Event()
+        notifier = self.gateway.store.notifier
+
+        def callback():
+            loop.call_soon_threadsafe(event.set)
+
+        notifier.subscribe(command_id, callback)
+        try:
+            deadline = loop.time() + wait
+            while True:
+                event.clear()
+                command = await self.store.call(
+                    self.gateway.describe_command, command_id)
+                remaining = deadline - loop.time()
+                if command is None or remaining <= 0\
+                or command['status'] not in self.store.ACTIVE_STATES:
+                    return command
+                try:
+                    await asyncio.wait_for(event.wait(),
+                        min(remaining, self.gateway.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            notifier.unsubscribe(command_id, callback)
+
+    async def iter_commands(self, *args, limit=None, chunk_size=500, **kwargs):
+        """Like :meth:`gateway.Gateway.iter_commands()`, but fetch the
+        commands in pages of `chunk_size` from the executor.
+        """
+        while limit is None or limit > 0:
+            size = chunk_size if limit is None else min(limit, chunk_size)
+            commands = await self.get_commands(*args, limit=size, **kwargs)
+            for command in commands:
+                yield command
+            if len(commands) < size:
+                break
+            if limit is not None:
+                limit -= len(commands)
+            kwargs['cursor'] = commands[-1]['command_id']
+
+    async def issue(self, command):
+        """Coroutine equivalent of :meth:`gateway.Gateway.issue()`."""
+        if self.gateway.is_readonly_mode():
+            raise self.ReadOnlyMode(reason=self.gateway.readonly_message)
+
+        command = self.gateway.validate(command)
+        self.gateway.admit(command)
+        if command.idempotency_key is None:
+            return await self._issue(command)
+        return await self.issue_idempotent(command)
+
+    async def issue_idempotent(self, command):
+        """Coroutine equivalent of
+        :meth:`gateway.Gateway.issue_idempotent()`.
+        """
+        # Like IdempotencyCache.run(), commands with the same key issued
+        # at once wait for the first one and receive its response.
+        key = (command.issuer, command.idempotency_key)
+        fingerprint = self.gateway.get_fingerprint(command)
+        pending = self.inflight.get(key)
+        if pending is not None:
+            issued, response = await asyncio.shield(pending)
+            self.gateway.check_fingerprint(issued, fingerprint)
+            return response
+
+        pending = self.inflight[key] = asyncio.get_event_loop().create_future()
+        try:
+            response = await self._issue_once(command)
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # Mark the exception as retrieved if no command waits for it.
+            pending.exception()
+            raise
+        finally:
+            del self.inflight[key]
+        pending.set_result((fingerprint, response))
+        return response
+
+    async def _issue_once(self, command):
+        # Looking up an earlier response blocks, so it is done in the
+        # executor; the command itself is run like the others. Commands
+        # with the same key issued by other processes are deduplicated
+        # by the store.
+        response = await self.store.call(self.gateway.lookup, command)
+        if response is None:
+            response = await self._issue(command)
+            self.gateway.remember(command, response)
+        return response
+
+    async def _issue(self, command):
+        try:
+            with self.gateway.timer('persist', command):
+                tx = await self.store.persist(command)
+        except self.DuplicateEntity:
+            replayed = await self.store.call(self.gateway.replay, command)\
+                if command.idempotency_key is not None else None
+            if replayed is None:
+                raise
+            return replayed[1]
+        return await self.execute(tx)
+
+    async def issue_batch(self, commands):
+        """Coroutine equivalent of :meth:`gateway.Gateway.issue_batch()`."""
+        if self.gateway.is_readonly_mode():
+            raise self.ReadOnlyMode(reason=self.gateway.readonly_message)
+
+        results = [None] * len(commands)
+        valid = []
+        for i, command in enumerate(commands):
+            try:
+                command = self.gateway.validate(command)
+                self.gateway.admit(command)
+                valid.append((i, command))
+            except (self.CommandRejected, self.RateLimited) as e:
+                results[i] = e
+
+        batched = [(i, x) for i, x in valid if x.idempotency_key is None]
+        transactions = await self.store.persist_many([x for i, x in batched])
+        for (i, command), tx in zip(batched, transactions):
+            try:
+                results[i] = await self.execute(tx)
+            except GatewayException as e:
+                results[i] = e
+
+        for i, command in valid:
+            if command.idempotency_key is None:
+                continue
+            try:
+                results[i] = await self.issue_idempotent(command)
+            except GatewayException as e:
+                results[i] = e
+
+        return results
+
+    async def execute(self, tx):
+        try:
+            with self.gateway.timer('execute', tx.command):
+                result = await self.runner.execute(tx.command)
+        except Exception as e:
+            await self.store.set_status(tx.ident, self.store.STATE_FAILED)
+            if isinstance(e, self.CommandFailed):
+                self.logger.exception(
+                    "Caught fatal exception during handling of command (id: {0})."\
+                        .format(tx.ident)
+                )
+            if isinstance(e, self.UpstreamFailure)\
+            and tx.command.idempotency_key is not None:
+                await self.store.release_idempotency_key(tx.ident)
+            raise
+
+        response = CommandResponseDTO(tx.ident, *result)
+        if response.done:
+            with self.gateway.timer('set_status', tx.command):
+                await self.store.set_status(response.command_id, self.store.STATE_DONE,
+                    result={'ident': response.ident, 'result': response.result})
+
+        return response
@@ -0,0 +1,222 @@
+import contextlib
+import fcntl
+import gzip
+import heapq
+import json
+import logging
+import os
+import threading
+
+from gateway.memory import CommandRecord
+
+
+class CommandArchive:
+    """Stores the commands removed from the command store by
+    :class:`gateway.retention.CommandRetention` in the directory
+    `path`, and reads them back.
+
+    The commands are appended in batches to segment files. Each batch
+    is a separate gzip member holding one JSON object per line, so
+    that a batch can be read without decompressing the rest of its
+    segment. The index file lists the position of each batch in its
+    segment, and the range of identifiers and timestamps it covers.
+    A batch is added to the index only after it has been written, so
+    that a batch torn by a crash is never read.
+
+    Args:
+        path: the directory holding the segments and the index.
+        segment_size: the number of commands after which a new
+            segment is started.
+        fsync: flush the segments and the index to disk after each
+            batch.
+    """
+    index_name = 'index.jsonl'
+    lock_name = '.lock'
+    logger = logging.getLogger('gateway.archive')
+
+    def __init__(self, path='archive', segment_size=100000, fsync=True):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = bool(fsync)
+        self.lock = threading.Lock()
+        self.batches = None
+        self.index_size = 0
+        self.segment = None
+        self.segment_count = 0
+
+    def get_batches(self):
+        """Return the list of :class:`ArchivedBatch` instances listed
+        in the index. The index is read again when it was extended by
+        another process.
+        """
+        try:
+            size = os.stat(os.path.join(self.path, self.index_name)).st_size
+        except FileNotFoundError:
+            size = 0
+        if self.batches is not None and size == self.index_size:
+            return self.batches
+        with self.lock:
+            self.batches = self.load()
+            self.index_size = size
+        return self.batches
+
+    def load(self):
+        batches = []
+        path = os.path.join(self.path, self.index_name)
+        if not os.path.exists(path):
+            return batches
+        with open(path) as f:
+            for line in f:
+                try:
+                    batches.append(ArchivedBatch(**json.loads(line)))
+                except ValueError:
+                    # The last line may be torn by a crash.
+                    self.logger.warning("Skipping invalid index entry in " + path)
+        self.segment, self.segment_count = None, 0
+        for batch in batches:
+            if batch.segment != self.segment:
+                self.segment, self.segment_count = batch.segment, 0
+            self.segment_count += batch.count
+        return batches
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """Lock the archive against other processes. Yields ``True`` if
+        the lock was acquired, or ``False`` if another process holds it.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, self.lock_name), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, commands):
+        """Append a batch of commands, ordered by ascending identifier,
+        to the current segment.
+
+        Args:
+            commands: a list of objects exposing the attributes of
+                :class:`gateway.memory.CommandRecord`.
+        """
+        if not commands:
+            return
+        records = [{x: getattr(c, x) for x in CommandRecord.__slots__}
+            for c in commands]
+        data = gzip.compress(''.join(
+            json.dumps(x, separators=(',', ':')) + '\n' for x in records)\
+                .encode('utf-8'))
+        timestamps = [x['timestamp'] for x in records]
+
+        batches = self.get_batches()
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            if self.segment is None or self.segment_count >= self.segment_size:
+                self.segment = 'commands-{0:020d}.jsonl.gz'\
+                    .format(records[0]['command_id'])
+                self.segment_count = 0
+            offset = self.write(self.segment, data)
+            batch = ArchivedBatch(self.segment, offset, len(data),
+                records[0]['command_id'], records[-1]['command_id'],
+                min(timestamps), max(timestamps), len(records))
+            entry = (json.dumps(batch.as_dict()) + '\n').encode('utf-8')
+            self.index_size = self.write(self.index_name, entry, line=True)\
+                + len(entry)
+            batches.append(batch)
+            self.segment_count += batch.count
+
+    def write(self, name, data, line=False):
+        # Return the offset at which `data` was appended. A line is
+        # started on a new line if the file ends with a torn one.
+        with open(os.path.join(self.path, name), 'a+b') as f:
+            offset = os.fstat(f.fileno()).st_size
+            if line and offset and os.pread(f.fileno(), 1, offset - 1) != b'\n':
+                f.write(b'\n')
+                offset += 1
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        return offset
+
+    def read(self, batch):
+        """Return the list of :class:`~gateway.memory.CommandRecord`
+        instances in `batch`.
+        """
+        with open(os.path.join(self.path, batch.segment), 'rb') as f:
+            f.seek(batch.offset)
+            data = gzip.decompress(f.read(batch.length))
+        return [CommandRecord(**json.loads(x))
+            for x in data.decode('utf-8').splitlines()]
+
+    def get_command(self, command_id):
+        """Return the archived command identified by `command_id`, or
+        ``None``.
+        """
+        for batch in self.get_batches():
+            if not (batch.first_id <= command_id <= batch.last_id):
+                continue
+            for record in self.read(batch):
+                if record.command_id == command_id:
+                    return record
+        return None
+
+    def get_commands(self, cursor=None, limit=100, status=None,
+        command_type=None, issuer=None, since=None, until=None):
+        """Return a list containing the archived commands matching the
+        criteria accepted by
+        :meth:`gateway.store.ICommandStore.get_commands()`, ordered by
+        descending identifier. Only the batches whose identifiers and
+        timestamps overlap the criteria are read.
+        """
+        batches = [x for x in self.get_batches()
+            if (cursor is None or x.first_id < cursor)
+            and (since is None or x.until >= since)
+            and (until is None or x.since < until)]
+
+        # Batches usually hold increasing identifiers, but a command
+        # that finished late is archived after newer ones; reading stops
+        # once no remaining batch can hold one of the `limit` greatest
+        # identifiers found.
+        batches.sort(key=lambda x: x.last_id, reverse=True)
+        found = {}
+        for batch in batches:
+            if limit is not None and len(found) >= limit\
+            and batch.last_id < heapq.nlargest(limit, found)[-1]:
+                break
+            for record in self.read(batch):
+                if (cursor is None or record.command_id < cursor)\
+                and (status is None or record.status == status)\
+                and (command_type is None or record.command_type == command_type)\
+                and (issuer is None or record.issuer == issuer)\
+                and (since is None or record.timestamp >= since)\
+                and (until is None or record.timestamp < until):
+                    found[record.command_id] = record
+        return [found[x] for x in sorted(found, reverse=True)[:limit]]
+
+    def iter_commands(self, *args, **kwargs):
+        return iter(self.get_commands(*args, **kwargs))
+
+
+class ArchivedBatch:
+    __slots__ = ['segment', 'offset', 'length', 'first_id', 'last_id',
+        'since', 'until', 'count']
+
+    def __init__(self, segment, offset, length, first_id, last_id, since,
+        until, count):
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.first_id = first_id
+        self.last_id = last_id
+        self.since = since
+        self.until = until
+        self.count = count
+
+    def as_dict(self):
+        return {x: getattr(self, x) for x in self.__slots__}
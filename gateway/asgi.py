@@ -0,0 +1,285 @@
+import concurrent.futures
+import inspect
+import io
+import sys
+
+from libsousou.web.exc import HttpException
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response
+import ioc
+
+from gateway.aio import AsyncCommandRunner
+from gateway.aio import AsyncCommandStore
+from gateway.aio import AsyncGateway
+from gateway.errors import ISSUE_ERRORS
+from gateway.errors import describe as describe_error
+from gateway.errors import get_headers as get_error_headers
+from gateway.wsgi import BatchController
+from gateway.wsgi import CommandStatusController
+from gateway.wsgi import GatewayApplication
+from gateway.wsgi import GatewayController
+from gateway.wsgi import MetricsController
+
+
+class AsyncControllerMixin:
+    """Dispatches requests to controller methods that may be
+    coroutine functions.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        method = request.get_request_method()
+        self.negotiate(request)
+        try:
+            self.authenticate(request, *args, **kwargs)
+            handler = self._get_request_handler(method)
+            response = handler(request, *args, **kwargs)
+            if inspect.isawaitable(response):
+                response = await response
+        except HttpException as e:
+            response = e.render_to_response(self.render_to_response, request)
+        except Exception as e:
+            if self.debug:
+                raise
+            response = self.on_server_error(e, request,  *args, **kwargs)
+        return response
+
+
+class AsyncGatewayController(AsyncControllerMixin, GatewayController):
+
+    async def get(self, request, **kwargs):
+        if self.must_stream(request):
+            return self.stream(request)
+
+        query = self.parse_query(request)
+        del query['stream']
+        return self.render_page(request, query,
+            *(await self.gateway.get_page(**query)))
+
+    async def post(self, request, **kwargs):
+        with self.time_request() as timer:
+            command = None
+            headers = None
+            try:
+                command = self.parse_command(request)
+                status, result = self.describe_result(await self.gateway.issue(command))
+            except ISSUE_ERRORS as e:
+                status, result = describe_error(e)
+                headers = get_error_headers(e)
+            self.tag_result(timer, command, status, result)
+        return self.render_to_response(result, status=status, headers=headers)
+
+    async def iter_lines(self, items):
+        async for item in items:
+            yield self.encode(item) + '\n'
+
+    async def iter_array(self, items):
+        yield '['
+        separator = ''
+        async for item in items:
+            yield separator + self.encode(item)
+            separator = ','
+        yield ']'
+
+
+class AsyncBatchController(AsyncControllerMixin, BatchController):
+
+    async def post(self, request, **kwargs):
+        results, commands = self.parse_batch(request)
+        try:
+            issued = await self.gateway.issue_batch([x for i, x in commands])
+        except ISSUE_ERRORS as e:
+            status, result = describe_error(e)
+            return self.render_to_response(result, status=status,
+                headers=get_error_headers(e))
+        return self.render_batch(results, commands, issued)
+
+
+class AsyncCommandStatusController(AsyncControllerMixin, CommandStatusController):
+
+    async def get(self, request, command_id, **kwargs):
+        wait = self.parse_query(request, self.wait_schema)['wait']
+        return self.render_command(
+            await self.gateway.get_command(command_id, wait=wait))
+
+
+class AsyncMetricsController(AsyncControllerMixin, MetricsController):
+    pass
+
+
+class GatewayASGIApplication:
+    """Serves the routes of :class:`gateway.wsgi.GatewayApplication` as
+    an ASGI application. Requests are handled on the event loop, and the
+    blocking calls to the command store and to synchronous command
+    handlers are offloaded to a thread pool. If the ``CommandRunner`` is
+    sharded, the commands with the same partition key run in order. The
+    lanes reserved by the ``CommandRunner`` and its fair queuing apply
+    to the asynchronous commands run on the event loop too, as they do
+    when the gateway is served through WSGI.
+
+    Args:
+        executor_workers: the number of threads in the pool running
+            blocking calls.
+        max_pending: the maximum number of asynchronous commands
+            waiting to be run, per lane.
+        workers: the number of asynchronous commands that may be
+            running at once, besides those of the reserved lanes.
+        debug: enable debug mode.
+    """
+    urls = GatewayApplication.urls
+    controllers = {
+        'command': AsyncGatewayController,
+        'command_status': AsyncCommandStatusController,
+        'batch': AsyncBatchController,
+        'metrics': AsyncMetricsController,
+    }
+    request_class = GatewayApplication.request_class
+    response_class = Response
+    command_gateway = ioc.instance('CommandGateway')
+    handlers = ioc.instance('CommandHandlersProvider')
+    runner = ioc.instance('CommandRunner')
+    store = ioc.instance('CommandStore')
+    recovery = ioc.instance('CommandRecovery')
+    retention = ioc.instance('CommandRetention')
+    codecs = ioc.instance('GatewayCodecs')
+
+    def __init__(self, executor_workers=32, max_pending=10000, workers=1000,
+        debug=False):
+        self.executor_workers = executor_workers
+        self.max_pending = max_pending
+        self.workers = workers
+        self.debug = debug
+        self.executor = None
+        self.gateway = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        body = await self.read_body(receive)
+        request = self.request_class(self.get_environ(scope, body))
+        request.codecs = self.codecs
+        response = await self.process_request(request)
+        await self.send_response(response, send)
+
+    def setup(self):
+        """Create the executor and the asynchronous adapters of the
+        command store, runner and gateway.
+        """
+        if self.gateway is not None:
+            return
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            self.executor_workers, thread_name_prefix='gateway-executor')
+        store = AsyncCommandStore(self.store, self.executor)
+        runner = AsyncCommandRunner(self.handlers, store, self.executor,
+            max_pending=self.max_pending, workers=self.workers,
+            **self.get_runner_options())
+        self.gateway = AsyncGateway(self.command_gateway, store, runner,
+            self.executor)
+        self.recovery.start()
+        self.retention.start()
+
+    def get_runner_options(self):
+        """Return the options of the :class:`AsyncCommandRunner` that
+        follow the configuration of the ``CommandRunner``.
+        """
+        return {
+            'partitioned': getattr(self.runner, 'shards', None) is not None,
+            'lanes': {lane: pool.workers for lane, pool
+                in getattr(self.runner, 'lanes', {}).items()},
+            'weights': getattr(self.runner, 'weights', None)
+        }
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.setup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.gateway is not None:
+                    self.gateway.runner.shutdown()
+                if self.executor is not None:
+                    self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def process_request(self, request):
+        self.setup()
+        adapter = self.urls.bind_to_environ(request.environ)
+        try:
+            endpoint, values = adapter.match()
+        except HTTPException as e:
+            return self.response_class("", content_type="application/json", status=e.code)
+
+        controller = self.controllers[endpoint]()
+        controller.gateway = self.gateway
+        return await controller.dispatch(request, **values)
+
+    async def read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] != 'http.request':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def send_response(self, response, send):
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [
+                (k.lower().encode('latin-1'), v.encode('latin-1'))
+                for k, v in response.headers.to_wsgi_list()
+            ]
+        })
+        if not hasattr(response.response, '__aiter__'):
+            await send({'type': 'http.response.body', 'body': response.get_data()})
+            return
+
+        async for chunk in response.response:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk,
+                'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def get_environ(self, scope, body):
+        """Return a WSGI environment for the request described by the
+        ASGI connection `scope`.
+        """
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            if name == 'CONTENT_TYPE':
+                environ[name] = value
+                continue
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value\
+                if key in environ else value
+        return environ
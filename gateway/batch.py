@@ -0,0 +1,112 @@
+import logging
+import queue
+import threading
+import time
+
+
+class GroupCommitter:
+    """Combines operations submitted by concurrent threads into batches
+    that are committed at once by a single background thread. The
+    submitting thread blocks until its batch is committed.
+
+    Args:
+        commit: a callable that receives a list of operations, commits
+            them in one transaction and returns a list holding the
+            result of each operation.
+        batch_size: the maximum number of operations in a batch.
+        window: the number of seconds to wait for more operations
+            when the queue is drained before the batch is full.
+    """
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, commit, batch_size=64, window=0.0):
+        self.commit = commit
+        self.batch_size = batch_size
+        self.window = window
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, operation):
+        """Submit an operation and wait until it is committed.
+
+        Returns:
+            the result of the operation, as returned by :attr:`commit`.
+        """
+        self.start()
+        pending = PendingOperation(operation)
+        self.queue.put(pending)
+        return pending.wait()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                name='gateway-commit', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            results = self.commit([x.operation for x in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].fail(e)
+                return
+
+            # Commit the operations one by one so that a single
+            # invalid operation does not fail the others.
+            self.logger.warning(
+                "Group commit of {0} operations failed, retrying individually."\
+                    .format(len(batch)))
+            for pending in batch:
+                self._commit([pending])
+            return
+
+        for pending, result in zip(batch, results):
+            pending.resolve(result)
+
+
+class PendingOperation:
+    __slots__ = ['operation', 'event', 'result', 'exception']
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+    def resolve(self, result):
+        self.result = result
+        self.event.set()
+
+    def fail(self, exception):
+        self.exception = exception
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
@@ -0,0 +1,171 @@
+import bisect
+import collections
+import threading
+import time
+
+
+class ListingCache:
+    """Caches pages of the command listing, keyed by their query. A
+    page is evicted when a command that may appear in it is persisted
+    or changes status in this process, and at the latest after `ttl`
+    seconds, which bounds the staleness of pages affected by other
+    processes.
+
+    A page covers the range of identifiers from the last command of the
+    page, if the page is full, up to its cursor. The pages are indexed
+    by the bounds of their range, so that a change only visits the pages
+    that may cover the command: the first pages of the listing, which
+    have no cursor, by their lower bound, and the other pages by their
+    cursor. The most recent changes are kept, so that a page read while
+    a command was changed is only discarded if it covers the command.
+
+    Args:
+        size: the maximum number of pages kept; the least recently used
+            pages are evicted first.
+        ttl: the number of seconds a page is kept.
+        history: the number of recent changes kept to check the pages
+            that are put; pages read before older changes are discarded.
+    """
+
+    def __init__(self, size=256, ttl=1.0, history=1024):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.version = 0
+        self.changes = collections.deque(maxlen=history)
+        self.heads = RangeIndex()
+        self.tails = RangeIndex()
+
+    @staticmethod
+    def get_key(query):
+        return tuple(sorted(query.items()))
+
+    def get(self, key):
+        """Return the :class:`CachedPage` for `key`, or ``None``."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires < time.monotonic():
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, commands, etag, cursor, limit):
+        """Cache a page read while the cache was at `version`. The page
+        is discarded if a command it may contain was changed since.
+        """
+        # A page holds the first `limit` matching commands below the
+        # cursor, so a change to a command below the last one of a full
+        # page does not affect it.
+        lower = commands[-1]['command_id']\
+            if limit is not None and commands and len(commands) == limit\
+            else None
+        entry = CachedPage(commands, etag, cursor, lower,
+            time.monotonic() + self.ttl)
+        with self.lock:
+            if self.version - version > len(self.changes):
+                return
+            for changed, command_id in reversed(self.changes):
+                if changed <= version:
+                    break
+                if entry.covers(command_id):
+                    return
+
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.get_index(entry).add(entry, key)
+            while len(self.entries) > self.size:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate(self, command_id):
+        """Evict the pages that may contain the command identified by
+        `command_id`.
+        """
+        with self.lock:
+            self.version += 1
+            self.changes.append((self.version, command_id))
+            for key in self.heads.find_below(command_id)\
+            + self.tails.find_above(command_id):
+                if self.entries[key].covers(command_id):
+                    self.remove(key)
+
+    def get_index(self, entry):
+        # The first pages are indexed by their lower bound, and the
+        # other pages by their cursor.
+        return self.heads if entry.cursor is None else self.tails
+
+    def remove(self, key):
+        # Must be invoked while holding the lock.
+        entry = self.entries.pop(key)
+        self.get_index(entry).discard(entry, key)
+
+
+class RangeIndex:
+    """Maps the lower bounds or the cursors of pages to their keys. A
+    bound of ``None`` stands for no bound.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.bounds = []
+
+    def add(self, entry, key):
+        bound = self.get_bound(entry)
+        keys = self.keys.get(bound)
+        if keys is None:
+            keys = self.keys[bound] = set()
+            if bound is not None:
+                bisect.insort(self.bounds, bound)
+        keys.add(key)
+
+    def discard(self, entry, key):
+        bound = self.get_bound(entry)
+        keys = self.keys[bound]
+        keys.discard(key)
+        if not keys:
+            del self.keys[bound]
+            if bound is not None:
+                del self.bounds[bisect.bisect_left(self.bounds, bound)]
+
+    def get_bound(self, entry):
+        return entry.cursor if entry.cursor is not None else entry.lower
+
+    def find_below(self, command_id):
+        """Return the keys with a bound lower than or equal to
+        `command_id`, or without a bound.
+        """
+        bounds = self.bounds[:bisect.bisect_right(self.bounds, command_id)]
+        return self.collect([None] + bounds)
+
+    def find_above(self, command_id):
+        """Return the keys with a bound greater than `command_id`."""
+        index = bisect.bisect_right(self.bounds, command_id)
+        return self.collect(self.bounds[index:])
+
+    def collect(self, bounds):
+        keys = []
+        for bound in bounds:
+            keys.extend(self.keys.get(bound, ()))
+        return keys
+
+
+class CachedPage:
+    __slots__ = ['commands', 'etag', 'cursor', 'lower', 'expires']
+
+    def __init__(self, commands, etag, cursor, lower, expires):
+        self.commands = commands
+        self.etag = etag
+        self.cursor = cursor
+        self.lower = lower
+        self.expires = expires
+
+    def covers(self, command_id):
+        """Return a boolean indicating if the command identified by
+        `command_id` may appear in the page.
+        """
+        return (self.cursor is None or command_id < self.cursor)\
+            and (self.lower is None or command_id >= self.lower)
@@ -0,0 +1,156 @@
+import json
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from gateway.dto import describe_response
+
+
+class JSONCodec:
+    """Encodes and decodes JSON with the standard library. Request
+    bodies are decoded from bytes without an intermediate string.
+
+    Args:
+        indent: the indentation of the encoded output, or ``None`` for
+            compact output.
+    """
+    content_type = 'application/json'
+
+    def __init__(self, indent=None):
+        self.indent = indent
+        self.separators = None if indent else (',', ':')
+        self.encoder = json.JSONEncoder(indent=indent,
+            separators=self.separators)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode(self, obj):
+        return self.encoder.encode(obj).encode('utf-8')
+
+    def encode_response(self, response):
+        """Encode a :class:`gateway.dto.CommandResponseDTO` like
+        :func:`gateway.dto.describe_response()` does, from the fields
+        of the response.
+        """
+        if self.indent:
+            return self.encode(describe_response(response))
+        return b''.join([
+            b'{"command_id":', self.encode(response.command_id),
+            b',"ident":', self.encode(response.ident),
+            b',"result":', self.encode(response.result), b'}'])
+
+
+class FastJSONCodec(JSONCodec):
+    """Like :class:`JSONCodec`, but uses :mod:`orjson`, which must be
+    installed.
+    """
+
+    def __init__(self, indent=None):
+        if orjson is None:
+            raise ImportError("FastJSONCodec requires the orjson package.")
+        super(FastJSONCodec, self).__init__(indent=indent)
+        self.options = orjson.OPT_NON_STR_KEYS
+        if indent:
+            self.options |= orjson.OPT_INDENT_2
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+    def encode(self, obj):
+        try:
+            return orjson.dumps(obj, option=self.options)
+        except TypeError:
+            # Integers exceeding 64 bits and types unknown to orjson.
+            return super(FastJSONCodec, self).encode(obj)
+
+
+class MessagePackCodec:
+    """Encodes and decodes MessagePack with :mod:`msgpack`, which must
+    be installed.
+    """
+    content_type = 'application/msgpack'
+    aliases = ['application/x-msgpack']
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("MessagePackCodec requires the msgpack package.")
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def encode_response(self, response):
+        """Like :meth:`JSONCodec.encode_response()`."""
+        return b''.join([b'\x83',
+            self.encode('command_id'), self.encode(response.command_id),
+            self.encode('ident'), self.encode(response.ident),
+            self.encode('result'), self.encode(response.result)])
+
+
+class CodecRegistry:
+    """Maps media types to the codecs that decode request bodies and
+    encode responses. Request bodies are decoded with the codec of
+    their ``Content-Type``, and responses are encoded with the codec
+    best matching the ``Accept`` header. Requests without a registered
+    media type fall back to the default codec, which is JSON.
+
+    Args:
+        fast_json: use :class:`FastJSONCodec` as the default codec if
+            :mod:`orjson` is installed.
+        messagepack: register :class:`MessagePackCodec` if
+            :mod:`msgpack` is installed.
+        debug: indent the JSON output.
+    """
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, fast_json=True, messagepack=True, debug=False):
+        self.codecs = {}
+        self.content_types = []
+        indent = 4 if debug else None
+        self.default = FastJSONCodec(indent) if fast_json and orjson\
+            else JSONCodec(indent)
+        self.register(self.default)
+        if messagepack:
+            self.register_optional(MessagePackCodec)
+
+    def register(self, codec, *aliases):
+        """Register `codec` for its content type and `aliases`, in
+        addition to the aliases declared by the codec. Codecs registered
+        first are preferred if the client accepts several media types
+        with the same quality. A codec implements the methods of
+        :class:`JSONCodec`.
+        """
+        self.codecs[codec.content_type] = codec
+        self.content_types.append(codec.content_type)
+        for content_type in list(aliases) + getattr(codec, 'aliases', []):
+            self.codecs[content_type] = codec
+
+    def register_optional(self, codec_class, *args, **kwargs):
+        try:
+            self.register(codec_class(*args, **kwargs))
+        except ImportError as e:
+            self.logger.warning("Codec not registered: {0}".format(e))
+
+    def get(self, content_type):
+        """Return the codec decoding `content_type`, or the default
+        codec.
+        """
+        return self.codecs.get(content_type) or self.default
+
+    def negotiate(self, accept):
+        """Return the codec encoding the media type that best matches
+        `accept`, a :class:`werkzeug.datastructures.MIMEAccept`.
+        """
+        return self.get(accept.best_match(self.content_types,
+            default=self.default.content_type))
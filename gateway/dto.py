@@ -5,10 +5,24 @@ CommandResponseDTO = namedtuple('CommandResponseDTO', [
     'command_id','ident', 'result','done','created','error'])
 
 
+def describe_response(response):
+    """Return the dictionary that represents a :class:`CommandResponseDTO`
+    in the responses of the gateway.
+    """
+    return {
+        'command_id': response.command_id,
+        'ident': response.ident,
+        'result': response.result
+    }
+
+
 class CommandRequestDTO:
-    fields = ['id','command','asynchronous', 'params','issuer','authenticated_by','host']
+    fields = ['id','command','asynchronous', 'params','issuer','authenticated_by','host',
+        'idempotency_key']
+    __slots__ = fields
 
-    def __init__(self, id, command, asynchronous, params, issuer, authenticated_by, host):
+    def __init__(self, id, command, asynchronous, params, issuer, authenticated_by, host,
+        idempotency_key=None):
         self.id = id
         self.command = command
         self.asynchronous = asynchronous
@@ -16,6 +30,7 @@ class CommandRequestDTO:
         self.issuer = issuer
         self.authenticated_by = authenticated_by
         self.host = host
+        self.idempotency_key = idempotency_key
 
     def set_command_id(self, ident):
         self.id = ident
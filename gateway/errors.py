@@ -0,0 +1,80 @@
+from marshmallow import ValidationError
+
+from gateway.mixins import ICommandProcessor
+
+
+#: The exceptions that may be raised while issuing a command, which
+#: are reported to the client with :func:`describe()`.
+ISSUE_ERRORS = (ICommandProcessor.CommandFailed, ICommandProcessor.NotAuthorized,
+    ICommandProcessor.DuplicateEntity, ICommandProcessor.CommandRejected,
+    ICommandProcessor.ReadOnlyMode, ICommandProcessor.UpstreamFailure,
+    ICommandProcessor.RateLimited, ValidationError)
+
+
+def describe(e):
+    """Return a tuple containing the HTTP status code and the error
+    context reported to the client for an exception raised while
+    issuing a command.
+
+    Args:
+        e: an exception listed in :data:`ISSUE_ERRORS`.
+
+    Returns:
+        tuple
+    """
+    if isinstance(e, ICommandProcessor.CommandFailed):
+        return 500, {
+            'code': 'FATAL_ERROR',
+            'message': "Fatal error during command handling.",
+            'hint': e.reason
+        }
+    if isinstance(e, ICommandProcessor.NotAuthorized):
+        return 401, {
+            'code': 'AUTHORIZATION_FAILURE',
+            'message': "You are not authorized to issue this command.",
+            'hint': e.reason
+        }
+    if isinstance(e, ICommandProcessor.DuplicateEntity):
+        return 409, {
+            'code': 'DUPLICATE_ENTITY',
+            'message': "The issued command causes a conflicting state.",
+            'hint': e.reason
+        }
+    if isinstance(e, (ICommandProcessor.CommandRejected, ValidationError)):
+        # The errors of the fields, if any, are reported in the context.
+        return 422, {
+            'code': 'UNPROCESSABLE_ENTITY',
+            'message': "The command provided in the request could not be processed.",
+            'hint': getattr(e, 'reason', "Invalid command parameters."),
+            'context': (e.messages if isinstance(e, ValidationError)
+                else e.context) or {}
+        }
+    if isinstance(e, ICommandProcessor.ReadOnlyMode):
+        return 503, {
+            'code': 'READONLY_MODE',
+            'message': "The system is in read-only mode.",
+            'hint': e.reason or "The system is in read-only mode until further notice."
+        }
+    if isinstance(e, ICommandProcessor.UpstreamFailure):
+        return 503, {
+            'code': 'UPSTREAM_FAILURE',
+            'message': "An upstream system component failed to service.",
+            'hint': e.reason
+        }
+    if isinstance(e, ICommandProcessor.RateLimited):
+        return 429, {
+            'code': 'RATE_LIMITED',
+            'message': "Too many commands were issued.",
+            'hint': e.reason,
+            'context': e.context
+        }
+    raise TypeError("Unknown error: {0}".format(type(e).__name__))
+
+
+def get_headers(e):
+    """Return a dictionary containing the response headers reported
+    to the client for an exception raised while issuing a command.
+    """
+    if isinstance(e, ICommandProcessor.RateLimited):
+        return {'Retry-After': str(e.context['retry_after'])}
+    return {}
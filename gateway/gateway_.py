@@ -1,19 +1,38 @@
+import hashlib
+import json
 import logging
+import threading
+import time
 
 from eda import dto
 import ioc
 
+from gateway.cache import ListingCache
 from gateway.dto import CommandResponseDTO
 from gateway.exc import GatewayException
+from gateway.idempotency import IdempotencyCache
 from gateway.mixins import ICommandProcessor
 
 
 class Gateway(ICommandProcessor):
-    """The gateway to which commands are issued."""
+    """The gateway to which commands are issued.
+
+    Args:
+        idempotency_cache_size: the maximum number of responses to
+            commands with an idempotency key kept in memory.
+        idempotency_ttl: the number of seconds these responses are kept.
+        listing_cache_size: the number of pages of the command listing
+            that are cached; ``0`` disables the cache.
+        listing_cache_ttl: the number of seconds a page is cached.
+    """
     handlers = ioc.instance('CommandHandlersProvider')
     runner = ioc.instance('CommandRunner')
     store = ioc.instance('CommandStore')
+    metrics = ioc.instance('GatewayMetrics')
+    admission = ioc.instance('AdmissionControl')
+    archive = ioc.instance('CommandArchive')
     readonly_message = None
+    poll_interval = 1.0
     logger = logging.getLogger('gateway')
 
     class schema_class(dto.Adapter):
@@ -22,16 +41,135 @@ class Gateway(ICommandProcessor):
             fields = ['command_id','timestamp','status',
                 'host','command_type','issuer','authenticated_by']
 
-    def __init__(self):
+    def __init__(self, idempotency_cache_size=10000, idempotency_ttl=86400,
+        listing_cache_size=0, listing_cache_ttl=1.0):
         self.schema = self.schema_class(many=True, strict=True)
+        self.item_schema = self.schema_class(strict=True)
+        self.idempotency = IdempotencyCache(
+            size=idempotency_cache_size, ttl=idempotency_ttl)
+        self.cache = ListingCache(listing_cache_size, listing_cache_ttl)\
+            if listing_cache_size > 0 else None
+        self.cache_lock = threading.Lock()
+        self.cache_attached = False
 
-    def get_commands(self, *args, **kwargs):
+    def get_commands(self, *args, archived=False, **kwargs):
         """Return a list containing the issued commands using the
-        specified criteria.
+        specified criteria. If `archived` is ``True``, the commands are
+        read from the archive instead of the command store.
+        """
+        source = self.archive if archived else self.store
+        result, errors = self.schema.dump(source.get_commands(*args, **kwargs))
+        return result
+
+    def get_page(self, **query):
+        """Like :meth:`get_commands()`, but return a tuple containing
+        the list of commands and an entity tag identifying its content.
+        Pages are served from the listing cache, if it is enabled.
+        """
+        cache = self.get_cache()
+        if cache is None:
+            commands = self.get_commands(**query)
+            return commands, self.get_etag(commands)
+
+        key = cache.get_key(query)
+        page = cache.get(key)
+        if page is not None:
+            return page.commands, page.etag
+
+        version = cache.version
+        commands = self.get_commands(**query)
+        etag = self.get_etag(commands)
+        cache.put(key, version, commands, etag,
+            query.get('cursor'), query.get('limit'))
+        return commands, etag
+
+    def get_cache(self):
+        # The cache is attached to the store on first use, because the
+        # store may not be available while the gateway is created.
+        if self.cache is None or self.cache_attached:
+            return self.cache
+        with self.cache_lock:
+            if not self.cache_attached:
+                self.store.notifier.watch(self.cache.invalidate)
+                self.cache_attached = True
+        return self.cache
+
+    def get_etag(self, commands):
+        """Return an entity tag for a list of commands. Only the status
+        of a command changes after it is persisted.
+        """
+        return hashlib.sha1(repr([(x['command_id'], x['status'])
+            for x in commands]).encode('utf-8')).hexdigest()
+
+    def iter_commands(self, *args, archived=False, **kwargs):
+        """Like :meth:`get_commands()`, but return an iterator that
+        yields the commands one by one as they are read from the
+        command store.
+        """
+        source = self.archive if archived else self.store
+        for command in source.iter_commands(*args, **kwargs):
+            result, errors = self.item_schema.dump(command)
+            yield result
+
+    def get_command(self, command_id, wait=0):
+        """Return a dictionary describing the command identified by
+        `command_id`, including the result returned by its handler, or
+        ``None`` if there is no such command.
+
+        Args:
+            command_id: the identifier of the command.
+            wait: if the command has not finished, the maximum number
+                of seconds to wait for it to finish. Status changes
+                made by this process are noticed immediately; the
+                command is read again every :attr:`poll_interval`
+                seconds to notice those made by other processes.
         """
-        result, errors = self.schema.dump(self.store.get_commands(*args, **kwargs))
+        event = threading.Event()
+        notifier = self.store.notifier
+        notifier.subscribe(command_id, event.set)
+        try:
+            deadline = time.monotonic() + wait
+            while True:
+                event.clear()
+                command = self.describe_command(command_id)
+                remaining = deadline - time.monotonic()
+                if command is None or remaining <= 0\
+                or command['status'] not in self.store.ACTIVE_STATES:
+                    return command
+                event.wait(min(remaining, self.poll_interval))
+
+                # Release the session so that the next read sees the
+                # changes committed in the meantime.
+                self.store.release()
+        finally:
+            notifier.unsubscribe(command_id, event.set)
+
+    def describe_command(self, command_id):
+        """Like :meth:`get_command()`, but return immediately."""
+        command = self.store.get_command(command_id)\
+            or self.archive.get_command(command_id)
+        if command is None:
+            return None
+        result, errors = self.item_schema.dump(command)
+        result.update(json.loads(command.result) if command.result
+            else {'ident': None, 'result': None})
         return result
 
+    def get_metrics(self):
+        """Return a dictionary containing the gauges describing the
+        state of the command runner.
+        """
+        return self.runner.get_metrics()
+
+    def timer(self, stage, command=None):
+        """Return a context manager that measures the duration of
+        `stage` in issuing `command`, which must have been validated.
+        The type of commands that are not validated is reported as
+        ``unknown``, because it is supplied by the client.
+        """
+        return self.metrics.timer('gateway_stage_duration_seconds', stage=stage,
+            command_type=command.command if command is not None else 'unknown')
+
     def is_readonly_mode(self):
         """Return a boolean indicating if the system is in readonly mode."""
         return False
@@ -49,29 +187,211 @@ class Gateway(ICommandProcessor):
             raise self.ReadOnlyMode(reason=self.readonly_message)
 
         command = self.validate(command)
+        self.admit(command)
+        if command.idempotency_key is not None:
+            return self.issue_idempotent(command)
+        return self._issue(command)
+
+    def issue_idempotent(self, command):
+        """Issue a validated command carrying an idempotency key. The
+        command is executed at most once; retries receive the response
+        of the first execution.
+
+        Returns:
+            gateway.dto.CommandResponseDTO
+        """
+        fingerprint = self.get_fingerprint(command)
+        issued, response = self.idempotency.run(
+            (command.issuer, command.idempotency_key),
+            lambda: (fingerprint, self._issue(command)),
+            lambda: self.replay(command))
+        self.check_fingerprint(issued, fingerprint)
+        return response
 
+    def _issue(self, command):
         # If the command is valid, it should be persisted in the command store.
-        with self.store.persist(command) as tx:
-            assert command.id is not None
-            try:
-                result = self.runner.execute(command)
-            except self.CommandFailed:
-                self.logger.exception(
-                    "Caught fatal exception during handling of command (id: {0})."\
-                        .format(tx.ident)
-                )
+        try:
+            with self.timer('persist', command):
+                tx = self.store.persist(command)
+        except self.DuplicateEntity:
+            # Another process persisted a command with the same
+            # idempotency key in the meantime.
+            replayed = self.replay(command)\
+                if command.idempotency_key is not None else None
+            if replayed is None:
                 raise
+            return replayed[1]
+        return self.execute(tx)
+
+    def replay(self, command):
+        """Return a tuple containing the fingerprint of the command that
+        was issued by the issuer of `command` with the same idempotency
+        key, and a :class:`gateway.dto.CommandResponseDTO` holding the
+        result it returned, or ``None`` if there is no such command.
+
+        Raises:
+            CommandRejected: the key was used for a different command.
+            CommandFailed: the command failed.
+        """
+        issued = self.store.get_idempotent(command.issuer,
+            command.idempotency_key)
+        if issued is None:
+            return None
+        fingerprint = self.get_fingerprint(issued)
+        self.check_fingerprint(fingerprint, self.get_fingerprint(command))
+        if issued.status == self.store.STATE_FAILED:
+            raise self.CommandFailed(
+                reason="The command issued with this idempotency key failed.")
+        done = issued.status == self.store.STATE_DONE
+        result = json.loads(issued.result) if issued.result\
+            else {'ident': None, 'result': None}
+        return fingerprint, CommandResponseDTO(issued.command_id,
+            result['ident'], result['result'], done, False, False)
+
+    def lookup(self, command):
+        """Return the response to the command issued earlier with the
+        idempotency key of `command`, from the cache or the command
+        store, or ``None``. Unlike :meth:`issue()`, does not wait for
+        a command with the same key that is being issued.
+        """
+        fingerprint = self.get_fingerprint(command)
+        cached = self.idempotency.lookup((command.issuer, command.idempotency_key))
+        if cached is None:
+            cached = self.replay(command)
+        if cached is None:
+            return None
+        issued, response = cached
+        self.check_fingerprint(issued, fingerprint)
+        return response
+
+    def remember(self, command, response):
+        """Cache `response` as the response to the command carrying an
+        idempotency key.
+        """
+        self.idempotency.add((command.issuer, command.idempotency_key),
+            (self.get_fingerprint(command), response))
+
+    def get_fingerprint(self, command):
+        """Return a digest of the type and the parameters of a command,
+        which is either a :class:`gateway.dto.CommandRequestDTO` or a
+        command read from the command store.
+        """
+        command_type = getattr(command, 'command_type', None) or command.command
+        params = json.loads(command.params) if isinstance(command.params, str)\
+            else command.params
+        return hashlib.sha1(json.dumps([command_type, params], sort_keys=True,
+            separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+
+    def check_fingerprint(self, issued, fingerprint):
+        """Raise :exc:`CommandRejected` if the idempotency key of a
+        command was used before for another command.
+        """
+        if issued != fingerprint:
+            raise self.CommandRejected(
+                reason="The idempotency key was used for a different command.")
+
+    def issue_batch(self, commands):
+        """Invoke the handlers for a list of commands. The valid commands
+        are persisted in a single transaction of the command store,
+        except the commands carrying an idempotency key, which are
+        issued one at a time like :meth:`issue_idempotent()`.
+
+        Args:
+            commands: a list of :class:`gateway.dto.CommandRequestDTO`
+                instances.
+
+        Returns:
+            a list holding, for each command, either a
+            :class:`gateway.dto.CommandResponseDTO` or the
+            :class:`gateway.exc.GatewayException` that was raised.
+        """
+        if self.is_readonly_mode():
+            raise self.ReadOnlyMode(reason=self.readonly_message)
+
+        results = [None] * len(commands)
+        valid = []
+        for i, command in enumerate(commands):
+            try:
+                command = self.validate(command)
+                self.admit(command)
+                valid.append((i, command))
+            except (self.CommandRejected, self.RateLimited) as e:
+                results[i] = e
+
+        batched = [(i, x) for i, x in valid if x.idempotency_key is None]
+        transactions = self.store.persist_many([x for i, x in batched])
+        for (i, command), tx in zip(batched, transactions):
+            try:
+                results[i] = self.execute(tx)
+            except GatewayException as e:
+                results[i] = e
+
+        for i, command in valid:
+            if command.idempotency_key is None:
+                continue
+            try:
+                results[i] = self.issue_idempotent(command)
+            except GatewayException as e:
+                results[i] = e
+
+        return results
+
+    def execute(self, tx):
+        """Run the command guarded by the transaction `tx`.
+
+        Args:
+            tx: the :class:`gateway.store.ICommandStore.CommandTransaction`
+                returned when persisting the command.
+
+        Returns:
+            gateway.dto.CommandResponseDTO
+        """
+        try:
+            with tx:
+                assert tx.command.id is not None
+                try:
+                    with self.timer('execute', tx.command):
+                        result = self.runner.execute(tx.command)
+                except self.CommandFailed:
+                    self.logger.exception(
+                        "Caught fatal exception during handling of command (id: {0})."\
+                            .format(tx.ident)
+                    )
+                    raise
+        except self.UpstreamFailure:
+            # The client is told to retry, so the retry must not be
+            # answered with the failure of this attempt.
+            if tx.command.idempotency_key is not None:
+                self.store.release_idempotency_key(tx.ident)
+            raise
 
         response = CommandResponseDTO(tx.ident, *result)
         if response.done:
-            self.store.set_status(response.command_id, self.store.STATE_DONE)
+            with self.timer('set_status', tx.command):
+                self.store.set_status(response.command_id, self.store.STATE_DONE,
+                    result={'ident': response.ident, 'result': response.result})
 
         return response
 
+    def admit(self, command):
+        """Raise :exc:`RateLimited` if the issuer of `command`, or its
+        type, exceeds its rate limit. Commands are admitted once they
+        are validated, so that rejected commands do not take tokens.
+        """
+        try:
+            self.admission.admit(command)
+        except self.RateLimited:
+            self.metrics.increment('gateway_rate_limited_total',
+                command_type=command.command)
+            raise
+
     def validate(self, command):
         # Validate the command parameters. If the parameters could not be
         # validated, the command is immediately rejected. Commands are
         # only persisted when their parameters are valid. Thus, the validate()
         # method of the command runner is expected to raise a CommandRejected
         # exception if there are validation errors.
-        return self.handlers.validate(command)
+        with self.timer('validate') as timer:
+            command = self.handlers.validate(command)
+            timer.tag(command_type=command.command)
+        return command
@@ -3,6 +3,8 @@ from collections import namedtuple
 from eda import dto
 
 from gateway.mixins import ICommandProcessor
+from gateway.policy import ExecutionPolicy
+from gateway.validation import compile_validator
 
 
 class ICommandHandlerMeta(type):
@@ -21,6 +23,9 @@ class ICommandHandlerMeta(type):
             raise cls.ProgrammingError(
                 "The inner Meta class must define a `command` attribute.")
         attrs['command'] = meta.command
+        attrs['partition_key'] = getattr(meta, 'partition_key', None)
+        attrs['lane'] = getattr(meta, 'lane', None)
+        attrs['policy'] = ExecutionPolicy.from_meta(meta)
 
         fields = {}
         for attname, value in list(attrs.items()):
@@ -33,9 +38,57 @@ class ICommandHandlerMeta(type):
         attrs['schema_class'] = type('CommandSchema', (dto.Adapter,), fields)
         attrs['schema'] = attrs['schema_class']()
 
+        # The fields are bound to the schema when it is instantiated,
+        # so the validator is compiled from the schema instance.
+        attrs['load_params'] = staticmethod(compile_validator(attrs['schema']))
 
         return super_new(cls, name, bases, attrs)
 
 
 class ICommandHandler(ICommandProcessor, metaclass=ICommandHandlerMeta):
-    pass
+    """Base class for command handlers. Implementations define a
+    ``run(command)`` method returning a tuple ``(ident, result, created)``;
+    ``run()`` may be a coroutine function, in which case it is awaited
+    on the event loop when the gateway is served through ASGI.
+
+    The inner ``Meta`` class may declare a ``partition_key``, the name
+    of a parameter identifying e.g. the aggregate a command operates
+    on. If the runner is sharded, commands with the same key are run
+    one at a time, in the order in which they were issued.
+
+    ``Meta`` may also declare the execution policy of the handler: a
+    ``timeout`` in seconds, the number of ``retries`` on
+    :exc:`UpstreamFailure` and the ``backoff`` between them, and the
+    ``failure_threshold`` and ``reset_timeout`` of a circuit breaker.
+    See :class:`gateway.policy.ExecutionPolicy`.
+
+    Finally, ``Meta`` may assign the handler to a ``lane``, e.g.
+    ``'high'`` or ``'bulk'``. If the runner reserves workers for the
+    lane, the asynchronous commands of the handler run on these workers
+    only, so that they neither wait for nor delay the other commands.
+    """
+
+    def validate(self, params):
+        """Validate the command parameters and return a dictionary
+        holding the deserialized parameters, as :meth:`Schema.load()`
+        would.
+
+        Raises:
+            CommandRejected: the parameters are not valid.
+        """
+        params, errors = self.load_params(params)
+        if errors:
+            raise self.CommandRejected(
+                reason="Invalid command parameters.",
+                context=errors
+            )
+        return params
+
+    def get_partition_key(self, params):
+        """Return the partition key of a command with the validated
+        parameters `params`, or ``None`` if its execution does not need
+        to be ordered.
+        """
+        if self.partition_key is None:
+            return None
+        return params.get(self.partition_key)
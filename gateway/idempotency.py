@@ -0,0 +1,99 @@
+import collections
+import threading
+import time
+
+from gateway.batch import PendingOperation
+
+
+class IdempotencyCache:
+    """Remembers the responses to recently issued commands by their
+    idempotency key, so that retried commands are not executed twice.
+    Concurrent calls with the same key wait for the first call to
+    finish and receive its response.
+
+    Args:
+        size: the maximum number of responses kept in memory; the least
+            recently used responses are evicted first.
+        ttl: the number of seconds a response is kept.
+    """
+
+    def __init__(self, size=10000, ttl=86400):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+
+    def run(self, key, func, lookup):
+        """Return the response for the idempotency key `key`.
+
+        Args:
+            key: the idempotency key.
+            func: invoked without arguments to execute the command if
+                no response is known for `key`.
+            lookup: invoked without arguments to find the response of a
+                command issued earlier, e.g. in the command store, if no
+                response is cached. Returns ``None`` if there is no
+                such command.
+
+        Returns:
+            the response returned by `lookup` or `func`.
+        """
+        with self.lock:
+            response = self.get(key)
+            if response is not None:
+                return response
+            pending = self.inflight.get(key)
+            leader = pending is None
+            if leader:
+                pending = self.inflight[key] = PendingOperation(key)
+
+        if not leader:
+            return pending.wait()
+
+        try:
+            response = lookup()
+            if response is None:
+                response = func()
+        except Exception as e:
+            with self.lock:
+                del self.inflight[key]
+            pending.fail(e)
+            raise
+
+        with self.lock:
+            del self.inflight[key]
+            self.put(key, response)
+        pending.resolve(response)
+        return response
+
+    def lookup(self, key):
+        """Return the cached response for `key`, or ``None``. Does not
+        wait for a call in progress with the same key.
+        """
+        with self.lock:
+            return self.get(key)
+
+    def add(self, key, response):
+        """Cache the response for `key`."""
+        with self.lock:
+            self.put(key, response)
+
+    def get(self, key):
+        # Must be invoked while holding the lock.
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return response
+
+    def put(self, key, response):
+        # Must be invoked while holding the lock.
+        self.entries[key] = (time.monotonic() + self.ttl, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
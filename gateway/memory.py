@@ -0,0 +1,216 @@
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from gateway.store import ICommandStore
+
+
+class MemoryCommandStore(ICommandStore):
+    """A :class:`ICommandStore` implementation keeping the most recent
+    commands in memory, in a ring buffer of fixed capacity. Persisting
+    a command overwrites the oldest one once the buffer is full.
+
+    Identifiers are allocated without locking; since they are dense,
+    the slot holding a command is derived from its identifier and no
+    separate index is needed. Only commands carrying an idempotency
+    key take a lock, to guarantee the uniqueness of the key.
+
+    The buffer may be written periodically to a snapshot file, from
+    which it is restored when the store is created.
+
+    Args:
+        capacity: the maximum number of commands kept.
+        snapshot_path: the path of the snapshot file, or ``None`` to disable
+            snapshots.
+        snapshot_interval: the number of seconds between snapshots.
+    """
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, capacity=100000, snapshot_path=None, snapshot_interval=60.0):
+        self.capacity = capacity
+        self.records = [None] * capacity
+        self.keys = {}
+        self.lock = threading.RLock()
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.high = 0
+        if snapshot_path is not None:
+            self.restore()
+        self.counter = itertools.count(self.high + 1)
+        if snapshot_path is not None:
+            threading.Thread(target=self.main_event_loop,
+                name='gateway-snapshot', daemon=True).start()
+
+    def get(self, command_id):
+        """Return the command identified by `command_id`, or ``None`` if
+        it does not exist or was overwritten.
+        """
+        record = self.records[command_id % self.capacity]
+        if record is None or record.command_id != command_id:
+            return None
+        return record
+
+    def get_commands(self, cursor=None, limit=100, **filters):
+        """Return a list containing the issued commands using the
+        criteria accepted by :meth:`gateway.test.CommandStore.get_commands()`,
+        ordered by descending identifier.
+        """
+        return list(self.iter_commands(cursor=cursor, limit=limit, **filters))
+
+    def iter_commands(self, cursor=None, limit=None, status=None,
+        command_type=None, issuer=None, since=None, until=None, chunk_size=None):
+        commands = self.scan(cursor, status, command_type, issuer, since, until)
+        return itertools.islice(commands, limit)
+
+    def scan(self, cursor, status, command_type, issuer, since, until):
+        high = self.get_high_water()
+        start = high if cursor is None else min(cursor - 1, high)
+        for command_id in range(start, max(high - self.capacity, 0), -1):
+            record = self.get(command_id)
+            if record is None\
+            or (status is not None and record.status != status)\
+            or (command_type is not None and record.command_type != command_type)\
+            or (issuer is not None and record.issuer != issuer)\
+            or (since is not None and record.timestamp < since)\
+            or (until is not None and record.timestamp >= until):
+                continue
+            yield record
+
+    def get_high_water(self):
+        """Return the highest identifier of a stored command."""
+        # Writers raise the high-water mark without a lock, so it may
+        # lag behind; follow the commands stored after it.
+        high = self.high
+        while self.get(high + 1) is not None:
+            high += 1
+        self.high = high
+        return high
+
+    def get_idempotent(self, issuer, idempotency_key):
+        record = self.keys.get((issuer, idempotency_key))
+        if record is None or self.get(record.command_id) is not record:
+            return None
+        return record
+
+    def release_idempotency_key(self, command_id):
+        record = self.get(command_id)
+        if record is None or record.idempotency_key is None:
+            return
+        with self.lock:
+            key = (record.issuer, record.idempotency_key)
+            if self.keys.get(key) is record:
+                del self.keys[key]
+            record.idempotency_key = None
+
+    def get_command(self, command_id):
+        return self.get(command_id)
+
+    def _set_status(self, command_id, status, result):
+        record = self.get(command_id)
+        if record is None:
+            return
+        if result is not None:
+            record.result = self.dump_result(result)
+        record.status = status
+
+    def _persist(self, command):
+        record = CommandRecord(
+            command_id=None,
+            command_type=command.command,
+            timestamp=int(time.time() * 1000),
+            issuer=command.issuer,
+            authenticated_by=command.authenticated_by,
+            host=command.host,
+            params=command.params,
+            status=self.STATE_PENDING,
+            idempotency_key=command.idempotency_key
+        )
+        if record.idempotency_key is None:
+            return self.store(record)
+
+        with self.lock:
+            if self.get_idempotent(record.issuer, record.idempotency_key) is not None:
+                raise self.DuplicateEntity(
+                    reason="A command with this idempotency key was already issued.")
+            ident = self.store(record)
+            self.keys[(record.issuer, record.idempotency_key)] = record
+        return ident
+
+    def store(self, record):
+        record.command_id = next(self.counter)
+        slot = record.command_id % self.capacity
+        evicted = self.records[slot]
+        self.records[slot] = record
+        if record.command_id > self.high:
+            self.high = record.command_id
+        if evicted is not None and evicted.idempotency_key is not None:
+            key = (evicted.issuer, evicted.idempotency_key)
+            with self.lock:
+                if self.keys.get(key) is evicted:
+                    del self.keys[key]
+        return record.command_id
+
+    def snapshot(self):
+        """Write the stored commands to the snapshot file. The file is
+        replaced atomically.
+        """
+        records = [x for x in list(self.records) if x is not None]
+        records.sort(key=lambda x: x.command_id)
+        dirname = os.path.dirname(os.path.abspath(self.snapshot_path))
+        fd, path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for record in records:
+                    f.write(json.dumps(record.as_dict(), separators=(',', ':')))
+                    f.write('\n')
+            os.replace(path, self.snapshot_path)
+        except Exception:
+            os.unlink(path)
+            raise
+
+    def restore(self):
+        """Load the commands from the snapshot file, if it exists."""
+        if not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path) as f:
+            for line in f:
+                record = CommandRecord(**json.loads(line))
+                self.records[record.command_id % self.capacity] = record
+                self.high = max(self.high, record.command_id)
+                if record.idempotency_key is not None:
+                    self.keys[(record.issuer, record.idempotency_key)] = record
+
+    def main_event_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            try:
+                self.snapshot()
+            except Exception:
+                self.logger.exception("Could not write the command store snapshot.")
+
+
+class CommandRecord:
+    __slots__ = ['command_id', 'command_type', 'timestamp', 'issuer',
+        'authenticated_by', 'host', 'params', 'status', 'idempotency_key',
+        'result']
+
+    def __init__(self, command_id, command_type, timestamp, issuer,
+        authenticated_by, host, params, status, idempotency_key=None,
+        result=None):
+        self.command_id = command_id
+        self.command_type = command_type
+        self.timestamp = timestamp
+        self.issuer = issuer
+        self.authenticated_by = authenticated_by
+        self.host = host
+        self.params = params
+        self.status = status
+        self.idempotency_key = idempotency_key
+        self.result = result
+
+    def as_dict(self):
+        return {x: getattr(self, x) for x in self.__slots__}
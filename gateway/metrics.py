@@ -0,0 +1,178 @@
+import bisect
+import threading
+import time
+
+
+class MetricsRegistry:
+    """Collects latency histograms and counters in memory and renders
+    them in the Prometheus text exposition format.
+
+    Args:
+        buckets: the upper bounds, in seconds, of the histogram buckets.
+    """
+    enabled = True
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def timer(self, name, **labels):
+        """Return a context manager that observes the time spent in its
+        block in the histogram `name`. The ``outcome`` label is set to
+        ``ok``, or to the name of the exception raised in the block,
+        unless it is given or set with :meth:`Timer.tag()`.
+        """
+        return Timer(self, name, labels)
+
+    def observe(self, name, value, **labels):
+        """Add `value` to the histogram `name`."""
+        key = (name, self.get_label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def increment(self, name, value=1, **labels):
+        """Add `value` to the counter `name`."""
+        key = (name, self.get_label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self, gauges=None):
+        """Render all metrics, and the `gauges` dictionary mapping metric
+        names to values, in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            histograms = sorted(((k, v.copy()) for k, v in self.histograms.items()),
+                key=lambda x: x[0])
+            counters = sorted(self.counters.items())
+
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append("# TYPE {0} counter".format(name))
+                declared.add(name)
+            lines.append(self.format_sample(name, labels, value))
+
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                lines.append("# TYPE {0} histogram".format(name))
+                declared.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(self.format_sample(name + '_bucket',
+                    labels + (('le', repr(bound)),), cumulative))
+            lines.append(self.format_sample(name + '_bucket',
+                labels + (('le', '+Inf'),), histogram.count))
+            lines.append(self.format_sample(name + '_sum', labels, histogram.sum))
+            lines.append(self.format_sample(name + '_count', labels, histogram.count))
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append("# TYPE {0} gauge".format(name))
+            lines.append(self.format_sample(name, (), value))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def get_label_key(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def format_sample(name, labels, value):
+        if not labels:
+            return "{0} {1}".format(name, value)
+        return "{0}{{{1}}} {2}".format(name, ','.join(
+            '{0}="{1}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels), value)
+
+
+class NullMetricsRegistry(MetricsRegistry):
+    """A :class:`MetricsRegistry` that discards all measurements.
+    Provide it as ``GatewayMetrics`` to disable the instrumentation.
+    """
+    enabled = False
+
+    def timer(self, name, **labels):
+        return NULL_TIMER
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def render(self, gauges=None):
+        return ''
+
+
+class Histogram:
+    __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+class Timer:
+    __slots__ = ['registry', 'name', 'labels', 'started']
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.started = None
+
+    def tag(self, **labels):
+        """Set labels that are only known at the end of the block."""
+        self.labels.update(labels)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        elapsed = time.perf_counter() - self.started
+        if 'outcome' not in self.labels:
+            self.labels['outcome'] = 'ok' if exc_type is None\
+                else exc_type.__name__
+        self.registry.observe(self.name, elapsed, **self.labels)
+
+
+class NullTimer:
+    __slots__ = []
+
+    def tag(self, **labels):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        pass
+
+
+NULL_TIMER = NullTimer()
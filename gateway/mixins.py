@@ -8,3 +8,4 @@ class ICommandProcessor:
     UpstreamFailure = type('UpstreamFailure', (GatewayException,), {})
     NotAuthorized = type('NotAuthorized', (GatewayException,), {})
     CommandFailed = type('CommandFailed', (GatewayException,), {})
+    RateLimited = type('RateLimited', (GatewayException,), {})
@@ -0,0 +1,48 @@
+import threading
+
+
+class StatusNotifier:
+    """Invokes the callbacks subscribed to a command when its status
+    changes in this process, and the watchers when any command is
+    persisted or changes status.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners = {}
+        self.watchers = []
+
+    def watch(self, callback):
+        """Invoke `callback` with the identifier of each command that
+        is persisted or changes status.
+        """
+        with self.lock:
+            self.watchers.append(callback)
+
+    def subscribe(self, command_id, callback):
+        with self.lock:
+            self.listeners.setdefault(command_id, []).append(callback)
+
+    def unsubscribe(self, command_id, callback):
+        with self.lock:
+            callbacks = self.listeners.get(command_id)
+            if callbacks is None:
+                return
+            callbacks.remove(callback)
+            if not callbacks:
+                del self.listeners[command_id]
+
+    def notify(self, command_id):
+        """Invoke the watchers and the callbacks subscribed to
+        `command_id`.
+        """
+        for watcher in self.watchers:
+            watcher(command_id)
+
+        # Most commands have no listeners; skip the lock for them.
+        if command_id not in self.listeners:
+            return
+        with self.lock:
+            callbacks = list(self.listeners.get(command_id, ()))
+        for callback in callbacks:
+            callback()
@@ -0,0 +1,168 @@
+import asyncio
+import inspect
+import threading
+import time
+
+from gateway.mixins import ICommandProcessor
+
+
+class ExecutionPolicy(ICommandProcessor):
+    """Describes how the handler of a command type is invoked. The
+    policy is created from the inner ``Meta`` class of the handler.
+
+    Args:
+        timeout: the maximum number of seconds a single invocation may
+            take before it fails with :exc:`UpstreamFailure`, or
+            ``None`` for no limit.
+        retries: the number of times an invocation failing with
+            :exc:`UpstreamFailure` is retried.
+        backoff: the number of seconds to wait before the first retry;
+            the delay doubles with each retry.
+        max_backoff: the maximum number of seconds between retries.
+        failure_threshold: the number of consecutive failed invocations
+            after which the circuit breaker opens and invocations fail
+            immediately, or ``None`` to disable the circuit breaker.
+        reset_timeout: the number of seconds after which an open circuit
+            breaker lets a trial invocation through.
+    """
+
+    def __init__(self, timeout=None, retries=0, backoff=0.1, max_backoff=5.0,
+        failure_threshold=None, reset_timeout=30.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)\
+            if failure_threshold else None
+
+    @classmethod
+    def from_meta(cls, meta):
+        """Create a policy from the attributes of a handler's ``Meta``
+        class.
+        """
+        return cls(
+            timeout=getattr(meta, 'timeout', None),
+            retries=getattr(meta, 'retries', 0),
+            backoff=getattr(meta, 'backoff', 0.1),
+            max_backoff=getattr(meta, 'max_backoff', 5.0),
+            failure_threshold=getattr(meta, 'failure_threshold', None),
+            reset_timeout=getattr(meta, 'reset_timeout', 30.0)
+        )
+
+    def get_delay(self, attempt):
+        return min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+
+    def run(self, func, on_retry=None):
+        """Invoke `func` without arguments, retrying it as configured.
+        `on_retry` is invoked with the attempt number before each retry.
+
+        Raises:
+            UpstreamFailure: the circuit breaker is open, or the last
+                attempt failed with :exc:`UpstreamFailure`.
+        """
+        attempt = 0
+        while True:
+            self.before()
+            try:
+                result = func()
+            except Exception as e:
+                attempt = self.after_failure(e, attempt)
+                if on_retry is not None:
+                    on_retry(attempt)
+                time.sleep(self.get_delay(attempt))
+                continue
+            self.after_success()
+            return result
+
+    async def run_async(self, func, on_retry=None):
+        """Like :meth:`run()`, but `func` returns an awaitable, as may
+        `on_retry`.
+        """
+        attempt = 0
+        while True:
+            self.before()
+            try:
+                result = await func()
+            except Exception as e:
+                attempt = self.after_failure(e, attempt)
+                if on_retry is not None:
+                    retry = on_retry(attempt)
+                    if inspect.isawaitable(retry):
+                        await retry
+                await asyncio.sleep(self.get_delay(attempt))
+                continue
+            self.after_success()
+            return result
+
+    def before(self):
+        if self.breaker is not None:
+            self.breaker.check()
+
+    def after_success(self):
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    def after_failure(self, exception, attempt):
+        # Return the number of the next attempt, or re-raise the
+        # exception if the invocation must not be retried.
+        upstream = isinstance(exception, self.UpstreamFailure)
+        if self.breaker is not None:
+            # Only failures of the upstream system, including timeouts,
+            # count; other exceptions, e.g. rejected commands, mean that
+            # it responded.
+            if upstream:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        if not upstream or attempt >= self.retries:
+            raise exception
+        return attempt + 1
+
+
+class CircuitBreaker(ICommandProcessor):
+    """Fails invocations immediately after `threshold` consecutive
+    failures. After `reset_timeout` seconds, a single trial invocation
+    is let through; the breaker closes if it succeeds and opens again
+    if it fails. A trial that has not finished after another
+    `reset_timeout` seconds is deemed failed, and the next invocation
+    is let through as a new trial.
+    """
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.STATE_CLOSED
+        self.failures = 0
+        self.opened = None
+
+    def check(self):
+        """Raise :exc:`UpstreamFailure` if invocations are not allowed."""
+        with self.lock:
+            if self.state == self.STATE_CLOSED:
+                return
+            now = time.monotonic()
+            if now - self.opened >= self.reset_timeout:
+                # The time of the trial is recorded, so that a trial
+                # that hangs does not keep the breaker half-open.
+                self.state = self.STATE_HALF_OPEN
+                self.opened = now
+                return
+        raise self.UpstreamFailure(
+            reason="The command is temporarily unavailable. Retry later.")
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.STATE_CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.STATE_HALF_OPEN\
+            or self.failures >= self.threshold:
+                self.state = self.STATE_OPEN
+                self.opened = time.monotonic()
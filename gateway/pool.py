@@ -0,0 +1,232 @@
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import math
+import queue
+import threading
+import zlib
+
+
+class WorkerPool:
+    """A fixed number of worker threads consuming a bounded queue of
+    tasks. The threads are started when the first task is submitted.
+
+    Args:
+        workers: the number of worker threads.
+        queue_size: the maximum number of tasks waiting for a worker;
+            ``0`` means unbounded.
+        name: a string used as the prefix of the worker thread names.
+        weights: if not ``None``, tasks are taken from the queue by
+            weighted fair queuing across the flows they are submitted
+            with, instead of in submission order. A dictionary mapping
+            flows to their weight; other flows have a weight of ``1``.
+    """
+    QueueFull = queue.Full
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, workers=8, queue_size=1024, name='gateway-worker',
+        weights=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.name = name
+        self.queue = queue.Queue(queue_size) if weights is None\
+            else FairQueue(queue_size, weights)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.busy = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def submit(self, func, *args, block=False, timeout=None, flow=None):
+        """Schedule `func` to be invoked with the positional arguments
+        `args` by one of the worker threads.
+
+        Args:
+            func: the callable to invoke.
+            block: wait for a free slot if the queue is full.
+            timeout: the maximum number of seconds to wait for a
+                free slot if `block` is ``True``.
+            flow: identifies the flow the task belongs to, if the
+                pool uses weighted fair queuing.
+
+        Returns:
+            concurrent.futures.Future
+
+        Raises:
+            WorkerPool.QueueFull: the queue did not accept the task.
+        """
+        self.start()
+        future = concurrent.futures.Future()
+        try:
+            self.queue.put((future, func, args, flow), block, timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise
+        with self.lock:
+            self.submitted += 1
+        return future
+
+    def start(self):
+        """Start the worker threads if they are not running yet."""
+        if self.threads:
+            return
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work,
+                    name="{0}-{1}".format(self.name, i), daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads after the queued tasks are
+        processed.
+        """
+        threads, self.threads = self.threads, []
+        for t in threads:
+            self.queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+    def metrics(self):
+        """Return a dictionary describing the state of the queue
+        and the worker threads.
+        """
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'workers_busy': self.busy,
+                'queue_depth': self.queue.qsize(),
+                'queue_capacity': self.queue_size,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected
+            }
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            future, func, args, flow = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.busy += 1
+            try:
+                result = func(*args)
+            except BaseException as e:
+                with self.lock:
+                    self.busy -= 1
+                    self.failed += 1
+                future.set_exception(e)
+            else:
+                with self.lock:
+                    self.busy -= 1
+                    self.completed += 1
+                future.set_result(result)
+
+
+class FairQueueMixin:
+    """Implements the storage of :class:`queue.Queue` and
+    :class:`asyncio.Queue` by self-clocked weighted fair queuing across
+    the flows identified by the last item of the tasks. Each flow
+    receives a share of the dequeued tasks proportional to its weight
+    while it has tasks waiting, so that a flow submitting a burst of
+    tasks does not delay the tasks of the other flows. The tasks of a
+    flow are taken in the order in which they were put.
+
+    Args:
+        maxsize: the maximum number of tasks; ``0`` means unbounded.
+        weights: a dictionary mapping flows, or their string
+            representation, to their weight.
+    """
+
+    def __init__(self, maxsize=0, weights=None):
+        self.weights = {str(k): float(v) for k, v in (weights or {}).items()}
+        super(FairQueueMixin, self).__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.heap = []
+        self.finish = {}
+        self.virtual = 0.0
+        self.sequence = itertools.count()
+
+    def _qsize(self):
+        return len(self.heap)
+
+    def _put(self, task):
+        if task is None:
+            # Stop the workers after the queued tasks.
+            heapq.heappush(self.heap, (math.inf, next(self.sequence), None, task))
+            return
+        flow = task[-1]
+        start = max(self.virtual, self.finish.get(flow, 0.0))
+        finish = self.finish[flow] = start + 1.0 / self.weights.get(str(flow), 1.0)
+        heapq.heappush(self.heap, (finish, next(self.sequence), flow, task))
+
+    def _get(self):
+        finish, sequence, flow, task = heapq.heappop(self.heap)
+        if task is not None:
+            self.virtual = finish
+            if self.finish.get(flow) == finish:
+                # The flow has no more tasks waiting.
+                del self.finish[flow]
+        return task
+
+
+class FairQueue(FairQueueMixin, queue.Queue):
+    """A :class:`queue.Queue` of tasks taken by weighted fair queuing;
+    see :class:`FairQueueMixin`.
+    """
+
+
+class ShardedPool:
+    """Runs tasks on `shards` single-threaded :class:`WorkerPool`
+    instances. Tasks submitted with the same key are always run by the
+    same shard, in the order in which they were submitted; tasks with
+    different keys may run in parallel.
+
+    Args:
+        shards: the number of shards.
+        queue_size: the maximum number of tasks waiting per shard;
+            ``0`` means unbounded.
+        name: a string used as the prefix of the worker thread names.
+    """
+    QueueFull = queue.Full
+
+    def __init__(self, shards=8, queue_size=1024, name='gateway-shard'):
+        self.pools = [
+            WorkerPool(1, queue_size, name="{0}-{1}".format(name, i))
+            for i in range(shards)
+        ]
+
+    def submit(self, key, func, *args, block=False, timeout=None):
+        """Schedule `func` on the shard owning `key`. See
+        :meth:`WorkerPool.submit()`.
+        """
+        return self.get_pool(key).submit(func, *args, block=block, timeout=timeout)
+
+    def get_pool(self, key):
+        # The hash of strings is randomized per process, so a stable
+        # checksum is used instead.
+        return self.pools[zlib.crc32(str(key).encode('utf-8')) % len(self.pools)]
+
+    def shutdown(self, wait=True):
+        for pool in self.pools:
+            pool.shutdown(wait=wait)
+
+    def metrics(self):
+        """Return the sum of the metrics of the shards."""
+        metrics = {}
+        for pool in self.pools:
+            for name, value in pool.metrics().items():
+                metrics[name] = metrics.get(name, 0) + value
+        return metrics
@@ -0,0 +1,157 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+
+class Supervisor:
+    """Binds the listening socket and forks `workers` processes that
+    accept connections on it. Workers that exit are replaced. On
+    ``SIGTERM`` or ``SIGINT`` the workers are asked to stop accepting
+    connections and finish the requests in progress; workers still
+    running after `graceful_timeout` seconds are killed.
+
+    Args:
+        serve: invoked in each worker process with the listening socket.
+            Must return once the worker receives ``SIGTERM`` and has
+            finished the requests in progress.
+        host: the address to listen on.
+        port: the port to listen on.
+        workers: the number of worker processes.
+        backlog: the size of the queue of pending connections.
+        graceful_timeout: the number of seconds the workers are given
+            to finish the requests in progress when stopping.
+        restart_delay: the minimum number of seconds between two
+            restarts of a worker, preventing a crashing worker from
+            being restarted in a tight loop.
+    """
+    logger = logging.getLogger('gateway.supervisor')
+    poll_interval = 0.5
+
+    def __init__(self, serve, host, port, workers, backlog=128,
+        graceful_timeout=30.0, restart_delay=1.0):
+        self.serve = serve
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.restart_delay = restart_delay
+        self.socket = None
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        """Start the workers and supervise them until a termination
+        signal is received.
+        """
+        self.socket = self.bind()
+        signal.signal(signal.SIGTERM, self.on_signal)
+        signal.signal(signal.SIGINT, self.on_signal)
+        self.logger.info("Listening on {0}:{1} with {2} workers."\
+            .format(self.host, self.port, self.workers))
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        restarts = {}
+        while not self.stopping:
+            for slot, status in self.reap():
+                self.logger.warning("Worker {0} exited with status {1}, restarting."\
+                    .format(slot, status))
+                restarts[slot] = time.monotonic() + self.restart_delay
+            for slot, deadline in list(restarts.items()):
+                if deadline <= time.monotonic() and not self.stopping:
+                    del restarts[slot]
+                    self.spawn(slot)
+            time.sleep(self.poll_interval)
+
+        self.stop()
+
+    def bind(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = slot
+            return
+
+        # In the worker process.
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.serve(self.socket)
+        except BaseException:
+            self.logger.exception("Worker {0} failed.".format(slot))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def reap(self):
+        """Return a list of ``(slot, status)`` tuples for the workers
+        that have exited.
+        """
+        exited = []
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            slot = self.children.pop(pid, None)
+            if slot is not None:
+                exited.append((slot, status))
+        return exited
+
+    def on_signal(self, signum, frame):
+        self.stopping = True
+
+    def stop(self):
+        self.logger.info("Stopping {0} workers.".format(len(self.children)))
+        self.socket.close()
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+
+        for pid in list(self.children):
+            self.logger.warning("Killing worker {0}.".format(self.children[pid]))
+            self.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.clear()
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def serve_forever(server):
+    """Run the :class:`socketserver.BaseServer` `server` until the
+    process receives ``SIGTERM``, then wait for the requests in
+    progress to finish.
+    """
+    def on_signal(signum, frame):
+        # shutdown() blocks until serve_forever() returns, so it
+        # must not be invoked from the thread running it.
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    # Join the request threads in server_close().
+    server.daemon_threads = False
+    server.block_on_close = True
+    signal.signal(signal.SIGTERM, on_signal)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
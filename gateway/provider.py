@@ -1,22 +1,51 @@
 import importlib
 import inspect
+import json
 import logging
+import threading
+import time
 
 from gateway.mixins import ICommandProcessor
 from gateway.handler import ICommandHandler
 
 
-import logging
-import sys
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+class CommandHandlersProvider(ICommandProcessor):
+    """Provides the handlers for each command type.
 
+    If a manifest is given, the handlers are imported and instantiated
+    on first use instead of when the provider is created. The manifest
+    is a JSON object mapping command types to handler classes, in the
+    form ``module:ClassName``; it can be created with
+    ``python3 -m gateway.provider MODULE [MODULE ...]``. Without a
+    manifest, the handlers in ``gateway.test`` are registered eagerly.
 
-class CommandHandlersProvider(ICommandProcessor):
+    Args:
+        manifest: the path to the handlers manifest.
+        warmup: load all handlers listed in the manifest in a
+            background thread.
+    """
     logger = logging.getLogger('gateway.environment')
 
-    def __init__(self):
+    def __init__(self, manifest=None, warmup=False):
         self.__handlers = {}
-        self.register_module('gateway.test')
+        self.manifest = {}
+        self.lock = threading.Lock()
+        self.timings = {}
+        if manifest is None:
+            self.register_module('gateway.test')
+            return
+
+        self.manifest = self.load_manifest(manifest)
+        if warmup:
+            threading.Thread(target=self.warmup,
+                name='gateway-warmup', daemon=True).start()
+
+    def load_manifest(self, path):
+        with open(path) as f:
+            manifest = json.load(f)
+        self.logger.info("Loaded {0} command types from {1}."\
+            .format(len(manifest), path))
+        return manifest
 
     def register_module(self, module_path):
         """Registers all command handlers in a module identified by `module_path`,
@@ -26,11 +55,7 @@ class CommandHandlersProvider(ICommandProcessor):
         handlers = {}
         try:
             module = importlib.import_module(module_path)
-            for attname, value in module.__dict__.items():
-                if not inspect.isclass(value)\
-                or not issubclass(value, ICommandHandler):
-                    continue
-
+            for value in get_handler_classes(module):
                 command_type = value.command_type
                 if command_type in self.__handlers:
                     raise self.HandlerAlreadyRegistered
@@ -51,17 +76,24 @@ class CommandHandlersProvider(ICommandProcessor):
 
         return success
 
+    def warmup(self):
+        """Load all handlers listed in the manifest."""
+        started = time.monotonic()
+        for command_type in list(self.manifest):
+            try:
+                self.get(command_type)
+            except self.UpstreamFailure:
+                pass
+        self.logger.info("Loaded {0} handlers in {1:.1f}ms."\
+            .format(len(self.__handlers), (time.monotonic() - started) * 1000))
+
     def validate(self, command):
         """Validates the command parameters. Raises
         :class:`gateway.exc.CommandRejected`  if the parameters are
         not valid.
         """
         handler = self.get(command.command)
-        params = handler.validate(command.params)
-        for key in list(command.params.keys()):
-            value = command.params.pop(key)
-            if key in params:
-                command.params[key] = params[key]
+        command.params = handler.validate(command.params)
         return command
 
     def get(self, command_type):
@@ -69,4 +101,57 @@ class CommandHandlersProvider(ICommandProcessor):
         try:
             return self.__handlers[command_type]
         except KeyError:
-            raise self.CommandRejected(reason="Unknown command: " + command_type)
+            if command_type not in self.manifest:
+                raise self.CommandRejected(reason="Unknown command: " + command_type)
+        return self.load(command_type)
+
+    def load(self, command_type):
+        """Import and instantiate the handler for `command_type` as
+        listed in the manifest.
+        """
+        with self.lock:
+            if command_type in self.__handlers:
+                return self.__handlers[command_type]
+
+            started = time.monotonic()
+            module_path, _, class_name = self.manifest[command_type].partition(':')
+            try:
+                handler = getattr(importlib.import_module(module_path), class_name)()
+            except Exception:
+                self.logger.exception(
+                    "Caught exception while loading the handler for " + command_type)
+                raise self.UpstreamFailure(
+                    reason="The handler for this command could not be loaded.")
+
+            self.timings[command_type] = time.monotonic() - started
+            self.__handlers[command_type] = handler
+            self.logger.info("Loaded handler for {0} in {1:.1f}ms."\
+                .format(command_type, self.timings[command_type] * 1000))
+            return handler
+
+
+def get_handler_classes(module):
+    """Return the :class:`gateway.handler.ICommandHandler` implementations
+    defined or imported in `module`.
+    """
+    return [x for x in module.__dict__.values()
+        if inspect.isclass(x) and issubclass(x, ICommandHandler)
+        and x is not ICommandHandler]
+
+
+def create_manifest(module_paths):
+    """Return a manifest listing the handlers in the given modules."""
+    manifest = {}
+    for module_path in module_paths:
+        for cls in get_handler_classes(importlib.import_module(module_path)):
+            manifest[cls.command] = '{0}:{1}'.format(cls.__module__, cls.__name__)
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        "Writes the manifest of the command handlers in the given modules.")
+    parser.add_argument('modules', nargs='+')
+    args = parser.parse_args()
+    print(json.dumps(create_manifest(args.modules), indent=2, sort_keys=True))
@@ -0,0 +1,110 @@
+import json
+import logging
+import threading
+
+import ioc
+
+from gateway.dto import CommandRequestDTO
+from gateway.mixins import ICommandProcessor
+
+
+class CommandRecovery(ICommandProcessor):
+    """Runs the asynchronous commands that were left unfinished by a
+    gateway that stopped, and renews the leases of the commands that
+    are run by this gateway, so that other gateways do not recover them.
+
+    The unfinished commands are scanned in batches of `batch_size` at
+    startup and every `interval` seconds. Each batch is leased before
+    the commands are dispatched to the runner, so that a command is
+    recovered by one gateway only.
+
+    The leases are renewed even if the recovery is disabled, because
+    the gateways sharing the command store may have it enabled.
+
+    Args:
+        enabled: recover the commands left unfinished by other gateways;
+            if ``False``, the leases of this gateway are renewed only.
+        batch_size: the number of commands scanned and leased at once.
+        interval: the number of seconds between two scans; must be
+            lower than the lease duration of the command store.
+    """
+    handlers = ioc.instance('CommandHandlersProvider')
+    runner = ioc.instance('CommandRunner')
+    store = ioc.instance('CommandStore')
+    logger = logging.getLogger('gateway.recovery')
+
+    def __init__(self, enabled=True, batch_size=500, interval=15.0):
+        self.enabled = bool(enabled)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Start the recovery thread if it is not running yet."""
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.main_event_loop,
+                name='gateway-recovery', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def main_event_loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.store.renew_leases()
+                recovered = self.recover() if self.enabled else 0
+                if recovered:
+                    self.logger.info("Recovered {0} commands.".format(recovered))
+            except Exception:
+                self.logger.exception("Caught exception while recovering commands.")
+            finally:
+                self.store.release()
+            self.stopped.wait(self.interval)
+
+    def recover(self):
+        """Lease and dispatch the unfinished commands that are not
+        leased by a running gateway, and return their number.
+        """
+        recovered = 0
+        after = 0
+        while True:
+            batch = self.store.get_recoverable(after, self.batch_size)
+            if not batch:
+                break
+            after = batch[-1].command_id
+            leased = self.store.claim_leases([x.command_id for x in batch])
+            for i, dao in enumerate(leased):
+                try:
+                    self.dispatch(dao)
+                except self.UpstreamFailure:
+                    # The queue is full; leave the remaining commands
+                    # to the next scan, or to another gateway.
+                    self.store.release_leases([x.command_id for x in leased[i:]])
+                    return recovered
+                recovered += 1
+            if len(batch) < self.batch_size:
+                break
+        return recovered
+
+    def dispatch(self, dao):
+        """Rebuild the command from its stored representation and run it
+        asynchronously.
+        """
+        command = CommandRequestDTO(dao.command_id, dao.command_type, True,
+            json.loads(dao.params), dao.issuer, dao.authenticated_by, dao.host,
+            dao.idempotency_key)
+        try:
+            command = self.handlers.validate(command)
+        except (self.CommandRejected, self.UpstreamFailure):
+            self.logger.exception(
+                "Unable to recover command (id: {0}).".format(dao.command_id))
+            self.store.set_status(dao.command_id, self.store.STATE_FAILED)
+            return
+        self.runner.run_asynchronous(command)
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+
+import ioc
+
+from gateway.mixins import ICommandProcessor
+
+
+class CommandRetention(ICommandProcessor):
+    """Moves the finished commands issued more than `max_age` seconds
+    ago from the command store to the ``CommandArchive``, so that the
+    store holds the recent commands only. The age of a command is
+    counted from its timestamp, which is the time it was issued, not
+    the time it finished.
+
+    The idempotency keys of archived commands are no longer known to
+    the command store: a command issued again with the key of an
+    archived command is executed again. `max_age` must therefore
+    exceed the period during which clients retry their commands.
+
+    The commands are moved in batches of `batch_size`: each batch is
+    written to the archive before it is deleted from the store, in a
+    transaction of its own, so that the writes of the gateway wait
+    for one small batch at most. A pass runs every `interval` seconds
+    and pauses `pause` seconds between batches. A single process
+    archives at a time; the others skip their pass.
+
+    After a pass, the space freed in the command store is reclaimed
+    `vacuum_pages` pages at a time, pausing `pause` seconds between
+    two chunks, for the same reason.
+
+    Args:
+        enabled: run the retention; if ``False``, :meth:`start()` does
+            nothing.
+        max_age: the number of seconds after it was issued that a
+            finished command is kept in the command store.
+        batch_size: the number of commands moved at once.
+        interval: the number of seconds between two passes.
+        pause: the number of seconds to wait between two batches.
+        vacuum_pages: the number of pages of the command store reclaimed
+            at once.
+    """
+    store = ioc.instance('CommandStore')
+    archive = ioc.instance('CommandArchive')
+    logger = logging.getLogger('gateway.retention')
+
+    def __init__(self, enabled=False, max_age=2592000, batch_size=500,
+        interval=300.0, pause=0.1, vacuum_pages=1000):
+        self.enabled = bool(enabled)
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Start the retention thread if it is not running yet."""
+        if not self.enabled or self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.main_event_loop,
+                name='gateway-retention', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def main_event_loop(self):
+        while not self.stopped.is_set():
+            try:
+                archived = self.run()
+                if archived:
+                    self.logger.info("Archived {0} commands.".format(archived))
+            except Exception:
+                self.logger.exception("Caught exception while archiving commands.")
+            finally:
+                self.store.release()
+            self.stopped.wait(self.interval)
+
+    def run(self):
+        """Archive the expired commands and return their number."""
+        with self.archive.exclusive() as acquired:
+            if not acquired:
+                return 0
+            archived = self.archive_expired(
+                int((time.time() - self.max_age) * 1000))
+        if archived:
+            self.compact()
+        return archived
+
+    def compact(self):
+        """Reclaim the space freed in the command store, in chunks."""
+        while not self.stopped.is_set()\
+        and self.store.compact(self.vacuum_pages) > 0:
+            self.stopped.wait(self.pause)
+
+    def archive_expired(self, before):
+        archived = 0
+        after = 0
+        while not self.stopped.is_set():
+            batch = self.store.get_expired(before, after, self.batch_size)
+            if not batch:
+                break
+            after = batch[-1].command_id
+            self.archive.append(batch)
+            command_ids = [x.command_id for x in batch]
+            self.store.delete(command_ids)
+            for command_id in command_ids:
+                self.store.notifier.notify(command_id)
+            archived += len(batch)
+            if len(batch) < self.batch_size:
+                break
+
+            # Let the thread-bound session see the deletions, and the
+            # writes of the gateway through between two batches.
+            self.store.release()
+            self.stopped.wait(self.pause)
+        return archived
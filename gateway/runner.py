@@ -5,3 +5,9 @@ class ICommandRunner(ICommandProcessor):
 
     def run(self, command):
         raise NotImplementedError
+
+    def get_metrics(self):
+        """Return a dictionary containing metrics describing the
+        state of the runner e.g. queue depth and busy workers.
+        """
+        return {}
@@ -1,6 +1,8 @@
 import json
+import threading
 
 from gateway.mixins import ICommandProcessor
+from gateway.notify import StatusNotifier
 
 
 class ICommandStore(ICommandProcessor):
@@ -10,24 +12,175 @@ class ICommandStore(ICommandProcessor):
     STATE_PENDING = 'pending'
     STATE_FAILED = 'failed'
     STATE_DONE = 'done'
+    STATE_RETRYING = 'retrying'
+
+    #: The states of commands that have not finished running.
+    ACTIVE_STATES = (STATE_PENDING, STATE_RETRYING)
+
+    #: The states of commands that have finished running.
+    FINISHED_STATES = (STATE_DONE, STATE_FAILED)
+
+    _notifier_lock = threading.Lock()
+
+    @property
+    def notifier(self):
+        """The :class:`gateway.notify.StatusNotifier` invoked when the
+        status of a command is set through this store.
+        """
+        notifier = self.__dict__.get('_notifier')
+        if notifier is None:
+            with self._notifier_lock:
+                notifier = self.__dict__.setdefault('_notifier', StatusNotifier())
+        return notifier
 
     def dump_params(self, params):
         return params
 
+    def dump_result(self, result):
+        return json.dumps(result)
+
     def persist(self, command):
         """Persists a command in the storage backend and returns
         a context guard.
         """
         ident = self._persist(command)
         command.set_command_id(ident)
+        self.notifier.notify(ident)
         return self.CommandTransaction(self, ident, command)
 
+    def persist_many(self, commands):
+        """Persists a list of commands in the storage backend and
+        returns a list of context guards, one for each command.
+        """
+        idents = self._persist_many(commands)
+        transactions = []
+        for ident, command in zip(idents, commands):
+            command.set_command_id(ident)
+            self.notifier.notify(ident)
+            transactions.append(self.CommandTransaction(self, ident, command))
+        return transactions
+
     def _persist(self, *args, **kwargs):
         raise NotImplementedError
 
-    def set_status(self, command_id, status):
+    def _persist_many(self, commands):
+        """Persist the commands and return a list containing their
+        identifiers. Implementations should override this method to
+        persist all commands in a single transaction.
+        """
+        return [self._persist(x) for x in commands]
+
+    def get_command(self, command_id):
+        """Return the command identified by `command_id`, or ``None``
+        if there is no such command. The ``result`` attribute of the
+        returned object holds the result of the command encoded by
+        :meth:`dump_result()`, or ``None``.
+        """
         raise NotImplementedError
 
+    def get_commands(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_idempotent(self, issuer, idempotency_key):
+        """Return the command that was persisted by `issuer` with the
+        given idempotency key, or ``None`` if there is no such command.
+        Idempotency keys are unique per issuer. The returned object
+        exposes the attributes of :class:`gateway.memory.CommandRecord`.
+        """
+        return None
+
+    def release_idempotency_key(self, command_id):
+        """Detach the idempotency key from the command identified by
+        `command_id`, so that a command issued again with the same key
+        is executed instead of being answered with the response of this
+        one.
+        """
+        pass
+
+    def iter_commands(self, *args, **kwargs):
+        """Return an iterator over the commands matching the criteria
+        accepted by :meth:`get_commands()`. Implementations should
+        fetch the commands in chunks instead of loading all of them.
+        """
+        return iter(self.get_commands(*args, **kwargs))
+
+    def set_status(self, command_id, status, result=None):
+        """Set the status of a command and notify the listeners
+        subscribed to it.
+
+        Args:
+            command_id: the identifier of the command.
+            status: the new status.
+            result: a dictionary holding the ``ident`` and ``result``
+                returned by the handler, or ``None``.
+        """
+        self._set_status(command_id, status, result)
+        self.notifier.notify(command_id)
+
+    def _set_status(self, command_id, status, result):
+        raise NotImplementedError
+
+    def get_recoverable(self, after=0, limit=500):
+        """Return a list holding at most `limit` unfinished asynchronous
+        commands with an identifier greater than `after`, that are not
+        leased by a running gateway, ordered by ascending identifier.
+        Stores that do not support recovery return an empty list.
+        """
+        return []
+
+    def claim_leases(self, command_ids):
+        """Lease the given commands to this store, unless they are
+        leased by another one, and return the commands that were
+        leased.
+        """
+        return []
+
+    def renew_leases(self):
+        """Extend the leases of the unfinished commands owned by this
+        store.
+        """
+        pass
+
+    def release_leases(self, command_ids):
+        """Expire the leases of the given commands, so that other
+        gateways may recover them.
+        """
+        pass
+
+    def get_expired(self, before, after=0, limit=500):
+        """Return a list holding at most `limit` finished commands
+        issued before the timestamp `before`, in milliseconds since the
+        UNIX epoch, with an identifier greater than `after`, ordered by
+        ascending identifier. The commands expose the attributes of
+        :class:`gateway.memory.CommandRecord`. Stores that do not
+        support retention return an empty list.
+        """
+        return []
+
+    def delete(self, command_ids):
+        """Delete the given finished commands."""
+        pass
+
+    def compact(self, pages=None):
+        """Reclaim the space freed by deleted commands, if the storage
+        backend supports it.
+
+        Args:
+            pages: the maximum number of pages reclaimed, or ``None``
+                to reclaim all of them.
+
+        Returns:
+            the number of pages that remain to be reclaimed.
+        """
+        return 0
+
+    def release(self):
+        """Release the resources (e.g. database sessions) held on
+        behalf of the current thread. Invoked at the end of each
+        request.
+        """
+        pass
+
     class CommandTransaction:
 
         def __init__(self, store, ident, command):
@@ -1,22 +1,91 @@
+import asyncio
+import concurrent.futures
 import logging
-import threading 
 
 import ioc
 
+from gateway.pool import ShardedPool
+from gateway.pool import WorkerPool
 from gateway.runner import ICommandRunner
 
 
 class CommandRunner(ICommandRunner):
+    """Runs synchronous commands on the calling thread and asynchronous
+    commands on a bounded pool of worker threads.
+
+    If `shards` is greater than zero, commands whose handler declares a
+    partition key are instead run on the shard owning their key, so
+    that commands with the same key run one at a time and in order.
+    Synchronous commands then wait for their shard to run them.
+
+    Handlers are invoked according to their execution policy. Handlers
+    with a timeout are run on a separate pool of `timeout_workers`
+    threads, so that the caller can stop waiting for them; a handler
+    that times out keeps its thread until it returns.
+
+    Handlers may declare a lane in their inner ``Meta`` class. The
+    asynchronous commands of a lane listed in `lanes` run on workers
+    reserved for the lane, with a queue of their own; those of other
+    lanes run on the shared workers. Reserving workers for a high
+    priority lane keeps its commands from waiting behind a burst of
+    other commands, and reserving few workers for a bulk lane caps the
+    capacity these commands take.
+
+    If `fair_queuing` is enabled, the workers take the queued
+    asynchronous commands by weighted fair queuing across issuers, so
+    that an issuer submitting a burst of commands does not delay the
+    commands of the other issuers.
+
+    Args:
+        workers: the number of threads running asynchronous commands.
+        queue_size: the maximum number of asynchronous commands waiting
+            for a worker; ``0`` means unbounded.
+        block: wait for a free slot when the queue is full, instead of
+            rejecting the command.
+        timeout: the maximum number of seconds to wait for a free slot
+            if `block` is ``True``.
+        shards: the number of threads running partitioned commands.
+        shard_queue_size: the maximum number of commands waiting per
+            shard; ``0`` means unbounded.
+        timeout_workers: the number of threads running handlers that
+            declare a timeout.
+        fair_queuing: share the workers fairly between issuers.
+        issuer_weights: a dictionary mapping issuers to their share of
+            the workers relative to other issuers, which have a weight
+            of ``1``.
+        lanes: a dictionary mapping lanes to the number of threads
+            reserved for their asynchronous commands. The queue of each
+            lane holds at most `queue_size` commands.
+    """
     handlers = ioc.instance('CommandHandlersProvider')
     logger = logging.getLogger('gateway')
     store = ioc.instance('CommandStore')
 
+    def __init__(self, workers=8, queue_size=1024, block=False, timeout=None,
+        shards=0, shard_queue_size=1024, timeout_workers=16,
+        fair_queuing=False, issuer_weights=None, lanes=None):
+        weights = self.weights = (issuer_weights or {}) if fair_queuing else None
+        self.pool = WorkerPool(workers, queue_size, name='gateway-async',
+            weights=weights)
+        self.lanes = {
+            lane: WorkerPool(int(lane_workers), queue_size,
+                name='gateway-lane-' + lane, weights=weights)
+            for lane, lane_workers in (lanes or {}).items()
+        }
+        self.timed = WorkerPool(timeout_workers, 0, name='gateway-timed')
+        self.shards = ShardedPool(shards, shard_queue_size)\
+            if shards > 0 else None
+        self.block = bool(block)
+        self.timeout = timeout
+
     def execute(self, command):
         error = False
         try:
             ident, result, created = self.run(command)\
                 if not command.asynchronous\
                 else self.run_asynchronous(command)
+        except self.UpstreamFailure:
+            raise
         except Exception as e:
             raise self.CommandFailed
 
@@ -29,28 +98,102 @@ class CommandRunner(ICommandRunner):
             command: a :class:`CommandRequestDTO` instance.
         """
         handler = self.handlers.get(command.command)
-        return handler.run(command)
+        key = self.get_partition_key(handler, command)
+        if key is None:
+            return self.invoke(handler, command)
+        return self.submit(key, self.invoke, handler, command).result()
+
+    def invoke(self, handler, command):
+        """Invoke the handler, applying its execution policy. If its
+        ``run()`` method is a coroutine function, it is run on a new
+        event loop in the current thread.
+        """
+        return handler.policy.run(
+            lambda: self.call(handler, command, handler.policy.timeout),
+            on_retry=lambda attempt: self.on_retry(command, attempt))
+
+    def call(self, handler, command, timeout):
+        if asyncio.iscoroutinefunction(handler.run):
+            coroutine = handler.run(command)
+            if timeout is not None:
+                coroutine = asyncio.wait_for(coroutine, timeout)
+            try:
+                return asyncio.run(coroutine)
+            except asyncio.TimeoutError:
+                raise self.UpstreamFailure(reason="The command timed out.")
+
+        if timeout is None:
+            return handler.run(command)
+        future = self.timed.submit(handler.run, command)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise self.UpstreamFailure(reason="The command timed out.")
+
+    def on_retry(self, command, attempt):
+        self.logger.warning("Retrying command (id: {0}), attempt {1}."\
+            .format(command.id, attempt))
+        if command.id is not None:
+            self.store.set_status(command.id, self.store.STATE_RETRYING)
 
     def run_asynchronous(self, command):
         """Run a command asynchronously.
 
         Args:
             command: a :class:`CommandRequestDTO` instance.
+
+        Raises:
+            UpstreamFailure: the queue is full.
         """
         assert command.id is not None
         handler = self.handlers.get(command.command)
-        t = threading.Thread(target=self._async, args=[handler, command])
-        t.start()
+        self.submit(self.get_partition_key(handler, command),
+            self._async, handler, command, flow=command.issuer,
+            lane=handler.lane)
         return None, None, False
 
+    def get_partition_key(self, handler, command):
+        if self.shards is None:
+            return None
+        return handler.get_partition_key(command.params)
+
+    def submit(self, key, func, *args, flow=None, lane=None):
+        """Submit `func` to the shard owning `key`, or to the worker
+        pool of `lane` if `key` is ``None``. `flow` identifies the issuer
+        of the command when the worker pool uses fair queuing.
+
+        Raises:
+            UpstreamFailure: the queue is full.
+        """
+        try:
+            if key is None:
+                return self.lanes.get(lane, self.pool).submit(func, *args,
+                    block=self.block, timeout=self.timeout, flow=flow)
+            return self.shards.submit(key, func, *args,
+                block=self.block, timeout=self.timeout)
+        except self.pool.QueueFull:
+            raise self.UpstreamFailure(
+                reason="The command queue is full. Retry later.")
+
+    def get_metrics(self):
+        metrics = self.pool.metrics()
+        if self.shards is not None:
+            for name, value in self.shards.metrics().items():
+                metrics['shard_' + name] = value
+        for lane, pool in self.lanes.items():
+            for name, value in pool.metrics().items():
+                metrics['lane_{0}_{1}'.format(lane, name)] = value
+        return metrics
+
     def _async(self, handler, command):
         try:
-            handler.run(command)
-            self.store.set_status(command.id, self.store.STATE_DONE)
+            ident, result, created = self.invoke(handler, command)
+            self.store.set_status(command.id, self.store.STATE_DONE,
+                result={'ident': ident, 'result': result})
         except Exception as e:
             self.store.set_status(command.id, self.store.STATE_FAILED)
             self.logger.exception(
                 "Caught fatal exception during handling of command (id: {0})."\
                     .format(command.id)
             )
-            raise
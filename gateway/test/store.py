@@ -1,72 +1,442 @@
-from threading import RLock
+import contextlib
 import json
+import threading
 import time
+import uuid
 
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column
 from sqlalchemy import String
 from sqlalchemy import Integer
 from sqlalchemy import BigInteger
+from sqlalchemy import Boolean
+from sqlalchemy import Index
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.pool import StaticPool
 
+from gateway.batch import GroupCommitter
 from gateway.dto import CommandRequestDTO
 from gateway.store import ICommandStore
 
 
 Relation = declarative_base()
-Session = scoped_session(sessionmaker())
 
 
 class CommandStore(ICommandStore):
+    """A :class:`ICommandStore` implementation using SQLAlchemy.
 
-    def __init__(self):
-        self.engine = create_engine("sqlite:///test.db?check_same_thread=False")
-        self.session = Session(bind=self.engine)
-        self.lock = RLock()
+    Reads use a session bound to the current thread, which is released
+    by :meth:`release()` at the end of each request. Writes use a
+    short-lived session per transaction. Connections are taken from a
+    pool, so reads and writes do not wait for each other. For SQLite,
+    writes are serialized by the store and the database is opened in
+    WAL mode so that readers are not blocked by the writer.
+
+    Args:
+        dsn: the SQLAlchemy database URL.
+        pool_size: the number of connections kept in the pool.
+        max_overflow: the number of connections that may be opened in
+            addition to `pool_size` under load.
+        pool_timeout: the number of seconds to wait for a connection.
+        pool_recycle: the number of seconds after which a connection
+            is replaced; ``-1`` disables recycling.
+        journal_mode: the SQLite journal mode; ignored for other
+            backends.
+        busy_timeout: the number of milliseconds SQLite waits for a
+            lock before failing; ignored for other backends.
+        group_commit: combine writes from concurrent threads into a
+            single transaction.
+        batch_size: the maximum number of writes committed in one
+            transaction if `group_commit` is enabled.
+        window: the number of seconds to wait for more writes before
+            committing a batch if `group_commit` is enabled.
+        lease_ttl: the number of seconds for which asynchronous
+            commands are leased to this store; leases are renewed by
+            :class:`gateway.recovery.CommandRecovery`, even if the
+            recovery is disabled.
+    """
+    OP_PERSIST = 'persist'
+    OP_STATUS = 'status'
+
+    def __init__(self, dsn='sqlite:///test.db', pool_size=5, max_overflow=10,
+        pool_timeout=30, pool_recycle=-1, journal_mode='wal', busy_timeout=5000,
+        group_commit=False, batch_size=64, window=0.0, lease_ttl=60):
+        self.engine = self.create_engine(dsn, pool_size=pool_size,
+            max_overflow=max_overflow, pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle, journal_mode=journal_mode,
+            busy_timeout=busy_timeout)
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.owner = uuid.uuid4().hex
+        self.lease_ttl = lease_ttl
+        self.Session = scoped_session(self.session_factory)
+
+        # SQLite allows a single writer only; serializing the writes
+        # in-process prevents them from failing on a busy database.
+        self.lock = threading.Lock()\
+            if self.engine.dialect.name == 'sqlite'\
+            else contextlib.nullcontext()
+        self.committer = None
+        if group_commit:
+            self.committer = GroupCommitter(self._commit,
+                batch_size=batch_size, window=window)
+        self.create_schema()
+
+    def create_schema(self):
+        """Create the tables, the nullable columns and the indexes that
+        do not exist yet.
+        """
         Relation.metadata.create_all(self.engine)
 
+        # create_all() does not alter existing tables.
+        table = CommandDAO.__table__
+        inspector = inspect(self.engine)
+        columns = {x['name'] for x in inspector.get_columns(table.name)}
+        with self.engine.begin() as connection:
+            for column in table.columns:
+                if column.name in columns or not column.nullable:
+                    continue
+                connection.execute(text("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                    table.name, column.name,
+                    column.type.compile(dialect=self.engine.dialect))))
+
+        indexes = {x['name'] for x in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(self.engine)
+
+    @staticmethod
+    def create_engine(dsn, pool_size, max_overflow, pool_timeout,
+        pool_recycle, journal_mode, busy_timeout):
+        """Create the SQLAlchemy engine for the database identified by
+        `dsn`.
+        """
+        url = make_url(dsn)
+        kwargs = {}
+        if url.get_backend_name() != 'sqlite':
+            return create_engine(url, pool_size=pool_size,
+                max_overflow=max_overflow, pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle, pool_pre_ping=True)
+
+        # Pooled SQLite connections are handed from thread to thread,
+        # but never used by two threads at once, so the thread check
+        # of the sqlite3 module must be disabled.
+        kwargs['connect_args'] = {'check_same_thread': False}
+        if url.database in (None, '', ':memory:'):
+            # An in-memory database exists per connection, so all
+            # threads must share the same connection.
+            kwargs['poolclass'] = StaticPool
+        else:
+            kwargs.update(poolclass=QueuePool, pool_size=pool_size,
+                max_overflow=max_overflow, pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle)
+        engine = create_engine(url, **kwargs)
+
+        @event.listens_for(engine, 'connect')
+        def on_connect(connection, record):
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA busy_timeout = {0:d}".format(busy_timeout))
+            # Only applies to new databases; lets compact() return the
+            # pages freed by deleted commands to the file system.
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            if journal_mode:
+                cursor.execute("PRAGMA journal_mode = {0}".format(journal_mode))
+                if journal_mode.lower() == 'wal':
+                    cursor.execute("PRAGMA synchronous = NORMAL")
+            cursor.close()
+
+        return engine
+
     def dump_params(self, params):
         return json.dumps(params)
 
-    def get_commands(self, offset=0, limit=100):
+    def release(self):
+        self.Session.remove()
+
+    def get_commands(self, cursor=None, limit=100, status=None,
+        command_type=None, issuer=None, since=None, until=None):
         """Return a list containing the issued commands using the
-        specified criteria.
+        specified criteria, ordered by descending identifier.
+
+        Args:
+            cursor: only return commands with an identifier lower than
+                `cursor`, i.e. the last identifier of the previous page.
+            limit: the maximum number of commands to return, or
+                ``None`` to return all matching commands.
+            status: only return commands having this status.
+            command_type: only return commands of this type.
+            issuer: only return commands issued by this issuer.
+            since: only return commands issued at or after this
+                timestamp, in milliseconds since the UNIX epoch.
+            until: only return commands issued before this timestamp.
         """
-        return self.session.query(CommandDAO)\
+        query = self.Session().query(CommandDAO)
+        if cursor is not None:
+            query = query.filter(CommandDAO.command_id < cursor)
+        if status is not None:
+            query = query.filter(CommandDAO.status == status)
+        if command_type is not None:
+            query = query.filter(CommandDAO.command_type == command_type)
+        if issuer is not None:
+            query = query.filter(CommandDAO.issuer == issuer)
+        if since is not None:
+            query = query.filter(CommandDAO.timestamp >= since)
+        if until is not None:
+            query = query.filter(CommandDAO.timestamp < until)
+        return query\
             .order_by(CommandDAO.command_id.desc())\
-            .offset(offset)\
             .limit(limit)
 
-    def set_status(self, command_id, status):
+    def get_idempotent(self, issuer, idempotency_key):
+        return self.Session().query(CommandDAO)\
+            .filter(CommandDAO.issuer == issuer)\
+            .filter(CommandDAO.idempotency_key == idempotency_key)\
+            .first()
+
+    def release_idempotency_key(self, command_id):
+        session = self.session_factory()
+        try:
+            with self.lock:
+                session.query(CommandDAO)\
+                    .filter(CommandDAO.command_id == command_id)\
+                    .update({'idempotency_key': None}, synchronize_session=False)
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def get_recoverable(self, after=0, limit=500):
+        # Seeks ix_commands_status to the first unfinished command after
+        # `after`; the remaining criteria are checked on the rows that
+        # follow.
+        now = self.get_timestamp()
+        return self.Session().query(CommandDAO)\
+            .filter(CommandDAO.status.in_(self.ACTIVE_STATES))\
+            .filter(CommandDAO.command_id > after)\
+            .filter(CommandDAO.asynchronous == True)\
+            .filter(or_(CommandDAO.lease_expires == None,
+                CommandDAO.lease_expires < now))\
+            .order_by(CommandDAO.command_id.asc())\
+            .limit(limit)\
+            .all()
+
+    def claim_leases(self, command_ids):
+        if not command_ids:
+            return []
+        now = self.get_timestamp()
+        selected = CommandDAO.command_id.in_(command_ids)
+        return self._update_leases(
+            [selected, or_(CommandDAO.lease_expires == None,
+                CommandDAO.lease_expires < now)],
+            {'lease_owner': self.owner, 'lease_expires': now + self.lease_ttl * 1000},
+            returning=selected)
+
+    def renew_leases(self):
+        self._update_leases([CommandDAO.lease_owner == self.owner],
+            {'lease_expires': self.get_timestamp() + self.lease_ttl * 1000})
+
+    def release_leases(self, command_ids):
+        if command_ids:
+            self._update_leases([CommandDAO.command_id.in_(command_ids),
+                CommandDAO.lease_owner == self.owner], {'lease_expires': 0})
+
+    def _update_leases(self, criteria, values, returning=None):
+        # If `returning` is given, return the unfinished commands matching
+        # it that are leased to this store. They are read in the writing
+        # transaction, because the session bound to the thread may not
+        # see the update yet.
+        session = self.session_factory()
+        try:
+            with self.lock:
+                session.query(CommandDAO)\
+                    .filter(CommandDAO.status.in_(self.ACTIVE_STATES), *criteria)\
+                    .update(values, synchronize_session=False)
+                leased = []
+                if returning is not None:
+                    leased = session.query(CommandDAO)\
+                        .filter(CommandDAO.status.in_(self.ACTIVE_STATES))\
+                        .filter(returning, CommandDAO.lease_owner == self.owner)\
+                        .order_by(CommandDAO.command_id.asc())\
+                        .all()
+                    session.expunge_all()
+                session.commit()
+                return leased
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def get_expired(self, before, after=0, limit=500):
+        return self.Session().query(CommandDAO)\
+            .filter(CommandDAO.status.in_(self.FINISHED_STATES))\
+            .filter(CommandDAO.command_id > after)\
+            .filter(CommandDAO.timestamp < before)\
+            .order_by(CommandDAO.command_id.asc())\
+            .limit(limit)\
+            .all()
+
+    def delete(self, command_ids):
+        if not command_ids:
+            return
+        session = self.session_factory()
+        try:
+            with self.lock:
+                session.query(CommandDAO)\
+                    .filter(CommandDAO.command_id.in_(command_ids))\
+                    .filter(CommandDAO.status.in_(self.FINISHED_STATES))\
+                    .delete(synchronize_session=False)
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def compact(self, pages=None):
+        if self.engine.dialect.name != 'sqlite':
+            return 0
+        # The vacuum holds the write lock of the database; vacuuming a
+        # bounded number of pages keeps the writes of the gateway from
+        # waiting for a whole pass. The sqlite3 module steps the pragma
+        # once, which frees a single page, so it is run once per page.
         with self.lock:
-            self.session.query(CommandDAO)\
-                .filter(CommandDAO.command_id==command_id)\
-                .update({'status': status})
-            self.session.flush()
-            self.session.commit()
+            connection = self.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                remaining = self.get_freelist_count(cursor)
+                for i in range(remaining if pages is None
+                else min(pages, remaining)):
+                    cursor.execute("PRAGMA incremental_vacuum(1)")
+                remaining = self.get_freelist_count(cursor)
+                cursor.close()
+                connection.commit()
+            finally:
+                connection.close()
+        return remaining
+
+    @staticmethod
+    def get_freelist_count(cursor):
+        cursor.execute("PRAGMA freelist_count")
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def get_timestamp():
+        return int(time.time() * 1000)
+
+    def iter_commands(self, *args, chunk_size=500, **kwargs):
+        return iter(self.get_commands(*args, **kwargs).yield_per(chunk_size))
+
+    def get_command(self, command_id):
+        return self.Session().query(CommandDAO).get(command_id)
+
+    def _set_status(self, command_id, status, result):
+        self._write((self.OP_STATUS, command_id, status, result))
 
     def _persist(self, command):
-        dao = CommandDAO(
+        try:
+            return self._write((self.OP_PERSIST, self.create_dao(command)))
+        except IntegrityError:
+            if command.idempotency_key is None\
+            or self.get_idempotent(command.issuer, command.idempotency_key) is None:
+                raise
+            raise self.DuplicateEntity(
+                reason="A command with this idempotency key was already issued.")
+
+    def _persist_many(self, commands):
+        if not commands:
+            return []
+        return self._commit([(self.OP_PERSIST, self.create_dao(x))
+            for x in commands])
+
+    def create_dao(self, command):
+        # Asynchronous commands are leased to this store until they
+        # are run, so that other gateways do not recover them.
+        asynchronous = bool(command.asynchronous)
+        return CommandDAO(
             command_type=command.command,
             params=self.dump_params(command.params),
             issuer=command.issuer,
             authenticated_by=command.authenticated_by,
-            host=command.host
+            host=command.host,
+            idempotency_key=command.idempotency_key,
+            asynchronous=asynchronous,
+            lease_owner=self.owner if asynchronous else None,
+            lease_expires=self.get_timestamp() + self.lease_ttl * 1000\
+                if asynchronous else None
         )
-        with self.lock:
-            self.session.add(dao)
-            self.session.flush()
-            self.session.commit()
-        return dao.command_id
+
+    def _write(self, operation):
+        if self.committer is not None:
+            return self.committer.submit(operation)
+        return self._commit([operation])[0]
+
+    def _commit(self, operations):
+        """Apply the given write operations in a single transaction
+        and return a list holding the result of each operation.
+        """
+        results = []
+        session = self.session_factory()
+        try:
+            with self.lock:
+                for operation in operations:
+                    if operation[0] == self.OP_PERSIST:
+                        session.add(operation[1])
+                    else:
+                        _, command_id, status, result = operation
+                        values = {'status': status}
+                        if result is not None:
+                            values['result'] = self.dump_result(result)
+                        if status not in self.ACTIVE_STATES:
+                            values['lease_owner'] = None
+                        session.query(CommandDAO)\
+                            .filter(CommandDAO.command_id==command_id)\
+                            .update(values, synchronize_session=False)
+                session.flush()
+
+                # Collect the identifiers before committing, because
+                # the attributes are expired afterwards.
+                for operation in operations:
+                    results.append(operation[1].command_id
+                        if operation[0] == self.OP_PERSIST else None)
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return results
 
 
 class CommandDAO(Relation):
     __tablename__ = 'commands'
-    __table_args__ = {
-        'sqlite_autoincrement': True    
-    }
+    __table_args__ = (
+        # The identifier is included in the filtered indexes so that
+        # get_commands() can seek to the cursor and read the index in
+        # order, instead of sorting the matching rows.
+        Index('ix_commands_status', 'status', 'command_id'),
+        Index('ix_commands_command_type', 'command_type', 'command_id'),
+        Index('ix_commands_issuer', 'issuer', 'command_id'),
+        Index('ix_commands_timestamp', 'timestamp'),
+        Index('ix_commands_idempotency_key', 'issuer', 'idempotency_key',
+            unique=True),
+        # Finished commands release their lease, so that the leases of
+        # a gateway can be renewed without scanning the table.
+        Index('ix_commands_lease_owner', 'lease_owner'),
+        {
+            'sqlite_autoincrement': True
+        }
+    )
 
     command_id = Column(Integer,
         primary_key=True,
@@ -109,3 +479,28 @@ class CommandDAO(Relation):
         default='pending',
         name='status'
     )
+
+    idempotency_key = Column(String,
+        nullable=True,
+        name='idempotency_key'
+    )
+
+    asynchronous = Column(Boolean,
+        nullable=True,
+        name='asynchronous'
+    )
+
+    lease_owner = Column(String,
+        nullable=True,
+        name='lease_owner'
+    )
+
+    lease_expires = Column(BigInteger,
+        nullable=True,
+        name='lease_expires'
+    )
+
+    result = Column(String,
+        nullable=True,
+        name='result'
+    )
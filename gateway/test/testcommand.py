@@ -25,14 +25,5 @@ class TestCommandHandler(ICommandHandler):
     def handle(self, params):
         return None
 
-    def validate(self, params):
-        params, errors = self.schema.load(params)
-        if errors:
-            raise self.CommandRejected(
-                reason="Invalid command parameters.",
-                context=errors
-            )
-        return params
-
     class Meta:
         command = 'gateway.test.TestCommand'
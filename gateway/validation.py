@@ -0,0 +1,90 @@
+import collections.abc
+import functools
+
+from marshmallow import ValidationError
+from marshmallow import missing
+
+
+def compile_validator(schema):
+    """Return a function that validates a mapping of command parameters
+    like :meth:`Schema.load()` and returns a tuple ``(params, errors)``;
+    `params` is a dictionary, or ``None`` if there are errors.
+
+    If `schema` only declares fields, the returned function follows the
+    rules of :meth:`Schema.load()` (missing values, ``load_from``,
+    ``attribute``, ``dump_only`` and required fields; unknown keys are
+    ignored) and reports errors in the same format, but does not create
+    an unmarshaller per call. Schemas declaring processors (e.g.
+    ``pre_load``, ``post_load``, ``validates`` or ``validates_schema``)
+    or other loading options are loaded with :meth:`Schema.load()`.
+
+    Args:
+        schema: a :class:`marshmallow.Schema` instance.
+    """
+    if not is_compilable(schema):
+        return functools.partial(load, schema)
+
+    dict_class = schema.dict_class
+    specs = tuple(
+        (name, field.attribute or name, field.load_from, field.deserialize,
+            field.missing, field.required)
+        for name, field in schema.fields.items()
+        if not field.dump_only
+    )
+
+    def validate(data):
+        if not isinstance(data, collections.abc.Mapping):
+            return None, {'_schema': ["Invalid input type."]}
+
+        params = dict_class()
+        errors = None
+        for name, attribute, load_from, deserialize, default, required in specs:
+            key = name
+            value = data.get(name, missing)
+            if value is missing and load_from:
+                key = load_from
+                value = data.get(load_from, missing)
+            if value is missing:
+                value = default() if callable(default) else default
+                if value is missing and not required:
+                    continue
+
+            try:
+                params[attribute] = deserialize(value, load_from or name, data)
+            except ValidationError as e:
+                if errors is None:
+                    errors = {}
+                if isinstance(e.messages, dict):
+                    errors[key] = e.messages
+                else:
+                    errors.setdefault(key, []).extend(e.messages)
+
+        if errors:
+            return None, errors
+        return params, {}
+
+    return validate
+
+
+def is_compilable(schema):
+    """Return a boolean indicating if :func:`compile_validator()` can
+    validate with the fields of `schema` only.
+    """
+    processors = getattr(schema, '__processors__', None)
+    if processors is None or any(processors.values()):
+        return False
+    if schema.many or schema.partial\
+    or getattr(schema, '__error_handler__', None) is not None:
+        return False
+    return not any('.' in (x.attribute or '') for x in schema.fields.values())
+
+
+def load(schema, data):
+    # Validate `data` with the schema itself, which may be strict.
+    try:
+        params, errors = schema.load(data)
+    except ValidationError as e:
+        return None, e.messages
+    if errors:
+        return None, errors
+    return params, {}
@@ -0,0 +1,370 @@
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from gateway.batch import GroupCommitter
+from gateway.memory import CommandRecord
+from gateway.store import ICommandStore
+
+
+class LogCommandStore(ICommandStore):
+    """A :class:`ICommandStore` implementation appending each persisted
+    command and each status transition as a binary record to a log,
+    which is split into segment files of at most `segment_size` bytes.
+
+    Writes from concurrent threads are appended and synced to disk in
+    batches. At startup the segments are scanned to rebuild the index
+    mapping command identifiers to record offsets; a partially written
+    record at the end of the log is truncated. Commands are read from
+    the segments through memory maps.
+
+    Each record consists of a header holding the length of the payload,
+    its CRC-32 checksum and the record kind, followed by the payload.
+    Besides commands and status transitions, the log records the
+    idempotency keys that were released.
+
+    Args:
+        path: the directory holding the segment files.
+        segment_size: the size in bytes after which a new segment is
+            started.
+        fsync: sync the log to disk before acknowledging writes.
+        batch_size: the maximum number of writes appended at once.
+        window: the number of seconds to wait for more writes before
+            appending a batch.
+    """
+    OP_PERSIST = 'persist'
+    OP_STATUS = 'status'
+    OP_RELEASE = 'release'
+    KIND_PERSIST = 1
+    KIND_STATUS = 2
+    KIND_RELEASE = 3
+    header = struct.Struct('<IIB')
+    persist_header = struct.Struct('<qqqqHHHI')
+    status_header = struct.Struct('<qH')
+    release_header = struct.Struct('<qq')
+    kinds = {OP_PERSIST: KIND_PERSIST, OP_STATUS: KIND_STATUS,
+        OP_RELEASE: KIND_RELEASE}
+    segment_suffix = '.log'
+    logger = logging.getLogger('gateway')
+
+    def __init__(self, path='commands', segment_size=64 * 1024 * 1024,
+        fsync=True, batch_size=64, window=0.0):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.offsets = {}
+        self.statuses = {}
+        self.results = {}
+        self.keys = {}
+        self.maps = {}
+        self.high = 0
+        self.file = None
+        self.segment = None
+        self.size = 0
+        self.committer = GroupCommitter(self._commit,
+            batch_size=batch_size, window=window)
+        os.makedirs(path, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        """Rebuild the index from the segments and open the last
+        segment for appending.
+        """
+        segments = sorted(int(x[:-len(self.segment_suffix)])
+            for x in os.listdir(self.path) if x.endswith(self.segment_suffix))
+        for segment in segments:
+            self.load_segment(segment)
+        self.open_segment(segments[-1] if segments else 1)
+
+    def load_segment(self, segment):
+        filename = self.get_segment_path(segment)
+        size = os.path.getsize(filename)
+        offset = 0
+        if size > 0:
+            with open(filename, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    while offset < size:
+                        record = self.read_record(buf, offset)
+                        if record is None:
+                            break
+                        kind, payload, length = record
+                        self.apply(kind, payload, segment, offset)
+                        offset += length
+
+        if offset < size:
+            self.logger.warning(
+                "Truncating {0} bytes of incomplete records from {1}."\
+                    .format(size - offset, filename))
+            with open(filename, 'r+b') as f:
+                f.truncate(offset)
+
+    def open_segment(self, segment):
+        if self.file is not None:
+            self.file.close()
+        self.segment = segment
+        self.file = open(self.get_segment_path(segment), 'ab')
+        self.size = self.file.tell()
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.path,
+            '{0:020d}{1}'.format(segment, self.segment_suffix))
+
+    def read_record(self, buf, offset):
+        """Return a tuple containing the kind, the payload and the total
+        length of the record at `offset` in `buf`, or ``None`` if the
+        record is incomplete or corrupt.
+        """
+        end = offset + self.header.size
+        if end > len(buf):
+            return None
+        length, checksum, kind = self.header.unpack_from(buf, offset)
+        payload = buf[end:end + length]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            return None
+        return kind, payload, self.header.size + length
+
+    def apply(self, kind, payload, segment, offset):
+        # Update the index with a record written at `offset`.
+        if kind == self.KIND_PERSIST:
+            record = self.decode_persist(payload)
+            self.offsets[record.command_id] = (segment, offset)
+            self.statuses[record.command_id] = record.status
+            if record.idempotency_key is not None:
+                self.keys[(record.issuer, record.idempotency_key)] = record.command_id
+            self.high = max(self.high, record.command_id)
+        elif kind == self.KIND_STATUS:
+            command_id, status, result = self.decode_status(payload)
+            if command_id in self.offsets:
+                self.statuses[command_id] = status
+                if result is not None:
+                    self.results[command_id] = (segment, offset)
+        elif kind == self.KIND_RELEASE:
+            command_id, issuer, key = self.decode_release(payload)
+            if self.keys.get((issuer, key)) == command_id:
+                del self.keys[(issuer, key)]
+
+    def encode(self, kind, payload):
+        return self.header.pack(len(payload), zlib.crc32(payload), kind) + payload
+
+    def encode_persist(self, record):
+        command_type = record.command_type.encode('utf-8')
+        host = record.host.encode('utf-8')
+        key = (record.idempotency_key or '').encode('utf-8')
+        params = record.params.encode('utf-8')
+        return self.encode(self.KIND_PERSIST, b''.join([
+            self.persist_header.pack(record.command_id, record.timestamp,
+                record.issuer, record.authenticated_by, len(command_type),
+                len(host), len(key), len(params)),
+            command_type, host, key, params
+        ]))
+
+    def decode_persist(self, payload):
+        command_id, timestamp, issuer, authenticated_by, *lengths =\
+            self.persist_header.unpack_from(payload)
+        values = []
+        offset = self.persist_header.size
+        for length in lengths:
+            values.append(bytes(payload[offset:offset + length]).decode('utf-8'))
+            offset += length
+        command_type, host, key, params = values
+        return CommandRecord(command_id, command_type, timestamp, issuer,
+            authenticated_by, host, params, self.STATE_PENDING, key or None)
+
+    def encode_status(self, command_id, status, result):
+        status = status.encode('utf-8')
+        result = self.dump_result(result).encode('utf-8')\
+            if result is not None else b''
+        return self.encode(self.KIND_STATUS,
+            self.status_header.pack(command_id, len(status)) + status + result)
+
+    def decode_status(self, payload):
+        # Return the identifier, the status and the encoded result, if
+        # any, of a status record.
+        command_id, length = self.status_header.unpack_from(payload)
+        offset = self.status_header.size
+        status = bytes(payload[offset:offset + length]).decode('utf-8')
+        result = bytes(payload[offset + length:]).decode('utf-8')
+        return command_id, status, result or None
+
+    def encode_release(self, record):
+        return self.encode(self.KIND_RELEASE,
+            self.release_header.pack(record.command_id, record.issuer)\
+                + record.idempotency_key.encode('utf-8'))
+
+    def decode_release(self, payload):
+        # Return the identifier, the issuer and the idempotency key of
+        # a command whose key was released.
+        command_id, issuer = self.release_header.unpack_from(payload)
+        key = bytes(payload[self.release_header.size:]).decode('utf-8')
+        return command_id, issuer, key
+
+    def get(self, command_id):
+        """Return the command identified by `command_id`, or ``None`` if
+        it does not exist. The idempotency key of the command is kept in
+        the log after it was released.
+        """
+        location = self.offsets.get(command_id)
+        if location is None:
+            return None
+        segment, offset = location
+        kind, payload, length = self.read_record(
+            self.get_map(segment, offset), offset)
+        record = self.decode_persist(payload)
+        record.status = self.statuses.get(command_id, record.status)
+        if command_id in self.results:
+            segment, offset = self.results[command_id]
+            kind, payload, length = self.read_record(
+                self.get_map(segment, offset), offset)
+            record.result = self.decode_status(payload)[2]
+        return record
+
+    def get_command(self, command_id):
+        return self.get(command_id)
+
+    def get_map(self, segment, offset):
+        """Return a memory map of `segment` covering the record at
+        `offset`. The map of the segment being appended to is replaced
+        when the log grows past it.
+        """
+        buf = self.maps.get(segment)
+        if buf is None or offset + self.header.size > len(buf)\
+        or offset + self.header.size + self.header.unpack_from(buf, offset)[0] > len(buf):
+            with open(self.get_segment_path(segment), 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Maps that are replaced are not closed, because other
+            # threads may still be reading them.
+            self.maps[segment] = buf
+        return buf
+
+    def dump_params(self, params):
+        return json.dumps(params)
+
+    def get_commands(self, cursor=None, limit=100, **filters):
+        """Return a list containing the issued commands using the
+        criteria accepted by :meth:`gateway.test.CommandStore.get_commands()`,
+        ordered by descending identifier.
+        """
+        return list(self.iter_commands(cursor=cursor, limit=limit, **filters))
+
+    def iter_commands(self, cursor=None, limit=None, status=None,
+        command_type=None, issuer=None, since=None, until=None, chunk_size=None):
+        commands = self.scan(cursor, status, command_type, issuer, since, until)
+        return itertools.islice(commands, limit)
+
+    def scan(self, cursor, status, command_type, issuer, since, until):
+        high = self.high
+        start = high if cursor is None else min(cursor - 1, high)
+        for command_id in range(start, 0, -1):
+            # The status is known without reading the log.
+            if status is not None and self.statuses.get(command_id) != status:
+                continue
+            record = self.get(command_id)
+            if record is None\
+            or (command_type is not None and record.command_type != command_type)\
+            or (issuer is not None and record.issuer != issuer)\
+            or (since is not None and record.timestamp < since)\
+            or (until is not None and record.timestamp >= until):
+                continue
+            yield record
+
+    def get_idempotent(self, issuer, idempotency_key):
+        command_id = self.keys.get((issuer, idempotency_key))
+        return self.get(command_id) if command_id is not None else None
+
+    def release_idempotency_key(self, command_id):
+        self.committer.submit((self.OP_RELEASE, command_id))
+
+    def _set_status(self, command_id, status, result):
+        self.committer.submit((self.OP_STATUS, command_id, status, result))
+
+    def _persist(self, command):
+        return self.committer.submit((self.OP_PERSIST, self.create_record(command)))
+
+    def _persist_many(self, commands):
+        if not commands:
+            return []
+        return self._commit([(self.OP_PERSIST, self.create_record(x))
+            for x in commands])
+
+    def create_record(self, command):
+        return CommandRecord(
+            command_id=None,
+            command_type=command.command,
+            timestamp=int(time.time() * 1000),
+            issuer=command.issuer,
+            authenticated_by=command.authenticated_by,
+            host=command.host,
+            params=self.dump_params(command.params),
+            status=self.STATE_PENDING,
+            idempotency_key=command.idempotency_key
+        )
+
+    def _commit(self, operations):
+        """Append the records for the given write operations to the log
+        and return a list holding the result of each operation. Either
+        all or none of the records are appended.
+        """
+        with self.lock:
+            keys = set()
+            for operation in operations:
+                if operation[0] != self.OP_PERSIST\
+                or operation[1].idempotency_key is None:
+                    continue
+                key = (operation[1].issuer, operation[1].idempotency_key)
+                if key in self.keys or key in keys:
+                    raise self.DuplicateEntity(
+                        reason="A command with this idempotency key was already issued.")
+                keys.add(key)
+
+            chunks = []
+            command_id = self.high
+            for operation in operations:
+                if operation[0] == self.OP_PERSIST:
+                    command_id += 1
+                    operation[1].command_id = command_id
+                    chunks.append(self.encode_persist(operation[1]))
+                elif operation[1] not in self.offsets:
+                    chunks.append(b'')
+                elif operation[0] == self.OP_STATUS:
+                    chunks.append(self.encode_status(*operation[1:]))
+                else:
+                    record = self.get(operation[1])
+                    chunks.append(self.encode_release(record)
+                        if record.idempotency_key is not None else b'')
+
+            try:
+                self.file.write(b''.join(chunks))
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+            except Exception:
+                self.file.truncate(self.size)
+                raise
+
+            # Index the records once they are durable.
+            results = []
+            offset = self.size
+            for operation, chunk in zip(operations, chunks):
+                if chunk:
+                    self.apply(self.kinds[operation[0]],
+                        memoryview(chunk)[self.header.size:], self.segment, offset)
+                offset += len(chunk)
+                results.append(operation[1].command_id
+                    if operation[0] == self.OP_PERSIST else None)
+            self.size = offset
+
+            if self.size >= self.segment_size:
+                self.open_segment(self.segment + 1)
+        return results
+
+    def close(self):
+        """Close the segment being appended to."""
+        with self.lock:
+            self.file.close()
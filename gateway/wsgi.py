@@ -0,0 +1,501 @@
+import json
+import sys
+import threading
+import urllib.parse
+
+from marshmallow import Schema
+from marshmallow import ValidationError
+from libsousou.web import RequestController
+from libsousou.web import IRequest
+from libsousou.web.exc import BadRequest
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map
+from werkzeug.routing import Rule
+from werkzeug.wrappers import Request
+from werkzeug.wrappers import Response
+import marshmallow.fields
+import marshmallow.validate
+import ioc
+
+from gateway.codec import JSONCodec
+from gateway.dto import CommandRequestDTO
+from gateway.dto import CommandResponseDTO
+from gateway.dto import describe_response
+from gateway.errors import ISSUE_ERRORS
+from gateway.errors import describe as describe_error
+from gateway.errors import get_headers as get_error_headers
+from gateway.mixins import ICommandProcessor
+
+
+class GatewayController(RequestController):
+    default_content_type = "application/json"
+    ndjson_content_type = "application/x-ndjson"
+    disable_authentication = True
+    gateway = ioc.instance('CommandGateway')
+    auth_service = ioc.instance('AuthenticationService')
+    metrics = ioc.instance('GatewayMetrics')
+    response_class = Response
+    debug = '--debug' in sys.argv
+    CommandParsingError = ValidationError
+    CommandRejected = ICommandProcessor.CommandRejected
+    request_metric = 'gateway_request_duration_seconds'
+    stage_metric = 'gateway_stage_duration_seconds'
+
+    #: The codec encoding the responses, negotiated from the ``Accept``
+    #: header of the request by :meth:`dispatch()`.
+    codec = JSONCodec(4 if debug else None)
+
+    #: A controller is created for each request, but the schemas are
+    #: created once per thread and reused by the requests it handles,
+    #: because marshmallow schemas keep state while loading.
+    schemas = threading.local()
+
+    @property
+    def command_schema(self):
+        return self.get_schema(self.CommandRequestSchema)
+
+    @property
+    def query_schema(self):
+        return self.get_schema(self.CommandQuerySchema)
+
+    @property
+    def export_schema(self):
+        return self.get_schema(self.CommandExportSchema)
+
+    def get_schema(self, schema_class):
+        """Return the instance of `schema_class` owned by the current
+        thread.
+        """
+        schemas = self.schemas.__dict__
+        schema = schemas.get(schema_class)
+        if schema is None:
+            schema = schemas[schema_class] = schema_class()
+        return schema
+
+    def response_factory(self, *args, **kwargs):
+        kwargs['status'] = kwargs.pop('status_code', None) or kwargs.get('status')
+        return self.response_class(*args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        self.negotiate(request)
+        return super(GatewayController, self).dispatch(request, *args, **kwargs)
+
+    def negotiate(self, request):
+        if request.codecs is not None:
+            self.codec = request.codecs.negotiate(request.accept_mimetypes)
+
+    def render(self, context):
+        if isinstance(context, CommandResponseDTO):
+            return self.codec.encode_response(context)
+        return self.codec.encode(context)
+
+    def render_to_response(self, context, *args, **kwargs):
+        kwargs['content_type'] = self.codec.content_type
+        return self.response_factory(self.render(context), *args, **kwargs)
+
+    def encode(self, obj):
+        """Encode `obj` to JSON. The output is indented in debug mode
+        only.
+        """
+        if self.debug:
+            return json.dumps(obj, indent=4)
+        return json.dumps(obj, separators=(',', ':'))
+
+    def get(self, request, **kwargs):
+        if self.must_stream(request):
+            return self.stream(request)
+
+        query = self.parse_query(request)
+        del query['stream']
+        return self.render_page(request, query,
+            *self.gateway.get_page(**query))
+
+    def must_stream(self, request):
+        # Parsed with the export schema, which accepts every query that
+        # may be streamed.
+        return self.parse_query(request, self.export_schema)['stream']\
+            or self.accepts_ndjson(request)
+
+    def render_page(self, request, query, commands, etag):
+        if etag in request.if_none_match:
+            response = self.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        headers = {'ETag': '"{0}"'.format(etag)}
+        if len(commands) == query['limit']:
+            headers['Link'] = self.get_next_link(request,
+                commands[-1]['command_id'])
+        return self.render_to_response(commands, headers=headers)
+
+    def stream(self, request):
+        """Stream the commands matching the query to the client while
+        they are read from the store, either as newline-delimited JSON
+        or as a JSON array. The ``limit`` parameter is optional.
+        """
+        query = self.parse_query(request, self.export_schema)
+        del query['stream']
+        commands = self.gateway.iter_commands(**query)
+        if self.accepts_ndjson(request):
+            content_type = self.ndjson_content_type
+            chunks = self.iter_lines(commands)
+        else:
+            content_type = self.default_content_type
+            chunks = self.iter_array(commands)
+        return self.response_class(chunks, status=200,
+            content_type=content_type, direct_passthrough=True)
+
+    def iter_lines(self, items):
+        for item in items:
+            yield self.encode(item) + '\n'
+
+    def iter_array(self, items):
+        yield '['
+        separator = ''
+        for item in items:
+            yield separator + self.encode(item)
+            separator = ','
+        yield ']'
+
+    def accepts_ndjson(self, request):
+        return request.accept_mimetypes.best_match([
+            self.default_content_type,
+            self.ndjson_content_type
+        ]) == self.ndjson_content_type
+
+    def parse_query(self, request, schema=None):
+        schema = schema or self.query_schema
+        query, errors = schema.load(request.args.to_dict())
+        if errors:
+            raise BadRequest({
+                'hint': "Invalid query parameters.",
+                'context': errors
+            })
+        return query
+
+    def get_next_link(self, request, cursor):
+        """Return the ``Link`` header pointing to the page following
+        the command identified by `cursor`.
+        """
+        args = request.args.to_dict()
+        args['cursor'] = cursor
+        return '<{0}?{1}>; rel="next"'.format(
+            request.base_url, urllib.parse.urlencode(args))
+
+    def post(self, request, **kwargs):
+        with self.time_request() as timer:
+            command = None
+            headers = None
+            try:
+                command = self.parse_command(request)
+                status, result = self.describe_result(self.gateway.issue(command))
+            except ISSUE_ERRORS as e:
+                status, result = describe_error(e)
+                headers = get_error_headers(e)
+            self.tag_result(timer, command, status, result)
+        return self.render_to_response(result, status=status, headers=headers)
+
+    def time_request(self):
+        """Return the timer observing the duration of a request. The
+        request is reported with outcome ``error`` and command type
+        ``unknown`` unless :meth:`tag_result()` labels it, e.g. if the
+        request is malformed, so that all series of the request metric
+        have the same labels.
+        """
+        return self.metrics.timer(self.request_metric, outcome='error',
+            command_type='unknown')
+
+    def tag_result(self, timer, command, status, result):
+        """Label the request duration with the error code of the
+        response, or ``ok``, and, if the command was accepted, its type.
+        The type of rejected commands is reported as ``unknown``,
+        because it is supplied by the client.
+        """
+        if status < 400:
+            timer.tag(outcome='ok', command_type=command.command)
+        else:
+            timer.tag(outcome=result.get('code', 'error'),
+                command_type='unknown')
+
+    def describe_result(self, result):
+        """Return a tuple containing the HTTP status code and the
+        response context for a :class:`~gateway.dto.CommandResponseDTO`.
+        The context is the response itself, which :meth:`render()`
+        encodes from its fields.
+        """
+        status = 200
+        if result.created:
+            status = 201
+        if not result.done:
+            status = 202
+        return status, result
+
+    def parse_command(self, request):
+        command = self.load_command(request, self.decode(request))
+        command.idempotency_key = self.get_idempotency_key(request)
+        return command
+
+    def decode(self, request):
+        with self.metrics.timer(self.stage_metric, stage='decode',
+            command_type='unknown'):
+            return request.payload
+
+    def get_idempotency_key(self, request):
+        key = request.headers.get('Idempotency-Key')
+        if key is not None and not (0 < len(key) <= 255):
+            raise self.UnprocessableEntity({
+                'hint': "The Idempotency-Key header must hold 1 to 255 characters."
+            })
+        return key
+
+    def load_command(self, request, data):
+        if not isinstance(data, dict):
+            raise self.UnprocessableEntity({'hint': "Malformed command request."})
+        with self.metrics.timer(self.stage_metric, stage='load',
+            command_type='unknown'):
+            data, errors = self.command_schema.load(data)
+        if errors:
+            raise self.UnprocessableEntity({
+                'hint': "Malformed command request.",
+                'context': errors
+            })
+
+        # The id attribute will be set by the command storage backend. The
+        # issuer and host are taken from the request, never from the body.
+        return CommandRequestDTO(None, data['command'], data['asynchronous'],
+            data['params'], request.issuer, request.authenticated_by,
+            request.remote_addr, data.get('idempotency_key'))
+
+    class CommandQuerySchema(Schema):
+        cursor = marshmallow.fields.Integer()
+        limit = marshmallow.fields.Integer(missing=100,
+            validate=marshmallow.validate.Range(min=1, max=1000))
+        status = marshmallow.fields.String()
+        command_type = marshmallow.fields.String()
+        issuer = marshmallow.fields.Integer()
+        since = marshmallow.fields.Integer()
+        until = marshmallow.fields.Integer()
+        archived = marshmallow.fields.Boolean(missing=False)
+        stream = marshmallow.fields.Boolean(missing=False)
+
+    class CommandExportSchema(CommandQuerySchema):
+        limit = marshmallow.fields.Integer(missing=None,
+            validate=marshmallow.validate.Range(min=1))
+
+    class CommandRequestSchema(Schema):
+        command = marshmallow.fields.String(required=True)
+        params = marshmallow.fields.Dict(required=True)
+        asynchronous = marshmallow.fields.Boolean(default=False, missing=False)
+
+
+class BatchController(GatewayController):
+    """Accepts an array of commands, which are persisted in a single
+    transaction. The response holds an array with the outcome of each
+    command, in the same format as the responses of
+    :class:`GatewayController`, plus the HTTP status code of the item.
+
+    An item may carry its own idempotency key in the ``idempotency_key``
+    field. The items with a key are issued one at a time, outside of the
+    transaction persisting the other items, and retried items receive
+    the response of their first execution. The ``Idempotency-Key``
+    header is rejected, because a single key can not identify the
+    commands of a batch.
+    """
+    max_batch_size = 10000
+
+    @property
+    def command_schema(self):
+        return self.get_schema(self.BatchItemSchema)
+
+    def post(self, request, **kwargs):
+        results, commands = self.parse_batch(request)
+        try:
+            issued = self.gateway.issue_batch([x for i, x in commands])
+        except ISSUE_ERRORS as e:
+            status, result = describe_error(e)
+            return self.render_to_response(result, status=status,
+                headers=get_error_headers(e))
+        return self.render_batch(results, commands, issued)
+
+    def parse_batch(self, request):
+        """Parse the commands in the request body.
+
+        Returns:
+            a tuple containing a list with the outcome of each item,
+            holding ``None`` for items that were parsed, and a list of
+            ``(index, command)`` tuples.
+        """
+        if 'Idempotency-Key' in request.headers:
+            raise self.UnprocessableEntity({
+                'hint': "Set the idempotency key of each command in its "
+                    "idempotency_key field instead of the Idempotency-Key header."
+            })
+        items = self.decode(request)
+        if not isinstance(items, list):
+            raise BadRequest({'hint': "Expected an array of commands."})
+        if len(items) > self.max_batch_size:
+            raise BadRequest({
+                'hint': "A batch may contain at most {0} commands."\
+                    .format(self.max_batch_size)
+            })
+
+        results = [None] * len(items)
+        commands = []
+        for i, data in enumerate(items):
+            try:
+                commands.append((i, self.load_command(request, data)))
+            except self.UnprocessableEntity as e:
+                # Reported like the commands rejected by their handler.
+                results[i] = describe_error(self.CommandRejected(
+                    reason=e.context.get('hint'), context=e.context.get('context')))
+            except self.CommandParsingError as e:
+                results[i] = describe_error(e)
+        return results, commands
+
+    def render_batch(self, results, commands, issued):
+        for (i, command), result in zip(commands, issued):
+            results[i] = describe_error(result)\
+                if isinstance(result, Exception)\
+                else self.describe_result(result)
+
+        # Each error is a new dictionary, so the status is added in place.
+        for i, (status, result) in enumerate(results):
+            if isinstance(result, CommandResponseDTO):
+                result = describe_response(result)
+            result['status'] = status
+            results[i] = result
+        return self.render_to_response(results, status=200)
+
+    class BatchItemSchema(GatewayController.CommandRequestSchema):
+        idempotency_key = marshmallow.fields.String(
+            validate=marshmallow.validate.Length(min=1, max=255))
+
+
+class CommandStatusController(GatewayController):
+    """Returns a single command, including the result returned by its
+    handler. If the ``wait`` parameter is given, the response is
+    delayed until the command has finished or `wait` seconds have
+    elapsed.
+    """
+
+    @property
+    def wait_schema(self):
+        return self.get_schema(self.CommandWaitSchema)
+
+    def get(self, request, command_id, **kwargs):
+        wait = self.parse_query(request, self.wait_schema)['wait']
+        return self.render_command(self.gateway.get_command(command_id, wait=wait))
+
+    def render_command(self, command):
+        if command is None:
+            return self.render_to_response({
+                'code': 'NOT_FOUND',
+                'message': "No such command."
+            }, status=404)
+        return self.render_to_response(command)
+
+    class CommandWaitSchema(Schema):
+        wait = marshmallow.fields.Float(missing=0,
+            validate=marshmallow.validate.Range(min=0, max=60))
+
+
+class MetricsController(GatewayController):
+    """Exposes the latency histograms collected by the
+    ``GatewayMetrics`` registry, and gauges describing the command
+    runner, in the Prometheus text exposition format. Responds with
+    404 if the metrics are disabled.
+    """
+
+    def get(self, request, **kwargs):
+        if not self.metrics.enabled:
+            return self.response_class("", status=404,
+                content_type=self.default_content_type)
+        return self.response_class(self.metrics.render(self.get_gauges()),
+            status=200, content_type=self.metrics.content_type)
+
+    def get_gauges(self):
+        gauges = {
+            'gateway_runner_' + name: value
+            for name, value in self.gateway.get_metrics().items()
+        }
+        gauges['gateway_threads'] = threading.active_count()
+        return gauges
+
+
+class GatewayApplication:
+    urls = Map([
+        Rule('/v1/command', methods=['POST','GET'], endpoint='command'),
+        Rule('/v1/command/<int:command_id>', methods=['GET'], endpoint='command_status'),
+        Rule('/v1/commands:batch', methods=['POST'], endpoint='batch'),
+        Rule('/metrics', methods=['GET'], endpoint='metrics')
+    ])
+
+    endpoints = {
+        'command': GatewayController.as_view(),
+        'command_status': CommandStatusController.as_view(),
+        'batch': BatchController.as_view(),
+        'metrics': MetricsController.as_view(),
+    }
+    response_class = Response
+    store = ioc.instance('CommandStore')
+    recovery = ioc.instance('CommandRecovery')
+    retention = ioc.instance('CommandRetention')
+    codecs = ioc.instance('GatewayCodecs')
+
+    def __init__(self, ioc_config=None, debug=False):
+        self.ioc_config = ioc_config
+        self.debug = debug
+        self.recovery.start()
+        self.retention.start()
+
+    def __call__(self, environ, start_response):
+        request = self.request_class(environ)
+        request.codecs = self.codecs
+        response = self.process_request(request)
+        response.call_on_close(self.store.release)
+        return response(environ, start_response)
+
+    def process_request(self, request):
+        adapter = self.urls.bind_to_environ(request.environ)
+        try:
+            endpoint, values = adapter.match()
+            response = self.invoke_handler(request, endpoint, values)
+        except HTTPException as e:
+            response = self.response_class("", content_type="application/json", status=e.code)
+
+        return response
+
+    def invoke_handler(self, request, endpoint, values):
+        handler = self.endpoints[endpoint]
+        return handler(request, **values)
+
+    class request_class(Request, IRequest):
+        issuer = 100
+        authenticated_by = 100
+
+        #: The :class:`~gateway.codec.CodecRegistry` of the application.
+        codecs = None
+
+        @property
+        def json(self):
+            try:
+                data = json.loads(self.data)
+            except Exception:
+                raise BadRequest
+            return data
+
+        @property
+        def payload(self):
+            """The request body, decoded with the codec registered for
+            its ``Content-Type``.
+            """
+            if self.codecs is None:
+                return self.json
+            try:
+                data = self.codecs.get(self.mimetype).decode(self.data)
+            except Exception:
+                raise BadRequest
+            return data
+
+        def get_request_method(self):
+            return self.method
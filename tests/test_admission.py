@@ -0,0 +1,87 @@
+import pytest
+
+from gateway import admission
+from gateway.admission import AdmissionControl
+from gateway.admission import TokenBucket
+from gateway.dto import CommandRequestDTO
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def create_command(issuer=1, command_type='test'):
+    return CommandRequestDTO(None, command_type, False, {}, issuer, issuer,
+        '127.0.0.1')
+
+
+def test_bucket_allows_a_burst():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for i in range(3)] == [0, 0, 0]
+    assert bucket.take(0) == pytest.approx(0.5)
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    for i in range(3):
+        bucket.take(0)
+    assert bucket.take(0.25) == pytest.approx(0.25)
+    assert bucket.take(0.5) == 0
+    assert bucket.take(0.5) == pytest.approx(0.5)
+
+
+def test_bucket_does_not_refill_past_its_burst():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    bucket.take(0)
+    assert [bucket.take(100) for i in range(3)] == [0, 0, 0]
+    assert bucket.take(100) > 0
+
+
+def test_issuer_limit(clock):
+    control = AdmissionControl(issuer_rate=1, issuer_burst=2)
+    control.admit(create_command())
+    control.admit(create_command())
+    with pytest.raises(control.RateLimited) as e:
+        control.admit(create_command())
+    assert e.value.context == {'retry_after': 1}
+
+    # Other issuers have buckets of their own.
+    control.admit(create_command(issuer=2))
+
+    clock[0] += 1
+    control.admit(create_command())
+
+
+def test_command_type_limit_refunds_the_issuer(clock):
+    control = AdmissionControl(issuer_rate=1, issuer_burst=1,
+        command_rates={'test': 1})
+    control.admit(create_command(issuer=1))
+    with pytest.raises(control.RateLimited):
+        control.admit(create_command(issuer=2))
+
+    # The rejected command did not take the token of issuer 2.
+    control.admit(create_command(issuer=2, command_type='other'))
+
+
+def test_disabled_by_default(clock):
+    control = AdmissionControl()
+    for i in range(1000):
+        control.admit(create_command())
+    assert not control.issuers
+
+
+def test_issuer_buckets_are_bounded(clock):
+    control = AdmissionControl(issuer_rate=1, max_buckets=100)
+    for issuer in range(1000):
+        control.admit(create_command(issuer=issuer))
+    assert len(control.issuers) == 100
+    assert list(control.issuers) == list(range(900, 1000))
+
+    # Recently seen issuers are kept.
+    with pytest.raises(control.RateLimited):
+        control.admit(create_command(issuer=900))
+    control.admit(create_command(issuer=1000))
+    assert 900 in control.issuers and 901 not in control.issuers
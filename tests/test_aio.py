@@ -0,0 +1,228 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+
+from gateway.aio import AsyncCommandRunner
+from gateway.aio import AsyncCommandStore
+from gateway.dto import CommandRequestDTO
+from gateway.memory import MemoryCommandStore
+from gateway.policy import ExecutionPolicy
+
+
+class Handler:
+    """Records the start and the end of the commands, which sleep for
+    the number of seconds given by their ``delay`` parameter.
+    """
+    policy = ExecutionPolicy()
+    partition_key = 'key'
+    lane = None
+
+    def __init__(self, lane=None):
+        self.lane = lane
+        self.events = []
+
+    def get_partition_key(self, params):
+        return params.get(self.partition_key)
+
+    async def run(self, command):
+        self.events.append(('start', command.params['name']))
+        await asyncio.sleep(command.params.get('delay', 0))
+        self.events.append(('end', command.params['name']))
+        return None, command.params['name'], False
+
+
+class Handlers:
+
+    def __init__(self, handler, **handlers):
+        self.handler = handler
+        self.handlers = handlers
+
+    def get(self, command_type):
+        return self.handlers.get(command_type, self.handler)
+
+
+@pytest.fixture
+def store():
+    return MemoryCommandStore(capacity=1000)
+
+
+def create_command(store, name, asynchronous=True, issuer=1,
+    command_type='test', **params):
+    params['name'] = name
+    command = CommandRequestDTO(None, command_type, asynchronous, params,
+        issuer, issuer, '127.0.0.1')
+    store.persist(command)
+    return command
+
+
+def run(func):
+    async def main():
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            return await func(executor)
+    return asyncio.run(main())
+
+
+async def wait(runner):
+    pools = [runner.pool] + list(runner.lanes.values())
+    while runner.tasks or any(x.busy or x.queue.qsize() for x in pools):
+        await asyncio.sleep(0.001)
+
+
+def test_commands_with_the_same_key_run_in_order(store):
+    handler = Handler()
+
+    async def main(executor):
+        runner = AsyncCommandRunner(Handlers(handler),
+            AsyncCommandStore(store, executor), executor, partitioned=True)
+        for name, key, delay in [('a1', 'a', 0.05), ('a2', 'a', 0),
+        ('b1', 'b', 0), ('a3', 'a', 0.01)]:
+            await runner.execute(create_command(store, name, key=key,
+                delay=delay))
+        # Synchronous commands wait for the commands issued before.
+        result = await runner.execute(create_command(store, 'a4',
+            asynchronous=False, key='a'))
+        await wait(runner)
+        return runner, result
+
+    runner, result = run(main)
+    assert result[1] == 'a4'
+    assert runner.partitions == {}
+    ends = [x for event, x in handler.events if event == 'end']
+    assert ends == ['b1', 'a1', 'a2', 'a3', 'a4']
+    assert handler.events.index(('start', 'a2'))\
+        > handler.events.index(('end', 'a1'))
+
+
+def test_commands_are_not_ordered_unless_partitioned(store):
+    handler = Handler()
+
+    async def main(executor):
+        runner = AsyncCommandRunner(Handlers(handler),
+            AsyncCommandStore(store, executor), executor)
+        await runner.execute(create_command(store, 'a1', key='a', delay=0.05))
+        await runner.execute(create_command(store, 'a2', key='a'))
+        await wait(runner)
+
+    run(main)
+    assert [x for event, x in handler.events if event == 'end'] == ['a2', 'a1']
+
+
+def test_failed_commands_do_not_stop_their_partition(store):
+
+    class FailingHandler(Handler):
+
+        async def run(self, command):
+            if command.params['name'] == 'a1':
+                raise ValueError
+            return await super(FailingHandler, self).run(command)
+
+    handler = FailingHandler()
+
+    async def main(executor):
+        runner = AsyncCommandRunner(Handlers(handler),
+            AsyncCommandStore(store, executor), executor, partitioned=True)
+        first = create_command(store, 'a1', key='a')
+        await runner.execute(first)
+        await runner.execute(create_command(store, 'a2', key='a'))
+        await wait(runner)
+        return first
+
+    first = run(main)
+    assert handler.events == [('start', 'a2'), ('end', 'a2')]
+    assert store.get_command(first.id).status == store.STATE_FAILED
+
+
+def test_reserved_lanes_are_not_delayed_by_other_commands(store):
+    low = Handler()
+    high = Handler(lane='high')
+
+    async def main(executor):
+        runner = AsyncCommandRunner(Handlers(low, high=high),
+            AsyncCommandStore(store, executor), executor, workers=2,
+            lanes={'high': 1})
+        for i in range(20):
+            await runner.execute(create_command(store, 'low', delay=0.02))
+        await runner.execute(create_command(store, 'high',
+            command_type='high'))
+        await asyncio.sleep(0.01)
+        # The high priority command ran while the others were queued.
+        assert high.events == [('start', 'high'), ('end', 'high')]
+        metrics = runner.get_metrics()
+        await wait(runner)
+        runner.shutdown()
+        return metrics
+
+    metrics = run(main)
+    assert len(low.events) == 40
+    assert metrics['workers_busy'] == 2
+    assert metrics['queue_depth'] == 18
+    assert metrics['lane_high_queue_depth'] == 0
+
+
+def test_full_queues_reject_commands_of_their_lane_only(store):
+    low = Handler()
+    high = Handler(lane='high')
+
+    async def main(executor):
+        runner = AsyncCommandRunner(Handlers(low, high=high),
+            AsyncCommandStore(store, executor), executor, max_pending=2,
+            workers=1, lanes={'high': 1})
+        for i in range(2):
+            await runner.execute(create_command(store, 'low', delay=0.01))
+        with pytest.raises(runner.UpstreamFailure):
+            await runner.execute(create_command(store, 'low'))
+        await runner.execute(create_command(store, 'high',
+            command_type='high'))
+        await wait(runner)
+
+    run(main)
+    assert len(low.events) == 4
+    assert len(high.events) == 2
+
+
+def test_synchronous_handlers_of_a_lane_run_on_its_threads(store):
+
+    class SynchronousHandler(Handler):
+
+        def run(self, command):
+            self.events.append(threading.current_thread().name)
+            return None, None, False
+
+    low = SynchronousHandler()
+    high = SynchronousHandler(lane='high')
+
+    async def main(executor):
+        runner = AsyncCommandRunner(Handlers(low, high=high),
+            AsyncCommandStore(store, executor), executor, lanes={'high': 1})
+        await runner.execute(create_command(store, 'low'))
+        await runner.execute(create_command(store, 'high',
+            command_type='high'))
+        await wait(runner)
+        runner.shutdown()
+
+    run(main)
+    assert high.events[0].startswith('gateway-lane-high')
+    assert not low.events[0].startswith('gateway-lane-high')
+
+
+@pytest.mark.parametrize('weights,expected', [
+    (None, ['1'] * 7 + ['2'] * 2),
+    ({}, ['1', '2', '1', '2', '1', '1', '1', '1', '1']),
+])
+def test_fair_queuing_across_issuers(store, weights, expected):
+    handler = Handler()
+
+    async def main(executor):
+        runner = AsyncCommandRunner(Handlers(handler),
+            AsyncCommandStore(store, executor), executor, workers=1,
+            weights=weights)
+        for i in range(7):
+            await runner.execute(create_command(store, '1', issuer=1))
+        for i in range(2):
+            await runner.execute(create_command(store, '2', issuer=2))
+        await wait(runner)
+
+    run(main)
+    assert [x for event, x in handler.events if event == 'end'] == expected
@@ -0,0 +1,94 @@
+import gc
+import json
+import tracemalloc
+
+import pytest
+
+pytest.importorskip('werkzeug')
+pytest.importorskip('libsousou')
+
+from werkzeug.test import EnvironBuilder
+
+from gateway.dto import CommandRequestDTO
+from gateway.dto import CommandResponseDTO
+from gateway.metrics import NullMetricsRegistry
+from gateway.wsgi import GatewayApplication
+from gateway.wsgi import GatewayController
+
+
+#: The number of bytes one request may allocate while it is handled by
+#: :meth:`GatewayController.post()`, including the request body, the
+#: decoded command and the response; about 1.5 times the peak measured
+#: with Werkzeug 3.
+MAX_ALLOCATED = 96 * 1024
+
+#: The number of bytes that the handled requests may keep allocated.
+MAX_RETAINED = 4 * 1024
+
+BODY = json.dumps({
+    'command': 'test',
+    'params': {'foo': 1, 'bar': 'baz'},
+    'asynchronous': False
+})
+
+
+class Gateway:
+    """Returns the same response to every command."""
+
+    def __init__(self):
+        self.response = CommandResponseDTO(1, 1, {'foo': 1}, True, True, None)
+
+    def issue(self, command):
+        return self.response
+
+
+def create_request():
+    builder = EnvironBuilder(path='/v1/command', method='POST', data=BODY,
+        content_type='application/json')
+    return GatewayApplication.request_class(builder.get_environ())
+
+
+def post(request):
+    controller = GatewayController()
+    controller.gateway = Gateway()
+    controller.metrics = NullMetricsRegistry()
+    response = controller.post(request)
+    assert response.status_code == 201
+    return controller
+
+
+def test_schemas_are_reused_across_requests():
+    first = post(create_request())
+    second = post(create_request())
+    assert first.command_schema is second.command_schema
+
+
+def test_command_dto_has_no_instance_dict():
+    command = CommandRequestDTO(None, 'test', False, {}, 1, 1, '127.0.0.1')
+    assert not hasattr(command, '__dict__')
+
+
+def test_post_allocations_are_bounded():
+    # The first request creates the schemas of the thread.
+    post(create_request())
+    tracemalloc.start()
+    try:
+        allocated = 0
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        for i in range(100):
+            request = create_request()
+            tracemalloc.reset_peak()
+            before, peak = tracemalloc.get_traced_memory()
+            post(request)
+            after, peak = tracemalloc.get_traced_memory()
+            allocated = max(allocated, peak - before)
+            del request
+        # The requests leave reference cycles behind.
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - current
+    finally:
+        tracemalloc.stop()
+
+    assert allocated <= MAX_ALLOCATED
+    assert retained <= MAX_RETAINED
@@ -0,0 +1,84 @@
+import os
+
+from gateway.archive import CommandArchive
+from gateway.memory import CommandRecord
+
+
+def create_record(command_id, timestamp=None, status='DONE', issuer=1):
+    return CommandRecord(command_id, 'test', timestamp or command_id * 1000,
+        issuer, 0, '127.0.0.1', '{"foo": 1}', status,
+        idempotency_key='key-{0}'.format(command_id),
+        result='{"ident": null, "result": null}')
+
+
+def test_archived_commands_are_read_back(tmpdir):
+    archive = CommandArchive(str(tmpdir), fsync=False)
+    records = [create_record(i) for i in range(1, 11)]
+    archive.append(records[:5])
+    archive.append(records[5:])
+
+    for record in records:
+        assert archive.get_command(record.command_id).as_dict()\
+            == record.as_dict()
+    assert archive.get_command(11) is None
+    assert [x.command_id for x in archive.get_commands()]\
+        == list(range(10, 0, -1))
+
+
+def test_archive_is_reopened(tmpdir):
+    archive = CommandArchive(str(tmpdir), segment_size=4, fsync=False)
+    for i in range(1, 10, 3):
+        archive.append([create_record(x) for x in range(i, i + 3)])
+
+    reopened = CommandArchive(str(tmpdir), segment_size=4, fsync=False)
+    assert [x.command_id for x in reopened.get_commands()]\
+        == list(range(9, 0, -1))
+    reopened.append([create_record(10)])
+    assert archive.get_command(10).command_id == 10
+    assert len({x.segment for x in archive.get_batches()}) == 2
+
+
+def test_archived_commands_are_filtered(tmpdir):
+    archive = CommandArchive(str(tmpdir), fsync=False)
+    archive.append([create_record(i, status='FAILED' if i % 2 else 'DONE',
+        issuer=i % 3) for i in range(1, 21)])
+
+    assert [x.command_id for x in archive.get_commands(cursor=6, limit=3)]\
+        == [5, 4, 3]
+    assert [x.command_id for x in archive.get_commands(status='FAILED', limit=3)]\
+        == [19, 17, 15]
+    assert [x.command_id for x in archive.get_commands(issuer=0)]\
+        == [18, 15, 12, 9, 6, 3]
+    assert [x.command_id for x in archive.get_commands(since=5000, until=8000)]\
+        == [7, 6, 5]
+
+
+def test_late_commands_are_listed_in_order(tmpdir):
+    # A command that finished late is archived after newer ones.
+    archive = CommandArchive(str(tmpdir), fsync=False)
+    archive.append([create_record(i) for i in (1, 2, 4, 5)])
+    archive.append([create_record(3)])
+    assert [x.command_id for x in archive.get_commands(limit=3)] == [5, 4, 3]
+
+
+def test_torn_index_entries_are_skipped(tmpdir):
+    archive = CommandArchive(str(tmpdir), fsync=False)
+    archive.append([create_record(1)])
+    with open(os.path.join(str(tmpdir), archive.index_name), 'a') as f:
+        f.write('{"segment": "commands-')
+
+    reopened = CommandArchive(str(tmpdir), fsync=False)
+    reopened.append([create_record(2)])
+    assert [x.command_id for x in reopened.get_commands()] == [2, 1]
+    assert [x.command_id for x in CommandArchive(str(tmpdir)).get_commands()]\
+        == [2, 1]
+
+
+def test_exclusive_lock(tmpdir):
+    archive = CommandArchive(str(tmpdir), fsync=False)
+    with archive.exclusive() as acquired:
+        assert acquired
+        with CommandArchive(str(tmpdir)).exclusive() as other:
+            assert not other
+    with CommandArchive(str(tmpdir)).exclusive() as acquired:
+        assert acquired
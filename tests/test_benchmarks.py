@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from benchmarks import compare
+
+
+def write_report(tmpdir, name, rps, peak_kb):
+    path = tmpdir.join(name)
+    path.write(json.dumps({
+        'results': [{'scenario': 'issue', 'concurrency': 4, 'rps': rps,
+            'p99_ms': 2.0}],
+        'allocations': [{'scenario': 'post', 'peak_kb': peak_kb,
+            'retained_blocks': 10}]
+    }))
+    return str(path)
+
+
+@pytest.mark.parametrize('peak_kb,status', [(50.0, 0), (54.0, 0), (56.0, 1)])
+def test_compare_fails_on_allocation_growth(tmpdir, capsys, peak_kb, status):
+    baseline = write_report(tmpdir, 'baseline.json', 1000.0, 50.0)
+    candidate = write_report(tmpdir, 'candidate.json', 1100.0, peak_kb)
+    assert compare.main([baseline, candidate]) == status
+    out = capsys.readouterr().out
+    assert '+10.0%' in out
+    assert 'post' in out
+
+
+def test_change_without_baseline():
+    assert compare.change(0, 1) == "n/a"
+    assert compare.change(2, 1) == "-50.0%"
@@ -0,0 +1,72 @@
+from gateway.cache import ListingCache
+
+
+def create_page(*command_ids):
+    return [{'command_id': x} for x in command_ids]
+
+
+def put(cache, key, version, command_ids, cursor=None, limit=3):
+    cache.put(key, version, create_page(*command_ids), 'etag', cursor, limit)
+
+
+def test_invalidate_evicts_the_pages_covering_the_command():
+    cache = ListingCache()
+    put(cache, 'head', cache.version, [30, 29, 28])
+    put(cache, 'second', cache.version, [27, 26, 25], cursor=28)
+    put(cache, 'last', cache.version, [24, 23], cursor=25)
+
+    cache.invalidate(26)
+    assert cache.get('second') is None
+    assert cache.get('head') is not None
+    assert cache.get('last') is not None
+
+    # New commands appear on the first page only.
+    cache.invalidate(31)
+    assert cache.get('head') is None
+    assert cache.get('last') is not None
+
+    cache.invalidate(1)
+    assert cache.get('last') is None
+    assert cache.entries == {}
+    assert cache.heads.bounds == cache.tails.bounds == []
+
+
+def test_page_is_stored_despite_changes_outside_of_its_range():
+    cache = ListingCache()
+    version = cache.version
+    cache.invalidate(10)
+    put(cache, 'second', version, [27, 26, 25], cursor=28)
+    assert cache.get('second') is not None
+
+
+def test_page_read_while_a_covered_command_changed_is_discarded():
+    cache = ListingCache()
+    version = cache.version
+    cache.invalidate(26)
+    put(cache, 'second', version, [27, 26, 25], cursor=28)
+    put(cache, 'head', version, [30, 29, 28])
+    assert cache.get('second') is None
+    assert cache.get('head') is not None
+
+    # The page is stored if it was read after the change.
+    put(cache, 'second', cache.version, [27, 26, 25], cursor=28)
+    assert cache.get('second') is not None
+
+
+def test_page_read_before_forgotten_changes_is_discarded():
+    cache = ListingCache(history=2)
+    version = cache.version
+    for command_id in range(3):
+        cache.invalidate(command_id)
+    put(cache, 'second', version, [27, 26, 25], cursor=28)
+    assert cache.get('second') is None
+
+
+def test_least_recently_used_pages_are_evicted():
+    cache = ListingCache(size=2)
+    put(cache, 'a', cache.version, [9, 8, 7])
+    put(cache, 'b', cache.version, [6, 5, 4], cursor=7)
+    cache.get('a')
+    put(cache, 'c', cache.version, [3, 2, 1], cursor=4)
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.tails.bounds == [4]
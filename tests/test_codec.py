@@ -0,0 +1,36 @@
+import pytest
+
+from gateway.codec import FastJSONCodec
+from gateway.codec import JSONCodec
+from gateway.codec import MessagePackCodec
+from gateway.dto import CommandResponseDTO
+from gateway.dto import describe_response
+
+
+RESPONSES = [
+    CommandResponseDTO(1, None, None, True, True, False),
+    CommandResponseDTO(2, 'ident', {'foo': [1, 2.5, None], 'bar': "é"},
+        True, False, False),
+    CommandResponseDTO(2 ** 70, 3, ['x'], False, False, False),
+]
+
+
+def get_codecs():
+    codecs = [JSONCodec(), JSONCodec(4)]
+    for codec_class in (FastJSONCodec, MessagePackCodec):
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            pass
+    return codecs
+
+
+@pytest.mark.parametrize('codec', get_codecs(),
+    ids=lambda x: '{0}-{1}'.format(type(x).__name__, getattr(x, 'indent', None)))
+@pytest.mark.parametrize('response', RESPONSES, ids=lambda x: str(x.command_id))
+def test_responses_are_encoded_from_their_fields(codec, response):
+    try:
+        expected = codec.encode(describe_response(response))
+    except OverflowError:
+        pytest.skip("Integer not supported by the codec.")
+    assert codec.encode_response(response) == expected
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from gateway import Gateway
+from gateway.dto import CommandRequestDTO
+from gateway.memory import MemoryCommandStore
+
+
+def create_command(asynchronous=True):
+    return CommandRequestDTO(None, 'test', asynchronous, {'foo': 1}, 1, 1,
+        '127.0.0.1')
+
+
+def create_gateway(store, **kwargs):
+    gateway = Gateway(**kwargs)
+    gateway.store = store
+    gateway.archive = MemoryCommandStore(capacity=10)
+    return gateway
+
+
+@pytest.fixture
+def store():
+    store = MemoryCommandStore(capacity=100)
+    for i in range(10):
+        store.persist(create_command())
+    return store
+
+
+def test_get_command_returns_unfinished_commands_without_wait(store):
+    gateway = create_gateway(store)
+    command = gateway.get_command(1)
+    assert command['status'] == store.STATE_PENDING
+    assert command['result'] is None
+    assert gateway.get_command(1000) is None
+
+
+def test_get_command_waits_for_the_command_to_finish(store):
+    gateway = create_gateway(store)
+    gateway.poll_interval = 10
+    threading.Timer(0.05, store.set_status, args=(1, store.STATE_DONE),
+        kwargs={'result': {'ident': 'a', 'result': [1]}}).start()
+    started = time.monotonic()
+    command = gateway.get_command(1, wait=5)
+
+    # Woken by the status change, not by polling.
+    assert time.monotonic() - started < 1
+    assert command['status'] == store.STATE_DONE
+    assert (command['ident'], command['result']) == ('a', [1])
+    assert store.notifier.listeners == {}
+
+
+def test_get_command_returns_after_wait(store):
+    gateway = create_gateway(store)
+    gateway.poll_interval = 0.01
+    started = time.monotonic()
+    assert gateway.get_command(1, wait=0.05)['status'] == store.STATE_PENDING
+    assert time.monotonic() - started >= 0.05
+
+
+def test_iter_commands_yields_the_listing(store):
+    gateway = create_gateway(store)
+    assert list(gateway.iter_commands(limit=None))\
+        == gateway.get_commands(limit=None)
+    assert [x['command_id'] for x in gateway.iter_commands(cursor=5)]\
+        == [4, 3, 2, 1]
+
+
+def test_pages_are_cached_until_they_change(store):
+    gateway = create_gateway(store, listing_cache_size=10, listing_cache_ttl=60)
+    head, etag = gateway.get_page(limit=3)
+    tail, tail_etag = gateway.get_page(cursor=5, limit=3)
+    assert [x['command_id'] for x in head] == [10, 9, 8]
+    assert gateway.get_page(limit=3)[0] is head
+
+    # A new command only changes the first page.
+    store.persist(create_command())
+    commands, changed = gateway.get_page(limit=3)
+    assert [x['command_id'] for x in commands] == [11, 10, 9]
+    assert changed != etag
+    assert gateway.get_page(cursor=5, limit=3)[0] is tail
+
+    # A status change changes the page holding the command.
+    store.set_status(3, store.STATE_DONE)
+    commands, changed = gateway.get_page(cursor=5, limit=3)
+    assert commands is not tail
+    assert changed != tail_etag
+    assert gateway.get_page(limit=3)[1] != etag
+
+
+def test_etag_identifies_the_content_of_the_page(store):
+    gateway = create_gateway(store)
+    commands, etag = gateway.get_page(limit=3)
+    assert gateway.get_page(limit=3)[1] == etag
+    store.set_status(9, store.STATE_FAILED)
+    assert gateway.get_page(limit=3)[1] != etag
@@ -0,0 +1,266 @@
+import asyncio
+import concurrent.futures
+
+import pytest
+
+from gateway import Gateway
+from gateway.admission import AdmissionControl
+from gateway.aio import AsyncCommandRunner
+from gateway.aio import AsyncCommandStore
+from gateway.aio import AsyncGateway
+from gateway.dto import CommandRequestDTO
+from gateway.memory import MemoryCommandStore
+from gateway.metrics import NullMetricsRegistry
+from gateway.mixins import ICommandProcessor
+from gateway.policy import ExecutionPolicy
+
+
+class Handlers:
+
+    def validate(self, command):
+        return command
+
+
+class Runner(ICommandProcessor):
+    """Returns the parameters of the commands as their result, or
+    raises the exceptions queued in :attr:`failures`.
+    """
+
+    def __init__(self):
+        self.executed = []
+        self.failures = []
+
+    def execute(self, command):
+        self.executed.append(command.id)
+        if self.failures:
+            raise self.failures.pop(0)
+        return command.id, dict(command.params), True, True, False
+
+
+def create_gateway(store, runner):
+    gateway = Gateway()
+    gateway.store = store
+    gateway.runner = runner
+    gateway.handlers = Handlers()
+    gateway.metrics = NullMetricsRegistry()
+    gateway.admission = AdmissionControl()
+    return gateway
+
+
+def create_command(key, issuer=1, **params):
+    return CommandRequestDTO(None, 'test', False, params or {'foo': 1},
+        issuer, issuer, '127.0.0.1', key)
+
+
+@pytest.fixture
+def store():
+    return MemoryCommandStore(capacity=100)
+
+
+@pytest.fixture
+def runner():
+    return Runner()
+
+
+def test_retry_receives_the_response_of_the_first_execution(store, runner):
+    gateway = create_gateway(store, runner)
+    first = gateway.issue(create_command('a'))
+    assert gateway.issue(create_command('a')) == first
+    assert runner.executed == [first.command_id]
+
+
+def test_replay_from_the_store_returns_the_stored_result(store, runner):
+    first = create_gateway(store, runner).issue(create_command('a', foo=2))
+
+    # Another gateway does not have the response in its cache.
+    replayed = create_gateway(store, runner).issue(create_command('a', foo=2))
+    assert (replayed.command_id, replayed.ident, replayed.result, replayed.done)\
+        == (first.command_id, first.ident, first.result, True)
+    assert runner.executed == [first.command_id]
+
+
+def test_retry_after_upstream_failure_is_executed(store, runner):
+    gateway = create_gateway(store, runner)
+    runner.failures.append(gateway.UpstreamFailure())
+    with pytest.raises(gateway.UpstreamFailure):
+        gateway.issue(create_command('a'))
+
+    response = gateway.issue(create_command('a'))
+    assert response.done
+    assert len(runner.executed) == 2
+    assert store.get_idempotent(1, 'a').command_id == response.command_id
+
+    # Other gateways replay the successful execution.
+    assert create_gateway(store, runner).issue(create_command('a')).command_id\
+        == response.command_id
+
+
+def test_retry_after_fatal_failure_is_not_executed(store, runner):
+    gateway = create_gateway(store, runner)
+    runner.failures.append(gateway.CommandFailed())
+    with pytest.raises(gateway.CommandFailed):
+        gateway.issue(create_command('a'))
+    with pytest.raises(gateway.CommandFailed):
+        create_gateway(store, runner).issue(create_command('a'))
+    assert len(runner.executed) == 1
+
+
+def test_key_reused_for_another_command_is_rejected(store, runner):
+    gateway = create_gateway(store, runner)
+    gateway.issue(create_command('a', foo=1))
+    with pytest.raises(gateway.CommandRejected):
+        gateway.issue(create_command('a', foo=2))
+    with pytest.raises(gateway.CommandRejected):
+        create_gateway(store, runner).issue(create_command('a', foo=2))
+    assert len(runner.executed) == 1
+
+
+def test_keys_are_scoped_to_the_issuer(store, runner):
+    gateway = create_gateway(store, runner)
+    first = gateway.issue(create_command('a', issuer=1))
+    second = gateway.issue(create_command('a', issuer=2))
+    assert first.command_id != second.command_id
+    assert len(runner.executed) == 2
+
+
+class AsyncHandler:
+    lane = None
+    policy = ExecutionPolicy()
+
+    def __init__(self):
+        self.executed = []
+
+    async def run(self, command):
+        self.executed.append(command.id)
+        return command.id, dict(command.params), True
+
+
+class AsyncHandlers(Handlers):
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def get(self, command_type):
+        return self.handler
+
+
+def test_async_commands_with_a_key_run_on_the_event_loop(store, runner):
+    handler = AsyncHandler()
+    gateway = create_gateway(store, runner)
+    gateway.handlers = AsyncHandlers(handler)
+
+    async def issue():
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            async_store = AsyncCommandStore(store, executor)
+            async_runner = AsyncCommandRunner(gateway.handlers, async_store,
+                executor)
+            async_gateway = AsyncGateway(gateway, async_store, async_runner,
+                executor)
+            return [await async_gateway.issue(create_command('a'))
+                for i in range(2)]
+
+    first, second = asyncio.run(issue())
+    assert first == second
+    assert first.result == {'foo': 1}
+    assert handler.executed == [first.command_id]
+    assert runner.executed == []
+
+
+class BlockingAsyncHandler(AsyncHandler):
+    """Runs the commands once :attr:`released` is set."""
+
+    def __init__(self):
+        super(BlockingAsyncHandler, self).__init__()
+        self.started = asyncio.Event()
+        self.released = asyncio.Event()
+
+    async def run(self, command):
+        self.started.set()
+        await self.released.wait()
+        return await super(BlockingAsyncHandler, self).run(command)
+
+
+def test_concurrent_async_commands_with_a_key_wait_for_the_first(store, runner):
+    gateway = create_gateway(store, runner)
+
+    async def issue():
+        handler = BlockingAsyncHandler()
+        gateway.handlers = AsyncHandlers(handler)
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            async_store = AsyncCommandStore(store, executor)
+            async_runner = AsyncCommandRunner(gateway.handlers, async_store,
+                executor)
+            async_gateway = AsyncGateway(gateway, async_store, async_runner,
+                executor)
+            first = asyncio.ensure_future(
+                async_gateway.issue(create_command('a')))
+            await handler.started.wait()
+            followers = [asyncio.ensure_future(
+                async_gateway.issue(create_command('a'))) for i in range(3)]
+            other = asyncio.ensure_future(
+                async_gateway.issue(create_command('a', foo=2)))
+            await asyncio.sleep(0.01)
+            assert not any(x.done() for x in followers)
+            handler.released.set()
+            responses = await asyncio.gather(first, *followers)
+            with pytest.raises(gateway.CommandRejected):
+                await other
+            assert async_gateway.inflight == {}
+            return handler, responses
+
+    handler, responses = asyncio.run(issue())
+    assert all(x == responses[0] for x in responses)
+    assert responses[0].done and responses[0].result == {'foo': 1}
+    assert handler.executed == [responses[0].command_id]
+
+
+def test_failure_of_the_first_async_command_is_shared(store, runner):
+    gateway = create_gateway(store, runner)
+
+    class FailingHandler(BlockingAsyncHandler):
+
+        async def run(self, command):
+            await super(FailingHandler, self).run(command)
+            raise ICommandProcessor.UpstreamFailure()
+
+    async def issue():
+        handler = FailingHandler()
+        gateway.handlers = AsyncHandlers(handler)
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            async_store = AsyncCommandStore(store, executor)
+            async_runner = AsyncCommandRunner(gateway.handlers, async_store,
+                executor)
+            async_gateway = AsyncGateway(gateway, async_store, async_runner,
+                executor)
+            first = asyncio.ensure_future(
+                async_gateway.issue(create_command('a')))
+            await handler.started.wait()
+            follower = asyncio.ensure_future(
+                async_gateway.issue(create_command('a')))
+            await asyncio.sleep(0)
+            handler.released.set()
+            results = await asyncio.gather(first, follower,
+                return_exceptions=True)
+            return handler, results
+
+    handler, results = asyncio.run(issue())
+    assert all(isinstance(x, ICommandProcessor.UpstreamFailure) for x in results)
+    assert len(handler.executed) == 1
+
+
+def test_batch_items_with_a_key_are_executed_once(store, runner):
+    gateway = create_gateway(store, runner)
+    first, other, retried, reused = gateway.issue_batch([
+        create_command('a'),
+        create_command(None),
+        create_command('a'),
+        create_command('a', foo=2),
+    ])
+    assert retried == first
+    assert other.command_id != first.command_id
+    assert isinstance(reused, gateway.CommandRejected)
+    assert sorted(runner.executed) == sorted([first.command_id, other.command_id])
+
+    # A retry of the batch receives the responses of the first execution.
+    assert gateway.issue_batch([create_command('a')]) == [first]
+    assert len(runner.executed) == 2
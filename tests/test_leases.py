@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from gateway.dto import CommandRequestDTO
+from gateway.recovery import CommandRecovery
+from gateway.test.store import CommandStore
+
+
+def create_command(asynchronous=True):
+    return CommandRequestDTO(None, 'test', asynchronous, {'foo': 1}, 1, 0,
+        '127.0.0.1')
+
+
+@pytest.fixture
+def dsn(tmpdir):
+    return 'sqlite:///' + str(tmpdir.join('commands.db'))
+
+
+def get_lease(store, command_id):
+    store.release()
+    dao = store.get_command(command_id)
+    return dao.lease_owner, dao.lease_expires
+
+
+def test_asynchronous_commands_are_leased_to_their_store(dsn):
+    store = CommandStore(dsn)
+    command_id = store.persist(create_command()).ident
+    assert get_lease(store, command_id)[0] == store.owner
+    assert store.get_recoverable() == []
+
+
+def test_leased_commands_are_not_claimed_by_other_stores(dsn):
+    store = CommandStore(dsn)
+    other = CommandStore(dsn)
+    command_id = store.persist(create_command()).ident
+    assert other.claim_leases([command_id]) == []
+    assert get_lease(other, command_id)[0] == store.owner
+
+
+def test_expired_leases_are_claimed_once(dsn):
+    store = CommandStore(dsn, lease_ttl=0)
+    command_ids = [x.ident for x in
+        store.persist_many([create_command() for i in range(50)])]
+    time.sleep(0.01)
+
+    claimants = [CommandStore(dsn) for i in range(4)]
+    barrier = threading.Barrier(len(claimants))
+    claimed = {}
+
+    def claim(claimant):
+        barrier.wait()
+        claimed[claimant.owner] = [x.command_id
+            for x in claimant.claim_leases(command_ids)]
+
+    threads = [threading.Thread(target=claim, args=[x]) for x in claimants]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    leased = [x for ids in claimed.values() for x in ids]
+    assert sorted(leased) == command_ids
+    for claimant in claimants:
+        for command_id in claimed[claimant.owner]:
+            assert get_lease(claimant, command_id)[0] == claimant.owner
+
+
+def test_renewed_leases_are_not_claimed(dsn):
+    store = CommandStore(dsn, lease_ttl=0)
+    command_id = store.persist(create_command()).ident
+    store.lease_ttl = 60
+    store.renew_leases()
+    time.sleep(0.01)
+    assert CommandStore(dsn).claim_leases([command_id]) == []
+
+
+def test_renewal_races_with_claims(dsn):
+    # A lease is either renewed by its owner or claimed by another
+    # store, never both.
+    store = CommandStore(dsn, lease_ttl=0)
+    command_ids = [x.ident for x in
+        store.persist_many([create_command() for i in range(50)])]
+    time.sleep(0.01)
+    store.lease_ttl = 60
+    other = CommandStore(dsn)
+    barrier = threading.Barrier(2)
+    claimed = []
+
+    def renew():
+        barrier.wait()
+        store.renew_leases()
+
+    def claim():
+        barrier.wait()
+        claimed.extend(x.command_id for x in other.claim_leases(command_ids))
+
+    threads = [threading.Thread(target=renew), threading.Thread(target=claim)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for command_id in command_ids:
+        owner, expires = get_lease(other, command_id)
+        assert owner == (other.owner if command_id in claimed else store.owner)
+        assert expires > store.get_timestamp()
+
+
+def test_released_leases_are_recoverable(dsn):
+    store = CommandStore(dsn)
+    command_id = store.persist(create_command()).ident
+    store.release_leases([command_id])
+    other = CommandStore(dsn)
+    assert [x.command_id for x in other.get_recoverable()] == [command_id]
+    assert [x.command_id for x in other.claim_leases([command_id])] == [command_id]
+
+
+def test_synchronous_commands_are_not_leased(dsn):
+    store = CommandStore(dsn)
+    command_id = store.persist(create_command(asynchronous=False)).ident
+    assert get_lease(store, command_id) == (None, None)
+
+
+def test_leases_are_renewed_if_recovery_is_disabled(dsn):
+    store = CommandStore(dsn, lease_ttl=0)
+    command_id = store.persist(create_command()).ident
+    store.lease_ttl = 60
+
+    recovery = CommandRecovery(enabled=False, interval=60)
+    recovery.store = store
+    recovery.start()
+    try:
+        deadline = time.monotonic() + 5
+        while get_lease(store, command_id)[1] < store.get_timestamp() + 30000:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        recovery.stop()
+    assert CommandStore(dsn).claim_leases([command_id]) == []
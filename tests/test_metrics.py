@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from gateway.dto import CommandResponseDTO
+from gateway.metrics import MetricsRegistry
+from gateway.mixins import ICommandProcessor
+
+
+def get_labels(registry, name):
+    return [dict(labels) for metric, labels in registry.histograms
+        if metric == name]
+
+
+def test_timer_reports_the_outcome_of_its_block():
+    registry = MetricsRegistry()
+    with registry.timer('duration', stage='a'):
+        pass
+    with pytest.raises(ValueError):
+        with registry.timer('duration', stage='b'):
+            raise ValueError
+    with registry.timer('duration', stage='c') as timer:
+        timer.tag(outcome='rejected')
+    assert sorted(get_labels(registry, 'duration'), key=lambda x: x['stage']) == [
+        {'stage': 'a', 'outcome': 'ok'},
+        {'stage': 'b', 'outcome': 'ValueError'},
+        {'stage': 'c', 'outcome': 'rejected'},
+    ]
+
+
+def test_render_uses_the_text_exposition_format():
+    registry = MetricsRegistry(buckets=[0.1, 1.0])
+    registry.observe('duration', 0.5, outcome='ok')
+    registry.increment('requests', outcome='ok')
+    assert registry.render({'threads': 2}).splitlines() == [
+        '# TYPE requests counter',
+        'requests{outcome="ok"} 1',
+        '# TYPE duration histogram',
+        'duration_bucket{outcome="ok",le="0.1"} 0',
+        'duration_bucket{outcome="ok",le="1.0"} 1',
+        'duration_bucket{outcome="ok",le="+Inf"} 1',
+        'duration_sum{outcome="ok"} 0.5',
+        'duration_count{outcome="ok"} 1',
+        '# TYPE threads gauge',
+        'threads 2',
+    ]
+
+
+class Gateway:
+    """Returns :attr:`response` or raises :attr:`error`."""
+
+    def __init__(self, response=None, error=None):
+        self.response = response
+        self.error = error
+
+    def issue(self, command):
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+def post(gateway, data):
+    pytest.importorskip('werkzeug')
+    pytest.importorskip('libsousou')
+    from werkzeug.test import EnvironBuilder
+    from gateway.wsgi import GatewayApplication
+    from gateway.wsgi import GatewayController
+
+    controller = GatewayController()
+    controller.gateway = gateway
+    controller.metrics = MetricsRegistry()
+    request = GatewayApplication.request_class(EnvironBuilder(
+        path='/v1/command', method='POST', data=json.dumps(data),
+        content_type='application/json').get_environ())
+    try:
+        controller.post(request)
+    except controller.UnprocessableEntity:
+        pass
+    labels = get_labels(controller.metrics, controller.request_metric)
+    assert len(labels) == 1
+    return labels[0]
+
+
+COMMAND = {'command': 'test', 'params': {}}
+
+
+@pytest.mark.parametrize('gateway,data,outcome,command_type', [
+    (Gateway(CommandResponseDTO(1, 1, {}, True, True, None)), COMMAND,
+        'ok', 'test'),
+    (Gateway(error=ICommandProcessor.UpstreamFailure()), COMMAND,
+        'UPSTREAM_FAILURE', 'unknown'),
+    (Gateway(), {'params': {}}, 'error', 'unknown'),
+])
+def test_requests_are_labelled_with_the_same_keys(gateway, data, outcome,
+    command_type):
+    assert post(gateway, data) == {
+        'outcome': outcome,
+        'command_type': command_type
+    }
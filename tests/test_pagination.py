@@ -0,0 +1,71 @@
+import pytest
+
+from gateway.dto import CommandRequestDTO
+from gateway.memory import MemoryCommandStore
+from gateway.wal import LogCommandStore
+
+
+def create_sql_store(path):
+    pytest.importorskip('sqlalchemy')
+    from gateway.test.store import CommandStore
+    return CommandStore('sqlite:///' + str(path.join('commands.db')))
+
+
+STORES = {
+    'memory': lambda path: MemoryCommandStore(capacity=1000),
+    'log': lambda path: LogCommandStore(str(path), fsync=False),
+    'sql': create_sql_store,
+}
+
+
+@pytest.fixture(params=sorted(STORES))
+def store(request, tmpdir):
+    store = STORES[request.param](tmpdir)
+    for i in range(1, 31):
+        tx = store.persist(CommandRequestDTO(None,
+            'even' if i % 2 == 0 else 'odd', False, {'i': i}, i % 3, 0,
+            '127.0.0.1'))
+        if i % 5 == 0:
+            store.set_status(tx.ident, store.STATE_DONE)
+    yield store
+    getattr(store, 'close', lambda: None)()
+
+
+def paginate(store, limit, **filters):
+    pages = []
+    cursor = None
+    while True:
+        page = [x.command_id for x in
+            store.get_commands(cursor=cursor, limit=limit, **filters)]
+        if not page:
+            return pages
+        pages.append(page)
+        cursor = page[-1]
+
+
+def test_pages_follow_the_cursor(store):
+    pages = paginate(store, 7)
+    assert [len(x) for x in pages] == [7, 7, 7, 7, 2]
+    assert [x for page in pages for x in page] == list(range(30, 0, -1))
+
+
+@pytest.mark.parametrize('filters,expected', [
+    ({'status': 'done'}, [30, 25, 20, 15, 10, 5]),
+    ({'command_type': 'even', 'issuer': 0}, [30, 24, 18, 12, 6]),
+    ({'status': 'pending', 'issuer': 1}, [28, 22, 19, 16, 13, 7, 4, 1]),
+])
+def test_filters_apply_to_every_page(store, filters, expected):
+    pages = paginate(store, 3, **filters)
+    assert all(len(x) <= 3 for x in pages)
+    assert [x for page in pages for x in page] == expected
+
+
+def test_time_range(store):
+    commands = store.get_commands(limit=None)
+    timestamps = sorted({x.timestamp for x in commands})
+    since, until = timestamps[0], timestamps[-1]
+    expected = [x.command_id for x in commands
+        if since <= x.timestamp < until]
+    assert [x.command_id for x in store.get_commands(limit=None,
+        since=since, until=until)] == expected
+    assert list(store.get_commands(since=until + 1)) == []
@@ -0,0 +1,63 @@
+import pytest
+
+from gateway import policy
+from gateway.policy import CircuitBreaker
+from gateway.policy import ExecutionPolicy
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(policy.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(policy.time, 'sleep', lambda seconds: None)
+    return now
+
+
+def fail(exception):
+    def func():
+        raise exception
+    return func
+
+
+def test_breaker_opens_on_upstream_failures(clock):
+    execution = ExecutionPolicy(failure_threshold=2, reset_timeout=10)
+    for i in range(2):
+        with pytest.raises(execution.UpstreamFailure):
+            execution.run(fail(execution.UpstreamFailure()))
+    assert execution.breaker.state == CircuitBreaker.STATE_OPEN
+    with pytest.raises(execution.UpstreamFailure):
+        execution.run(lambda: 'ok')
+
+
+def test_breaker_ignores_rejected_commands(clock):
+    execution = ExecutionPolicy(failure_threshold=2, reset_timeout=10)
+    for i in range(5):
+        with pytest.raises(execution.CommandRejected):
+            execution.run(fail(execution.CommandRejected()))
+        with pytest.raises(ValueError):
+            execution.run(fail(ValueError()))
+    assert execution.breaker.state == CircuitBreaker.STATE_CLOSED
+    assert execution.run(lambda: 'ok') == 'ok'
+
+
+def test_breaker_closes_after_a_successful_trial(clock):
+    execution = ExecutionPolicy(failure_threshold=1, reset_timeout=10)
+    with pytest.raises(execution.UpstreamFailure):
+        execution.run(fail(execution.UpstreamFailure()))
+    clock[0] += 10
+    assert execution.run(lambda: 'ok') == 'ok'
+    assert execution.breaker.state == CircuitBreaker.STATE_CLOSED
+
+
+def test_hung_trial_does_not_keep_the_breaker_half_open(clock):
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock[0] += 10
+    breaker.check()
+
+    # The trial has not finished yet.
+    with pytest.raises(breaker.UpstreamFailure):
+        breaker.check()
+    clock[0] += 10
+    breaker.check()
+    assert breaker.state == CircuitBreaker.STATE_HALF_OPEN
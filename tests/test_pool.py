@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+
+from gateway.batch import GroupCommitter
+from gateway.batch import PendingOperation
+from gateway.pool import FairQueue
+from gateway.pool import ShardedPool
+from gateway.pool import WorkerPool
+
+
+def test_saturated_pool_rejects_tasks():
+    pool = WorkerPool(1, 1)
+    started = threading.Event()
+    released = threading.Event()
+
+    def block():
+        started.set()
+        released.wait()
+
+    running = pool.submit(block)
+    started.wait()
+    queued = pool.submit(lambda: 'queued')
+    with pytest.raises(pool.QueueFull):
+        pool.submit(lambda: 'rejected')
+    metrics = pool.metrics()
+    released.set()
+
+    assert queued.result(1) == 'queued'
+    assert running.result(1) is None
+    pool.shutdown()
+    assert metrics['workers_busy'] == 1
+    assert metrics['queue_depth'] == 1
+    assert metrics['rejected'] == 1
+    assert pool.metrics()['completed'] == 2
+
+
+def test_blocking_submit_waits_for_a_free_slot():
+    pool = WorkerPool(1, 1)
+    started = threading.Event()
+    released = threading.Event()
+    pool.submit(lambda: (started.set(), released.wait()))
+    started.wait()
+    pool.submit(time.sleep, 0)
+    with pytest.raises(pool.QueueFull):
+        pool.submit(time.sleep, 0, block=True, timeout=0.01)
+
+    threading.Timer(0.01, released.set).start()
+    assert pool.submit(lambda: 'waited', block=True, timeout=1)\
+        .result(1) == 'waited'
+    pool.shutdown()
+
+
+def test_failed_tasks_are_reported_by_their_future():
+    pool = WorkerPool(1, 0)
+    future = pool.submit(lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        future.result(1)
+    pool.shutdown()
+    assert pool.metrics()['failed'] == 1
+
+
+def test_sharded_pool_runs_tasks_with_the_same_key_in_order():
+    pool = ShardedPool(4, 0)
+    events = []
+    futures = [pool.submit(key, lambda *x: (time.sleep(x[1]), events.append(x)),
+        key, delay) for key, delay in [('a', 0.03), ('a', 0), ('b', 0.01),
+        ('a', 0.01), ('b', 0)]]
+    for future in futures:
+        future.result(1)
+    pool.shutdown()
+    assert [x for x in events if x[0] == 'a'] == [('a', 0.03), ('a', 0), ('a', 0.01)]
+    assert [x for x in events if x[0] == 'b'] == [('b', 0.01), ('b', 0)]
+    assert pool.get_pool('a') is pool.get_pool('a')
+
+
+def test_fair_queue_shares_tasks_by_weight():
+    tasks = FairQueue(0, {'b': 2})
+    for flow in 'aaaabbbb':
+        tasks.put((None, flow))
+    tasks.put(None)
+    order = [tasks.get() for i in range(9)]
+    assert order.pop() is None
+    assert [x[-1] for x in order] == list('babbabaa')
+
+
+def test_fair_queue_keeps_the_order_of_a_flow():
+    tasks = FairQueue()
+    for i in range(5):
+        tasks.put((i, 'a'))
+    assert [tasks.get()[0] for i in range(5)] == list(range(5))
+
+
+def test_group_committer_combines_concurrent_operations():
+    batches = []
+    started = threading.Event()
+    released = threading.Event()
+
+    def commit(operations):
+        batches.append(list(operations))
+        started.set()
+        released.wait()
+        return [x * 10 for x in operations]
+
+    committer = GroupCommitter(commit)
+    results = {}
+
+    def submit(operation):
+        results[operation] = committer.submit(operation)
+
+    threads = [threading.Thread(target=submit, args=(0,))]
+    threads[0].start()
+    started.wait()
+    for operation in range(1, 5):
+        threads.append(threading.Thread(target=submit, args=(operation,)))
+        threads[-1].start()
+    while committer.queue.qsize() < 4:
+        time.sleep(0.001)
+    released.set()
+    for t in threads:
+        t.join()
+
+    assert [sorted(x) for x in batches] == [[0], [1, 2, 3, 4]]
+    assert results == {x: x * 10 for x in range(5)}
+
+
+def test_group_committer_retries_failed_batches_individually():
+    batches = []
+
+    def commit(operations):
+        batches.append(list(operations))
+        if 'bad' in operations:
+            raise ValueError
+        return operations
+
+    committer = GroupCommitter(commit)
+    pending = [PendingOperation(x) for x in ('good', 'bad', 'other')]
+    committer._commit(pending)
+    assert batches == [['good', 'bad', 'other'], ['good'], ['bad'], ['other']]
+    assert pending[0].wait() == 'good'
+    assert pending[2].wait() == 'other'
+    with pytest.raises(ValueError):
+        pending[1].wait()
@@ -0,0 +1,84 @@
+import os
+import signal
+import socket
+import time
+
+import pytest
+
+from gateway.prefork import Supervisor
+
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'),
+    reason="Requires os.fork().")
+
+
+def start(serve, workers, **kwargs):
+    supervisor = Supervisor(serve, '127.0.0.1', 0, workers, **kwargs)
+    supervisor.socket = supervisor.bind()
+    for slot in range(workers):
+        supervisor.spawn(slot)
+    return supervisor
+
+
+def reap(supervisor, count, timeout=5):
+    exited = []
+    deadline = time.monotonic() + timeout
+    while len(exited) < count and time.monotonic() < deadline:
+        exited.extend(supervisor.reap())
+        time.sleep(0.01)
+    return exited
+
+
+def test_workers_accept_connections_on_the_shared_socket():
+
+    def serve(sock):
+        connection, address = sock.accept()
+        connection.sendall(str(os.getpid()).encode('ascii'))
+        connection.close()
+
+    supervisor = start(serve, 2)
+    port = supervisor.socket.getsockname()[1]
+    try:
+        pids = set()
+        for i in range(2):
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as c:
+                pids.add(int(c.recv(16)))
+        assert pids == set(supervisor.children)
+        assert sorted(reap(supervisor, 2)) == [(0, 0), (1, 0)]
+        assert supervisor.children == {}
+    finally:
+        supervisor.stop()
+
+
+def test_failed_workers_exit_with_an_error_status():
+
+    def serve(sock):
+        raise ValueError
+
+    supervisor = start(serve, 1)
+    try:
+        (slot, status), = reap(supervisor, 1)
+        assert slot == 0
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 1
+    finally:
+        supervisor.stop()
+
+
+def test_stop_kills_workers_after_the_graceful_timeout():
+    ready, notify = os.pipe()
+
+    def serve(sock):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        os.write(notify, b'x')
+        time.sleep(60)
+
+    supervisor = start(serve, 1, graceful_timeout=0.2)
+    os.read(ready, 1)
+    os.close(ready)
+    os.close(notify)
+
+    started = time.monotonic()
+    supervisor.stop()
+    assert time.monotonic() - started >= 0.2
+    assert supervisor.children == {}
+    assert supervisor.socket.fileno() == -1
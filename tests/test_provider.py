@@ -0,0 +1,82 @@
+import json
+import sys
+
+import pytest
+
+from gateway.provider import CommandHandlersProvider
+from gateway.provider import create_manifest
+
+
+HANDLERS = '''
+from eda import dto
+
+from gateway.handler import ICommandHandler
+
+
+class FooHandler(ICommandHandler):
+    foo = dto.Integer(required=True)
+
+    def run(self, command):
+        return None, command.params['foo'], False
+
+    class Meta:
+        command = 'foo'
+'''
+
+
+@pytest.fixture
+def manifest(tmpdir, monkeypatch):
+    """Write a module holding a handler and its manifest, and return
+    the path of the manifest.
+    """
+    tmpdir.join('lazyhandlers.py').write(HANDLERS)
+    tmpdir.join('brokenhandlers.py').write('raise ImportError')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    yield write_manifest(tmpdir, {
+        'foo': 'lazyhandlers:FooHandler',
+        'broken': 'brokenhandlers:Handler',
+    })
+    for name in ('lazyhandlers', 'brokenhandlers'):
+        sys.modules.pop(name, None)
+
+
+def write_manifest(tmpdir, manifest):
+    path = tmpdir.join('handlers.json')
+    path.write(json.dumps(manifest))
+    return str(path)
+
+
+def test_handlers_are_imported_on_first_use(manifest):
+    provider = CommandHandlersProvider(manifest)
+    assert 'lazyhandlers' not in sys.modules
+
+    handler = provider.get('foo')
+    assert 'lazyhandlers' in sys.modules
+    assert provider.get('foo') is handler
+    assert list(provider.timings) == ['foo']
+
+
+def test_unknown_command_types_are_rejected(manifest):
+    provider = CommandHandlersProvider(manifest)
+    with pytest.raises(provider.CommandRejected):
+        provider.get('bar')
+
+
+def test_handlers_that_fail_to_load_raise_upstream_failure(manifest):
+    provider = CommandHandlersProvider(manifest)
+    with pytest.raises(provider.UpstreamFailure):
+        provider.get('broken')
+    assert provider.get('foo').command == 'foo'
+
+
+def test_warmup_loads_all_handlers(manifest):
+    provider = CommandHandlersProvider(manifest)
+    provider.warmup()
+    assert 'lazyhandlers' in sys.modules
+    assert list(provider.timings) == ['foo']
+
+
+def test_create_manifest_lists_the_handlers_of_modules(manifest):
+    assert create_manifest(['lazyhandlers']) == {
+        'foo': 'lazyhandlers:FooHandler'
+    }
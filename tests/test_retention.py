@@ -0,0 +1,89 @@
+import time
+
+from gateway.memory import CommandRecord
+from gateway.retention import CommandRetention
+from gateway.store import ICommandStore
+
+
+class Store(ICommandStore):
+    """Holds finished commands and a number of free pages, which are
+    reclaimed by :meth:`compact()`.
+    """
+
+    def __init__(self, commands, pages):
+        self.commands = commands
+        self.pages = pages
+        self.compacted = []
+
+    def get_expired(self, before, after=0, limit=500):
+        return [x for x in self.commands if x.command_id > after][:limit]
+
+    def delete(self, command_ids):
+        self.commands = [x for x in self.commands
+            if x.command_id not in command_ids]
+
+    def release(self):
+        pass
+
+    def compact(self, pages=None):
+        reclaimed = min(self.pages, pages if pages is not None else self.pages)
+        self.compacted.append(reclaimed)
+        self.pages -= reclaimed
+        return self.pages
+
+
+class Archive:
+
+    def __init__(self):
+        self.commands = []
+
+    def exclusive(self):
+        return Lock()
+
+    def append(self, commands):
+        self.commands.extend(commands)
+
+
+class Lock:
+
+    def __enter__(self):
+        return True
+
+    def __exit__(self, *args):
+        pass
+
+
+def create_retention(store, **kwargs):
+    retention = CommandRetention(pause=0, **kwargs)
+    retention.store = store
+    retention.archive = Archive()
+    return retention
+
+
+def create_record(command_id):
+    return CommandRecord(command_id, 'test', 0, 1, 1, '127.0.0.1', {},
+        ICommandStore.STATE_DONE)
+
+
+def test_space_is_reclaimed_in_chunks_after_archiving():
+    store = Store([create_record(i) for i in range(1, 6)], 25)
+    retention = create_retention(store, batch_size=2, vacuum_pages=10)
+    assert retention.run() == 5
+    assert store.commands == []
+    assert [x.command_id for x in retention.archive.commands] == list(range(1, 6))
+    assert store.compacted == [10, 10, 5]
+
+
+def test_nothing_is_reclaimed_without_archived_commands():
+    store = Store([], 25)
+    assert create_retention(store).run() == 0
+    assert store.compacted == []
+
+
+def test_compaction_stops_with_the_retention():
+    store = Store([create_record(1)], 25)
+    retention = create_retention(store, vacuum_pages=10)
+    retention.store.compact = lambda pages: (retention.stop(), 1)[1]
+    started = time.monotonic()
+    retention.compact()
+    assert time.monotonic() - started < 1
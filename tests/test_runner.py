@@ -0,0 +1,196 @@
+import threading
+import time
+
+import pytest
+
+# gateway.test holds the SQLAlchemy store and the test command handler.
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('libsousou')
+
+from gateway.dto import CommandRequestDTO
+from gateway.memory import MemoryCommandStore
+from gateway.policy import ExecutionPolicy
+from gateway.test.runner import CommandRunner
+
+
+class Handler:
+    """Records the start and the end of the commands, which sleep for
+    the number of seconds given by their ``delay`` parameter, or until
+    :attr:`released` is set if they have the ``block`` parameter.
+    """
+    policy = ExecutionPolicy()
+    partition_key = 'key'
+
+    def __init__(self, lane=None):
+        self.lane = lane
+        self.events = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def get_partition_key(self, params):
+        return params.get(self.partition_key)
+
+    def run(self, command):
+        self.events.append(('start', command.params['name']))
+        self.started.set()
+        if command.params.get('block'):
+            self.released.wait()
+        time.sleep(command.params.get('delay', 0))
+        self.events.append(('end', command.params['name']))
+        return None, command.params['name'], False
+
+    def get_ends(self):
+        return [x for event, x in self.events if event == 'end']
+
+
+class Handlers:
+
+    def __init__(self, handler, **handlers):
+        self.handler = handler
+        self.handlers = handlers
+
+    def get(self, command_type):
+        return self.handlers.get(command_type, self.handler)
+
+
+@pytest.fixture
+def store():
+    return MemoryCommandStore(capacity=1000)
+
+
+def create_runner(store, handlers, **kwargs):
+    runner = CommandRunner(**kwargs)
+    runner.handlers = handlers
+    runner.store = store
+    return runner
+
+
+def create_command(store, name, asynchronous=True, issuer=1,
+    command_type='test', **params):
+    params['name'] = name
+    command = CommandRequestDTO(None, command_type, asynchronous, params,
+        issuer, issuer, '127.0.0.1')
+    store.persist(command)
+    return command
+
+
+def wait(runner):
+    """Wait until the runner has run all submitted commands."""
+    pools = [runner.pool] + list(runner.lanes.values())
+    if runner.shards is not None:
+        pools.append(runner.shards)
+    while any(x['submitted'] > x['completed'] + x['failed']
+    for x in (pool.metrics() for pool in pools)):
+        time.sleep(0.001)
+
+
+def test_saturated_pool_rejects_commands_with_upstream_failure(store):
+    handler = Handler()
+    runner = create_runner(store, Handlers(handler), workers=1, queue_size=1)
+    running = create_command(store, 'running', block=True)
+    runner.execute(running)
+    handler.started.wait()
+    queued = create_command(store, 'queued')
+    runner.execute(queued)
+    rejected = create_command(store, 'rejected')
+    with pytest.raises(runner.UpstreamFailure):
+        runner.execute(rejected)
+    metrics = runner.get_metrics()
+    handler.released.set()
+    wait(runner)
+
+    assert metrics['workers_busy'] == 1
+    assert metrics['queue_depth'] == 1
+    assert metrics['rejected'] == 1
+    assert handler.get_ends() == ['running', 'queued']
+    assert store.get_command(queued.id).status == store.STATE_DONE
+    assert store.get_command(rejected.id).status == store.STATE_PENDING
+
+
+def test_commands_with_the_same_key_run_in_order(store):
+    handler = Handler()
+    runner = create_runner(store, Handlers(handler), workers=4, shards=4)
+    assert runner.shards.get_pool('a') is not runner.shards.get_pool('b')
+    for name, key, delay in [('a1', 'a', 0.05), ('a2', 'a', 0),
+    ('b1', 'b', 0), ('a3', 'a', 0.01)]:
+        runner.execute(create_command(store, name, key=key, delay=delay))
+
+    # Synchronous commands wait for the commands issued before.
+    result = runner.execute(create_command(store, 'a4', asynchronous=False,
+        key='a'))
+    wait(runner)
+
+    assert result[1] == 'a4'
+    assert [x for x in handler.get_ends() if x[0] == 'a']\
+        == ['a1', 'a2', 'a3', 'a4']
+    assert handler.events.index(('start', 'a2'))\
+        > handler.events.index(('end', 'a1'))
+    assert handler.get_ends().index('b1') < handler.get_ends().index('a1')
+
+
+def test_commands_are_not_ordered_unless_sharded(store):
+    handler = Handler()
+    runner = create_runner(store, Handlers(handler), workers=2)
+    runner.execute(create_command(store, 'a1', key='a', delay=0.05))
+    runner.execute(create_command(store, 'a2', key='a'))
+    wait(runner)
+    assert handler.get_ends() == ['a2', 'a1']
+
+
+def test_reserved_lanes_are_not_delayed_by_a_flood_of_other_commands(store):
+    low = Handler()
+    high = Handler(lane='high')
+    runner = create_runner(store, Handlers(low, high=high), workers=2,
+        queue_size=100, lanes={'high': 1})
+    for i in range(40):
+        runner.execute(create_command(store, 'low', delay=0.01))
+    started = time.monotonic()
+    runner.execute(create_command(store, 'high', command_type='high'))
+    while not high.get_ends():
+        time.sleep(0.001)
+    elapsed = time.monotonic() - started
+    metrics = runner.get_metrics()
+    wait(runner)
+
+    # The low priority commands take 0.2 seconds on the shared workers.
+    assert elapsed < 0.1
+    assert metrics['queue_depth'] > 0
+    assert metrics['lane_high_queue_depth'] == 0
+    assert len(low.get_ends()) == 40
+
+
+def test_full_shared_queue_does_not_reject_reserved_lanes(store):
+    low = Handler()
+    high = Handler(lane='high')
+    runner = create_runner(store, Handlers(low, high=high), workers=1,
+        queue_size=1, lanes={'high': 1})
+    runner.execute(create_command(store, 'low', block=True))
+    low.started.wait()
+    runner.execute(create_command(store, 'low'))
+    with pytest.raises(runner.UpstreamFailure):
+        runner.execute(create_command(store, 'low'))
+    runner.execute(create_command(store, 'high', command_type='high'))
+    while not high.get_ends():
+        time.sleep(0.001)
+    low.released.set()
+    wait(runner)
+    assert len(low.get_ends()) == 2
+
+
+@pytest.mark.parametrize('fair_queuing,expected', [
+    (False, ['1'] * 7 + ['2'] * 2),
+    (True, ['1', '2', '1', '2', '1', '1', '1', '1', '1']),
+])
+def test_fair_queuing_across_issuers(store, fair_queuing, expected):
+    handler = Handler()
+    runner = create_runner(store, Handlers(handler), workers=1,
+        fair_queuing=fair_queuing)
+    runner.execute(create_command(store, 'blocker', issuer=3, block=True))
+    handler.started.wait()
+    for i in range(7):
+        runner.execute(create_command(store, '1', issuer=1))
+    for i in range(2):
+        runner.execute(create_command(store, '2', issuer=2))
+    handler.released.set()
+    wait(runner)
+    assert handler.get_ends()[1:] == expected
@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from gateway.dto import CommandRequestDTO
+from gateway.test.store import CommandStore
+
+
+def create_command(idempotency_key=None, foo=1):
+    return CommandRequestDTO(None, 'test', False, {'foo': foo}, 1, 0,
+        '127.0.0.1', idempotency_key)
+
+
+@pytest.fixture
+def dsn(tmpdir):
+    return 'sqlite:///' + str(tmpdir.join('commands.db'))
+
+
+def record_batches(store):
+    """Return a list to which the size of each batch committed by
+    the group committer of `store` is appended.
+    """
+    batches = []
+    commit = store.committer.commit
+
+    def record(operations):
+        batches.append(len(operations))
+        return commit(operations)
+
+    store.committer.commit = record
+    return batches
+
+
+def persist_concurrently(store, commands):
+    """Persist `commands` from one thread each, and return a list
+    holding the identifier of each command or the exception raised.
+    """
+    results = [None] * len(commands)
+    barrier = threading.Barrier(len(commands))
+
+    def persist(i):
+        barrier.wait()
+        try:
+            results[i] = store.persist(commands[i]).ident
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=persist, args=(i,))
+        for i in range(len(commands))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_group_commit_combines_concurrent_writes(dsn):
+    store = CommandStore(dsn, group_commit=True, window=0.05)
+    batches = record_batches(store)
+    command_ids = persist_concurrently(store,
+        [create_command() for i in range(8)])
+
+    assert len(set(command_ids)) == 8
+    assert sum(batches) == 8
+    assert len(batches) < 8
+
+    store.set_status(command_ids[0], store.STATE_DONE,
+        result={'ident': None, 'result': 1})
+    store.release()
+    assert store.get_command(command_ids[0]).status == store.STATE_DONE
+
+
+def test_group_commit_isolates_failed_writes(dsn):
+    store = CommandStore(dsn, group_commit=True, window=0.05)
+    first = store.persist(create_command('a')).ident
+    results = persist_concurrently(store,
+        [create_command('a')] + [create_command() for i in range(3)])
+
+    assert isinstance(results[0], store.DuplicateEntity)
+    assert all(isinstance(x, int) and x != first for x in results[1:])
+    assert len(set(results[1:])) == 3
+
+
+def test_reads_use_a_session_per_thread(dsn):
+    store = CommandStore(dsn)
+    session = store.Session()
+    assert store.Session() is session
+
+    sessions = []
+    t = threading.Thread(target=lambda: sessions.append(store.Session()))
+    t.start()
+    t.join()
+    assert sessions[0] is not session
+
+    store.release()
+    assert store.Session() is not session
+
+
+def test_released_session_reads_committed_writes(dsn):
+    store = CommandStore(dsn)
+    command_id = store.persist(create_command()).ident
+    assert store.get_command(command_id).status == store.STATE_PENDING
+
+    # Written by another thread, with a session of its own.
+    t = threading.Thread(target=store.set_status,
+        args=(command_id, store.STATE_DONE))
+    t.start()
+    t.join()
+    store.release()
+    assert store.get_command(command_id).status == store.STATE_DONE
+
+
+def test_compact_reclaims_a_bounded_number_of_pages(dsn):
+    store = CommandStore(dsn)
+    command_ids = [x.ident for x in store.persist_many(
+        [create_command(foo='x' * 4000) for i in range(50)])]
+    for command_id in command_ids:
+        store.set_status(command_id, store.STATE_DONE)
+    store.delete(command_ids)
+
+    remaining = store.compact(10)
+    assert remaining > 10
+    while remaining > 0:
+        left = store.compact(10)
+        assert left == max(remaining - 10, 0)
+        remaining = left
+    assert store.compact() == 0
@@ -0,0 +1,73 @@
+from marshmallow import Schema
+from marshmallow import ValidationError
+from marshmallow import fields
+from marshmallow import post_load
+from marshmallow import validates_schema
+import pytest
+
+from gateway.validation import compile_validator
+from gateway.validation import is_compilable
+
+
+class ParamsSchema(Schema):
+    foo = fields.Integer(required=True)
+    bar = fields.String(missing='default')
+    baz = fields.Integer(load_from='bazValue')
+    qux = fields.Integer(attribute='quux', validate=lambda x: x > 0)
+    created = fields.Integer(dump_only=True)
+    tags = fields.List(fields.String())
+
+
+class ProcessedSchema(ParamsSchema):
+
+    @validates_schema
+    def validate_foo(self, data):
+        if data and data.get('foo') == 13:
+            raise ValidationError("Unlucky.", 'foo')
+
+    @post_load
+    def add_total(self, data):
+        data['total'] = data['foo'] + data.get('baz', 0)
+        return data
+
+
+INPUTS = [
+    {'foo': 1},
+    {'foo': '2', 'bar': 'x', 'bazValue': 3, 'qux': 4, 'tags': ['a']},
+    {'foo': 1, 'baz': 5, 'bazValue': 6},
+    {'foo': 1, 'bar': None},
+    {'foo': 'x', 'qux': 'y'},
+    {'foo': 1, 'qux': 0},
+    {'foo': 1, 'tags': 'a'},
+    {'foo': 1, 'unknown': 2, 'created': 3},
+    {'foo': 13},
+    {},
+    [],
+    None,
+]
+
+
+def load(schema, data):
+    params, errors = schema.load(data)
+    return (None, errors) if errors else (params, {})
+
+
+@pytest.mark.parametrize('data', INPUTS)
+def test_compiled_validator_matches_schema_load(data):
+    schema = ParamsSchema()
+    assert is_compilable(schema)
+    assert compile_validator(schema)(data) == load(schema, data)
+
+
+@pytest.mark.parametrize('data', INPUTS)
+def test_validator_loads_schemas_with_processors(data):
+    schema = ProcessedSchema()
+    assert not is_compilable(schema)
+    assert compile_validator(schema)(data) == load(schema, data)
+
+
+def test_validator_reports_errors_of_strict_schemas():
+    schema = ParamsSchema(strict=True)
+    params, errors = compile_validator(schema)({'foo': 'x'})
+    assert params is None
+    assert errors == {'foo': ["Not a valid integer."]}
@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from gateway.dto import CommandRequestDTO
+from gateway.wal import LogCommandStore
+
+
+def create_command(key=None):
+    return CommandRequestDTO(None, 'test', False, {'foo': 1}, 1, 0,
+        '127.0.0.1', key)
+
+
+def open_store(path, **kwargs):
+    return LogCommandStore(str(path), fsync=False, **kwargs)
+
+
+def get_segments(path):
+    return sorted(os.path.join(str(path), x) for x in os.listdir(str(path)))
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = open_store(tmpdir)
+    yield store
+    store.close()
+
+
+def test_commands_are_recovered(tmpdir, store):
+    command_id = store.persist(create_command('a')).ident
+    store.set_status(command_id, store.STATE_DONE,
+        result={'ident': 'x', 'result': [1]})
+    store.close()
+
+    store = open_store(tmpdir)
+    try:
+        command = store.get_command(command_id)
+        assert command.status == store.STATE_DONE
+        assert command.result == '{"ident": "x", "result": [1]}'
+        assert store.get_idempotent(1, 'a').command_id == command_id
+        assert store.persist(create_command()).ident == command_id + 1
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('torn', [1, 5, 12])
+def test_torn_tail_is_truncated(tmpdir, store, torn):
+    first = store.persist(create_command()).ident
+    second = store.persist(create_command('b')).ident
+    store.close()
+    segment, = get_segments(tmpdir)
+    size = os.path.getsize(segment)
+    with open(segment, 'r+b') as f:
+        f.truncate(size - torn)
+
+    store = open_store(tmpdir)
+    try:
+        assert store.get_command(first) is not None
+        assert store.get_command(second) is None
+        assert store.get_idempotent(1, 'b') is None
+        assert store.persist(create_command('b')).ident == second
+    finally:
+        store.close()
+
+    store = open_store(tmpdir)
+    try:
+        assert [x.command_id for x in store.get_commands()] == [second, first]
+        assert store.get_idempotent(1, 'b').command_id == second
+    finally:
+        store.close()
+
+
+def test_corrupt_tail_is_truncated(tmpdir, store):
+    first = store.persist(create_command()).ident
+    offset = os.path.getsize(get_segments(tmpdir)[0])
+    store.set_status(first, store.STATE_DONE)
+    store.close()
+    segment, = get_segments(tmpdir)
+    with open(segment, 'r+b') as f:
+        f.seek(offset + store.header.size)
+        f.write(b'\xff')
+
+    store = open_store(tmpdir)
+    try:
+        assert store.get_command(first).status == store.STATE_PENDING
+        assert os.path.getsize(segment) == offset
+        store.set_status(first, store.STATE_FAILED)
+    finally:
+        store.close()
+
+    store = open_store(tmpdir)
+    try:
+        assert store.get_command(first).status == store.STATE_FAILED
+    finally:
+        store.close()
+
+
+def test_garbage_after_the_last_record_is_truncated(tmpdir, store):
+    command_id = store.persist(create_command()).ident
+    store.close()
+    segment, = get_segments(tmpdir)
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(b'\x00' * 3)
+
+    store = open_store(tmpdir)
+    try:
+        assert os.path.getsize(segment) == size
+        assert store.get_command(command_id) is not None
+    finally:
+        store.close()
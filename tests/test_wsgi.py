@@ -0,0 +1,234 @@
+import json
+
+import pytest
+
+pytest.importorskip('werkzeug')
+pytest.importorskip('libsousou')
+
+from werkzeug.test import EnvironBuilder
+
+from gateway import Gateway
+from gateway.admission import AdmissionControl
+from gateway.codec import CodecRegistry
+from gateway.codec import JSONCodec
+from gateway.memory import MemoryCommandStore
+from gateway.metrics import MetricsRegistry
+from gateway.metrics import NullMetricsRegistry
+from gateway.mixins import ICommandProcessor
+from gateway.wsgi import BatchController
+from gateway.wsgi import CommandStatusController
+from gateway.wsgi import GatewayApplication
+from gateway.wsgi import GatewayController
+from gateway.wsgi import MetricsController
+
+
+class Handlers:
+    """Rejects the commands of type ``invalid``."""
+
+    def validate(self, command):
+        if command.command == 'invalid':
+            raise ICommandProcessor.CommandRejected(reason="Invalid.")
+        return command
+
+
+class Runner(ICommandProcessor):
+    """Returns the parameters of the commands as their result."""
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, command):
+        self.executed.append(command.id)
+        return command.id, dict(command.params), True, True, False
+
+    def get_metrics(self):
+        return {'queue_depth': 3}
+
+
+class TextCodec(JSONCodec):
+    """Encodes JSON as a custom media type."""
+    content_type = 'application/x-test'
+    aliases = []
+
+
+class SmallBatchController(BatchController):
+    max_batch_size = 2
+
+
+@pytest.fixture
+def gateway():
+    gateway = Gateway()
+    gateway.store = MemoryCommandStore(capacity=100)
+    gateway.archive = MemoryCommandStore(capacity=10)
+    gateway.runner = Runner()
+    gateway.handlers = Handlers()
+    gateway.metrics = NullMetricsRegistry()
+    gateway.admission = AdmissionControl()
+    return gateway
+
+
+def dispatch(controller_class, gateway, method='GET', path='/v1/command',
+    data=None, metrics=None, codecs=None, kwargs=None, **options):
+    """Dispatch a request to a new `controller_class` and return the
+    response.
+    """
+    controller = controller_class()
+    controller.gateway = gateway
+    controller.metrics = metrics or NullMetricsRegistry()
+    if data is not None and not isinstance(data, (str, bytes)):
+        data = json.dumps(data)
+        options.setdefault('content_type', 'application/json')
+    request = GatewayApplication.request_class(EnvironBuilder(path=path,
+        method=method, data=data, **options).get_environ())
+    request.codecs = codecs or CodecRegistry(fast_json=False, messagepack=False)
+    return controller.dispatch(request, **(kwargs or {}))
+
+
+def decode(response):
+    return json.loads(response.get_data(as_text=True))
+
+
+def read(response):
+    # Streamed responses are passed through to the server as is.
+    return ''.join(response.response)
+
+
+def issue(gateway, count):
+    for i in range(count):
+        dispatch(GatewayController, gateway, 'POST',
+            data={'command': 'test', 'params': {'i': i}})
+
+
+def test_post_issues_the_command(gateway):
+    response = dispatch(GatewayController, gateway, 'POST',
+        data={'command': 'test', 'params': {'foo': 1}})
+    assert response.status_code == 201
+    assert decode(response) == {'command_id': 1, 'ident': 1, 'result': {'foo': 1}}
+
+
+def test_batch_reports_the_outcome_of_each_item(gateway):
+    response = dispatch(BatchController, gateway, 'POST',
+        path='/v1/commands:batch', data=[
+            {'command': 'test', 'params': {'foo': 1}},
+            {'command': 'test'},
+            {'command': 'invalid', 'params': {}},
+            {'command': 'test', 'params': {'foo': 2}},
+        ])
+    assert response.status_code == 200
+    first, malformed, rejected, last = decode(response)
+    assert (first['status'], first['result']) == (201, {'foo': 1})
+    assert (last['status'], last['result']) == (201, {'foo': 2})
+    for item in (malformed, rejected):
+        assert item['status'] == 422
+        assert item['code'] == 'UNPROCESSABLE_ENTITY'
+    assert 'params' in malformed['context']
+    assert rejected['hint'] == "Invalid."
+    assert len(gateway.runner.executed) == 2
+
+
+def test_batch_items_may_carry_an_idempotency_key(gateway):
+    item = {'command': 'test', 'params': {'foo': 1}, 'idempotency_key': 'a'}
+    first, retried = decode(dispatch(BatchController, gateway, 'POST',
+        path='/v1/commands:batch', data=[item, item]))
+    assert first == retried
+    assert decode(dispatch(BatchController, gateway, 'POST',
+        path='/v1/commands:batch', data=[item])) == [first]
+    assert len(gateway.runner.executed) == 1
+
+
+@pytest.mark.parametrize('data,headers,status', [
+    ({'command': 'test', 'params': {}}, {}, 400),
+    ([{'command': 'test', 'params': {}}] * 3, {}, 400),
+    ([{'command': 'test', 'params': {}}], {'Idempotency-Key': 'a'}, 422),
+])
+def test_invalid_batches_are_rejected(gateway, data, headers, status):
+    response = dispatch(SmallBatchController, gateway, 'POST',
+        path='/v1/commands:batch', data=data, headers=headers)
+    assert response.status_code == status
+    assert gateway.runner.executed == []
+
+
+def test_metrics_endpoint_renders_the_metrics_and_gauges(gateway):
+    metrics = MetricsRegistry()
+    dispatch(GatewayController, gateway, 'POST', metrics=metrics,
+        data={'command': 'test', 'params': {}})
+    response = dispatch(MetricsController, gateway, path='/metrics',
+        metrics=metrics)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    lines = response.get_data(as_text=True).splitlines()
+    assert 'gateway_runner_queue_depth 3' in lines
+    assert any(x.startswith('gateway_request_duration_seconds_count{')
+        and 'outcome="ok"' in x for x in lines)
+
+
+def test_metrics_endpoint_is_disabled_without_registry(gateway):
+    assert dispatch(MetricsController, gateway, path='/metrics')\
+        .status_code == 404
+
+
+def test_codecs_are_negotiated_from_the_request_headers(gateway):
+    codecs = CodecRegistry(fast_json=False, messagepack=False)
+    codecs.register(TextCodec())
+    response = dispatch(GatewayController, gateway, 'POST', codecs=codecs,
+        data=json.dumps({'command': 'test', 'params': {'foo': 1}}),
+        content_type=TextCodec.content_type,
+        headers={'Accept': TextCodec.content_type})
+    assert response.status_code == 201
+    assert response.mimetype == TextCodec.content_type
+    assert decode(response)['result'] == {'foo': 1}
+
+    response = dispatch(GatewayController, gateway, codecs=codecs,
+        headers={'Accept': 'application/json;q=0.5, application/x-test'})
+    assert response.mimetype == TextCodec.content_type
+    response = dispatch(GatewayController, gateway, codecs=codecs,
+        headers={'Accept': 'text/html'})
+    assert response.mimetype == 'application/json'
+
+
+def test_listing_is_streamed_on_request(gateway):
+    issue(gateway, 5)
+    response = dispatch(GatewayController, gateway,
+        query_string={'stream': 'true', 'limit': 3})
+    assert response.mimetype == 'application/json'
+    assert [x['command_id'] for x in json.loads(read(response))] == [5, 4, 3]
+
+    response = dispatch(GatewayController, gateway,
+        headers={'Accept': 'application/x-ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+    lines = read(response).splitlines()
+    assert [json.loads(x)['command_id'] for x in lines] == [5, 4, 3, 2, 1]
+
+
+def test_unchanged_pages_are_not_sent_again(gateway):
+    issue(gateway, 5)
+    response = dispatch(GatewayController, gateway, query_string={'limit': 2})
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert 'cursor=4' in response.headers['Link']
+
+    response = dispatch(GatewayController, gateway, query_string={'limit': 2},
+        headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    issue(gateway, 1)
+    response = dispatch(GatewayController, gateway, query_string={'limit': 2},
+        headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_command_status_is_returned_with_its_result(gateway):
+    issue(gateway, 1)
+    gateway.store.set_status(1, gateway.store.STATE_DONE,
+        result={'ident': 'a', 'result': 2})
+    response = dispatch(CommandStatusController, gateway,
+        path='/v1/command/1', query_string={'wait': 1}, kwargs={'command_id': 1})
+    assert response.status_code == 200
+    command = decode(response)
+    assert (command['status'], command['ident'], command['result'])\
+        == ('done', 'a', 2)
+
+    response = dispatch(CommandStatusController, gateway,
+        path='/v1/command/2', kwargs={'command_id': 2})
+    assert response.status_code == 404